@@ -1,25 +1,43 @@
 import asyncio
+import collections
+import contextlib
+import hashlib
+import http.server
+import io
+import itertools
+import json
 import logging
 import os
+import re
+import sqlite3
+import sys
+import threading
+import time
 
 import dotenv
-import firebase_admin
 import kivy.properties as kvprops
-import openai
-import pyrebase
-from firebase_admin import auth, credentials
 from kivy.clock import Clock
+from kivy.event import EventDispatcher
+from kivy.graphics.context import get_context
 from kivy.lang import Builder
 from kivy.metrics import dp
 from kivy.storage.jsonstore import JsonStore
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.utils import escape_markup
 from kivymd.app import MDApp
 from kivymd.uix.boxlayout import MDBoxLayout
-from kivymd.uix.button import MDFlatButton, MDRaisedButton
+from kivymd.uix.button import MDRaisedButton
 from kivymd.uix.dialog import MDDialog
+from kivymd.uix.label import MDLabel
 from kivymd.uix.list import IconRightWidget, OneLineAvatarIconListItem
 from kivymd.uix.menu import MDDropdownMenu
 from kivymd.uix.screenmanager import MDScreenManager
 
+try:
+    import tiktoken
+except ImportError:  # Token counts are estimated from the text length without it
+    tiktoken = None
+
 dotenv.load_dotenv()
 
 # --------------------------------------------------------------------------------
@@ -37,16 +55,68 @@ SENDER_ID = os.getenv("SENDER_ID")
 # --------------------------------------------------------------------------------
 
 INSTRUCTIONS = """<<PUT THE PROMPT HERE>>"""
+MODEL = "gpt-3.5-turbo"
 TEMPERATURE = 0.5
 MAX_TOKENS = 500
 FREQUENCY_PENALTY = 0
 PRESENCE_PENALTY = 0.6
-MAX_CONTEXT_QUESTIONS = 10  # Limits how many questions we include in the prompt
+CONTEXT_TOKEN_BUDGET = 3000  # Tokens of instructions, history and question sent with each prompt
+CONTEXT_SUMMARY_ENABLED = False  # Summarizes turns that no longer fit the budget into one system message
+CONTEXT_SUMMARY_BATCH = 4  # Turns that have to drop out of the context before they are summarized
+STREAM_RESPONSES = True  # Renders assistant replies token by token
+STREAM_FRAME_BUDGET = 1 / 30  # Minimum seconds between two label updates while streaming
+MAX_CONCURRENT_PROMPTS = 3  # Chats that generate a reply at the same time, the others wait for a free slot
+READ_MORE_LIMIT = 200  # Answers longer than this are truncated behind a "Read more" button
+HISTORY_PAGE_SIZE = 20  # Prompt and answer pairs rendered per page when scrolling up in a chat
+BUBBLE_HEIGHT_CACHE_SIZE = 4096  # Measured chat bubble heights kept per (text, width)
+BUBBLE_TEXTURE_CACHE_PIXELS = 8 * 1024 * 1024  # Pixels of rendered bubble texts kept per (text, width, font, color)
+MESSAGE_MODEL_CACHE_SIZE = 1024  # Parsed messages kept per text
+FOLLOW_UP_PROMPT = "Tell me more about {item}."  # Sent when a list item of an answer is tapped
+CHAT_CACHE_PATH = "chats.db"  # Local mirror of the user's chats, next to settings.json
+CHAT_STREAM_ENABLED = True  # Follows changes to the user's chats from other devices while logged in
+CHAT_STREAM_RETRY_DELAY = 2  # Seconds before the chat stream is opened again after it stopped, doubled per attempt
+CHAT_STREAM_MAX_RETRY_DELAY = 60  # Upper limit of the chat stream retry delay
+CHAT_STREAM_CHATS_PER_FRAME = 4  # Chats updated from the chat stream per frame, the rest waits for the next frames
+CAPTURE_MAX_SIZE = 512  # Longest side in pixels of the camera photos sent to ingredient recognition
+CAPTURE_JPEG_QUALITY = 85  # JPEG quality of the camera photos sent to ingredient recognition
+RECIPE_OPTIONS = 10  # Recipes suggested for the ingredients of a camera capture
+RECIPE_PREFETCH = 3  # Best ranked suggestions whose recipes are requested while the user is still choosing
+RECIPE_CONCURRENCY = 3  # Recipes requested at the same time
+RECIPE_CACHE_SIZE = 100  # Suggestions and recipes kept per (ingredients, title)
+RECIPE_OPTIONS_PROMPT = "List {count} dishes I can cook with these ingredients: {ingredients}. Answer with a JSON " \
+                        "array of dish names only, best match first."
+RECIPE_DETAIL_PROMPT = "Write the full recipe of {title} with these ingredients: {ingredients}. List the " \
+                       "ingredients with amounts, then number the steps."
+RECIPE_PROMPT = "How do I cook {title}?"  # Shown as the user's message when a suggested recipe is picked
+SCREEN_PRELOAD = True  # Builds screens that are not shown yet during idle frames after startup
+SCREEN_PRELOAD_DELAY = 1  # Seconds after the first frame before preloading starts
+SERVICES_START_DELAY = 0.1  # Seconds after startup before Firebase and OpenAI are loaded, after the first frame
+PRELOADED_SCREENS = ("signup", "home", "settings")  # The camera screen opens the camera, so it is built on demand
+USERNAME_INDEX_BATCH_SIZE = 500  # Users read per request while building the usernames index
+NULL_ETAG = "K+iMpCQsduglOsYkdIUQZQMtaDM="  # ETag the Realtime Database returns for an empty node
+CHAT_SCHEMA_VERSION = 2  # Layout of the chats in the database and the local cache, see new_chat_id
+CHAT_MIGRATION_BATCH_SIZE = 100  # Users read per request while moving chats to the current schema
+CHAT_DOWNLOAD_PAGE_SIZE = 100  # Prompt and answer pairs read per request when a chat is downloaded
+RESPONSE_CACHE_ENABLED = False  # Reuses completions and moderation results for identical requests
+RESPONSE_CACHE_SIZE = 256  # Entries kept in memory per cache
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # Seconds a cached response stays valid
+RESPONSE_CACHE_PATH = None  # e.g. "responses.db" to keep cached responses across restarts
+RESPONSE_CACHE_DISK_SIZE = 10000  # Entries kept on disk per cache
+ID_TOKEN_EXPIRY_MARGIN = 5 * 60  # Seconds before expiry after which a stored ID token is refreshed instead of reused
+AUTO_LOGIN_RETRY_DELAY = 30  # Seconds before the stored user is logged in again when the server could not be reached
+HTTP_POOL_SIZE = 10  # Connections kept open per host, also the most requests in flight per host
+HTTP_KEEPALIVE = 60  # Seconds an idle connection to OpenAI is kept open
+HTTP_MAX_RETRIES = 3  # Retries of failed connections to Firebase
+METRICS_SINK = "log"  # Where backend metrics are exported: "log", "json", "prometheus" or None
+METRICS_EXPORT_INTERVAL = 60  # Seconds between two metrics exports
+METRICS_SAMPLE_SIZE = 1000  # Latest latencies kept per operation for the percentiles
+METRICS_JSON_PATH = "metrics.json"  # File written by the "json" sink
+METRICS_PROMETHEUS_PORT = 9464  # Local port of the text endpoint of the "prometheus" sink
+METRICS_OVERLAY = False  # Shows the live metrics on the settings screen
+UI_STALL_THRESHOLD = 0.1  # Frames longer than this many seconds are recorded as UI thread stalls
 
 # ------------------------------------------------------------------------------
 
-openai.api_key = OPENAI_API_KEY
-
 config = {
     "apiKey": FIREBASE_WEB_API_KEY,
     "authDomain": "dataai-dev.firebaseapp.com",
@@ -57,24 +127,2115 @@ config = {
     "appId": APP_ID,
 }
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class Metrics:
+    """
+    Count, errors, bytes and latency percentiles per operation name, e.g. "db.users.get" or "openai.completion".
+    Safe to use from any thread.
+    """
+
+    def __init__(self, sample_size: int):
+        self.sample_size = sample_size
+        self.operations = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def record(self, name: str, seconds: float, nbytes: int = 0, error: bool = False):
+        """
+        Adds one finished operation.
+        :param name:
+        :param seconds:
+        :param nbytes: Bytes sent and received
+        :param error: Whether the operation raised
+        :return: None
+        """
+        with self.lock:
+            operation = self.operations.get(name)
+            if operation is None:
+                operation = self.operations[name] = {
+                    "count": 0, "errors": 0, "bytes": 0, "seconds": 0.0,
+                    "samples": collections.deque(maxlen=self.sample_size),
+                }
+            operation["count"] += 1
+            operation["errors"] += error
+            operation["bytes"] += nbytes
+            operation["seconds"] += seconds
+            operation["samples"].append(seconds)
+
+    @contextlib.contextmanager
+    def measure(self, name: str):
+        """
+        Records the duration of the block. The yielded dict takes the bytes of the operation under "bytes".
+        :param name:
+        :return: Iterator[dict]
+        """
+        measurement = {"bytes": 0}
+        started_at = time.perf_counter()
+        error = False
+        try:
+            yield measurement
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started_at, measurement["bytes"], error)
+
+    def call(self, name: str, function, *args, **kwargs):
+        """
+        Calls function and records it. HTTP responses received meanwhile on this thread add to its bytes.
+        :param name:
+        :param function:
+        :return: Any: result of function
+        """
+        with self.measure(name) as measurement:
+            self.local.measurement = measurement
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.measurement = None
+
+    def count_response(self, response, *args, **kwargs):
+        """
+        requests response hook, adds the request and response sizes to the operation running on this thread.
+        :param response:
+        :return: None
+        """
+        measurement = getattr(self.local, "measurement", None)
+        if measurement is not None:
+            body = response.request.body or b""
+            measurement["bytes"] += len(body) + int(response.headers.get("Content-Length") or 0)
+
+    def snapshot(self):
+        """
+        Returns the current numbers of every operation, latencies in milliseconds.
+        :return: dict[str, dict]
+        """
+        with self.lock:
+            operations = {name: dict(operation, samples=sorted(operation["samples"]))
+                          for name, operation in self.operations.items()}
+
+        result = {}
+        for name, operation in sorted(operations.items()):
+            samples = operation.pop("samples")
+            result[name] = dict(operation, **{
+                f"p{quantile}": samples[min(len(samples) - 1, len(samples) * quantile // 100)] * 1000
+                for quantile in (50, 95, 99)
+            })
+        return result
+
+
+class LogMetricsSink:
+    """
+    Writes the metrics to the log.
+    """
+
+    @staticmethod
+    def export(snapshot: dict):
+        for name, operation in snapshot.items():
+            logging.info("Metrics: %s count=%d errors=%d bytes=%d p50=%.1fms p95=%.1fms p99=%.1fms", name,
+                         operation["count"], operation["errors"], operation["bytes"],
+                         operation["p50"], operation["p95"], operation["p99"])
+
+
+class JsonMetricsSink:
+    """
+    Replaces a JSON file with the metrics on every export.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, snapshot: dict):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"time": time.time(), "operations": snapshot}, file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+class PrometheusMetricsSink:
+    """
+    Serves the metrics of the last export in the Prometheus text format on http://127.0.0.1:port/metrics.
+    """
+
+    def __init__(self, port: int):
+        self.text = b""
+        sink = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(sink.text)))
+                self.end_headers()
+                self.wfile.write(sink.text)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics-endpoint", daemon=True).start()
+
+    def export(self, snapshot: dict):
+        lines = []
+        for metric, field, kind in (("dataai_operations_total", "count", "counter"),
+                                    ("dataai_operation_errors_total", "errors", "counter"),
+                                    ("dataai_operation_bytes_total", "bytes", "counter"),
+                                    ("dataai_operation_seconds_sum", "seconds", "counter")):
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.extend(f'{metric}{{operation="{name}"}} {operation[field]}' for name, operation in snapshot.items())
+        lines.append("# TYPE dataai_operation_seconds summary")
+        for name, operation in snapshot.items():
+            for quantile in (50, 95, 99):
+                seconds = operation[f"p{quantile}"] / 1000
+                lines.append(f'dataai_operation_seconds{{operation="{name}",quantile="0.{quantile}"}} {seconds}')
+        self.text = ("\n".join(lines) + "\n").encode()
+
+
+metrics = Metrics(METRICS_SAMPLE_SIZE)
+
+
+class InstrumentedClient:
+    """
+    Wraps a backend client so that every method call is recorded in metrics as "prefix.method".
+    """
+
+    def __init__(self, client, prefix: str):
+        self.client = client
+        self.prefix = prefix
+
+    def operation_name(self, method: str):
+        return f"{self.prefix}.{method}"
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.client, name)
+        if not callable(attr) or isinstance(attr, type):
+            return attr
+
+        def call(*args, **kwargs):
+            return metrics.call(self.operation_name(name), attr, *args, **kwargs)
+
+        return call
+
+
+class InstrumentedDatabase(InstrumentedClient):
+    """
+    Instrumented pyrebase database. Query building calls are passed through, requests are recorded as
+    "db.<top level node>.<method>", e.g. "db.chats.get".
+    """
+
+    QUERY_METHODS = {"child", "shallow", "order_by_key", "order_by_value", "order_by_child", "start_at", "end_at",
+                     "equal_to", "limit_to_first", "limit_to_last"}
+
+    def __init__(self, database):
+        super().__init__(database, "db")
+
+    def operation_name(self, method: str):
+        node = str(self.client.path).strip("/").split("/")[0] or "root"
+        return f"{self.prefix}.{node}.{method}"
+
+    def __getattr__(self, name: str):
+        if name in self.QUERY_METHODS:
+            method = getattr(self.client, name)
+
+            def query(*args, **kwargs):
+                method(*args, **kwargs)
+                return self
+
+            return query
+        return super().__getattr__(name)
+
+
+class InstrumentedFirebase:
+    """
+    Instrumented pyrebase app. Its auth and database clients are instrumented, and the sizes of its HTTP responses
+    are counted.
+    """
+
+    def __init__(self, firebase):
+        self.firebase = firebase
+        session = getattr(firebase, "requests", None)
+        if session is not None:
+            session.hooks["response"].append(metrics.count_response)
+
+    def auth(self):
+        return InstrumentedClient(self.firebase.auth(), "auth")
+
+    def database(self):
+        return InstrumentedDatabase(self.firebase.database())
+
+    def __getattr__(self, name: str):
+        return getattr(self.firebase, name)
+
+
+def instrument_service(name: str, client):
+    """
+    Wraps a service client so that its calls are recorded in metrics. The openai calls are recorded where they are
+    made, since streamed completions finish after the call returns.
+    :param name:
+    :param client:
+    :return: Any
+    """
+    if name == "firebase":
+        return InstrumentedFirebase(client)
+    if name == "admin_auth":
+        return InstrumentedClient(client, "admin_auth")
+    if name == "recognizer":
+        return InstrumentedClient(client, "recognizer")
+    return client
+
+
+_services = {}  # Service clients, created on first use by the accessors below
+_services_lock = threading.RLock()
+
+
+def _service(name: str, create):
+    """
+    Returns the service client stored under name, creating it on first use. Safe to call from any thread.
+    :param name:
+    :param create: callable that returns the client
+    :return: Any
+    """
+    with _services_lock:
+        if name not in _services:
+            _services[name] = create()
+        return _services[name]
+
+
+def register_service(name: str, client):
+    """
+    Replaces a service client, e.g. with an in-memory fake for headless runs and benchmarks. Call it before the app
+    starts. Names are "firebase", "admin_auth", "openai" and "recognizer"; the auth and database clients are created
+    from the registered firebase app.
+    :param name:
+    :param client:
+    :return: None
+    """
+    with _services_lock:
+        _services[name] = instrument_service(name, client)
+        if name == "firebase":
+            _services.pop("auth", None)
+            _services.pop("db", None)
+
+
+def get_firebase():
+    """
+    Returns the pyrebase app. Imports and initializes pyrebase and the Firebase Admin SDK on first use.
+    :return: pyrebase.pyrebase.Firebase
+    """
+    def create():
+        import firebase_admin
+        import pyrebase
+        from firebase_admin import credentials
+
+        firebase_admin.initialize_app(credentials.Certificate(GOOGLE_APPLICATION_CREDENTIALS))
+        firebase = pyrebase.initialize_app(config)
+        mount_http_pool(firebase.requests)
+        return instrument_service("firebase", firebase)
+
+    return _service("firebase", create)
+
+
+def get_auth():
+    """
+    Returns the pyrebase auth client.
+    :return: pyrebase.pyrebase.Auth
+    """
+    return _service("auth", lambda: get_firebase().auth())
+
+
+def get_db():
+    """
+    Returns the database used on the main thread. Worker threads create their own with get_firebase().database().
+    :return: pyrebase.pyrebase.Database
+    """
+    return _service("db", lambda: get_firebase().database())
+
+
+def get_admin_auth():
+    """
+    Returns the firebase_admin.auth module of the initialized Firebase Admin SDK.
+    :return: module
+    """
+    def create():
+        get_firebase()
+        from firebase_admin import auth
+        return instrument_service("admin_auth", auth)
+
+    return _service("admin_auth", create)
+
+
+def get_openai():
+    """
+    Returns the openai module with the API key set. On the worker loop, the requests of the calling task go through
+    the shared aiohttp session instead of a new session per request.
+    :return: module
+    """
+    def create():
+        import openai
+        openai.api_key = OPENAI_API_KEY
+        return openai
+
+    openai = _service("openai", create)
+    aiosession = getattr(openai, "aiosession", None)
+    if aiosession is not None and aiosession.get() is None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return openai
+        aiosession.set(get_http_session())
+    return openai
+
+
+def get_recognizer():
+    """
+    Returns the ingredient recognition backend, StubIngredientRecognizer unless one was registered with
+    register_service("recognizer", backend).
+    :return: Any: object with a recognize(photo) method, see StubIngredientRecognizer
+    """
+    return _service("recognizer", lambda: instrument_service("recognizer", StubIngredientRecognizer()))
+
+
+def mount_http_pool(session):
+    """
+    Replaces the connection pool of a requests session with one of HTTP_POOL_SIZE kept-alive connections per host.
+    Requests wait for a free connection instead of opening more.
+    :param session: requests.Session shared by the pyrebase auth and database clients
+    :return: None
+    """
+    import requests
+
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                                            max_retries=HTTP_MAX_RETRIES, pool_block=True)
+    for scheme in ("http://", "https://"):
+        session.mount(scheme, adapter)
+
+
+def get_http_session():
+    """
+    Returns the aiohttp session of the worker loop, with HTTP_POOL_SIZE kept-alive connections per host. Must be
+    called on the worker loop.
+    :return: aiohttp.ClientSession
+    """
+    def create():
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(limit_per_host=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE)
+        return aiohttp.ClientSession(connector=connector)
+
+    return _service("http", create)
+
+
+async def close_http_session():
+    """
+    Closes the aiohttp session of the worker loop if it was created.
+    :return: None
+    """
+    with _services_lock:
+        session = _services.pop("http", None)
+    if session is not None:
+        await session.close()
+
+
+def is_network_error(error: Exception):
+    """
+    Returns whether a request failed because the server could not be reached, rather than being refused by it.
+    :param error:
+    :return: bool
+    """
+    import requests
+
+    # Only looked up when loaded, since the error may come from loading the services
+    with _services_lock:
+        admin_auth = _services.get("admin_auth") or sys.modules.get("firebase_admin.auth")
+    certificate_error = getattr(admin_auth, "CertificateFetchError", ConnectionError)
+    return isinstance(error, (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout,
+                              certificate_error))
+
+
+def sign_up_error_message(error: Exception):
+    """
+    Returns the message shown for a failed sign up. Like is_network_error, it does not load the services, since the
+    error may come from loading them.
+    :param error:
+    :return: str
+    """
+    with _services_lock:
+        admin_auth = _services.get("admin_auth") or sys.modules.get("firebase_admin.auth")
+    email_exists = getattr(admin_auth, "EmailAlreadyExistsError", None)
+    uid_exists = getattr(admin_auth, "UidAlreadyExistsError", None)
+    # pyrebase raises requests.HTTPError with the EMAIL_EXISTS response of the REST API in its message
+    if email_exists is not None and isinstance(error, email_exists) or "EMAIL_EXISTS" in str(error):
+        return "The user with the provided email already exists."
+    if uid_exists is not None and isinstance(error, uid_exists):
+        return "The user with the provided username already exists."
+    return str(error)
+
+
+def iter_user_batches(database, batch_size: int):
+    """
+    Reads the users node in key order, batch_size users per request.
+    :param database:
+    :param batch_size:
+    :return: Iterator[dict]: user key to user record, one dict per batch
+    """
+    last_key = None
+    while True:
+        query = database.child("users").order_by_key()
+        if last_key is not None:
+            query = query.start_at(last_key)
+        users = query.limit_to_first(batch_size + 1).get().val() or {}
+        keys = [key for key in users if key != last_key][:batch_size]
+        if not keys:
+            return
+        yield {key: users[key] for key in keys}
+        last_key = keys[-1]
+
+
+def migrate_username_index(batch_size: int = USERNAME_INDEX_BATCH_SIZE):
+    """
+    Builds the usernames/{username} index from the existing users node, reading and writing one batch of users at a
+    time. Usernames that are already indexed keep their owner. Usernames claimed by a sign up that stopped before its
+    user record was written are released, or given to a user whose record has that username. Run it once before
+    releasing the indexed sign up, e.g. python -c "import main; main.migrate_username_index()".
+    :param batch_size:
+    :return: int: number of usernames added to the index
+    """
+    database = get_firebase().database()
+    indexed = dict(database.child("usernames").get().val() or {})
+    owners = set()
+    skipped = {}
+    added = 0
+
+    for users in iter_user_batches(database, batch_size):
+        updates = {}
+        owners.update(users)
+        for key, user in users.items():
+            username = user.get("username")
+            if not username:
+                continue
+            if username in indexed:
+                if indexed[username] != key:
+                    skipped.setdefault(username, key)
+                    logging.warning("Username %s of %s is already taken, skipped", username, key)
+                continue
+            indexed[username] = key
+            updates[f"usernames/{username}"] = key
+
+        if updates:
+            database.update(updates)
+            added += len(updates)
+        logging.info("Username index: %d users read, %d usernames added", len(users), len(updates))
+
+    orphans = {f"usernames/{username}": skipped.get(username)
+               for username, owner in indexed.items() if owner not in owners}
+    if orphans:
+        database.update(orphans)
+        logging.info("Username index: %d usernames without a user released", len(orphans))
+    return added
+
+
+def claim_username(database, username: str, owner: str):
+    """
+    Writes usernames/{username} for the owner unless the username is taken. The ETag tells whether the entry is
+    empty, and the write is conditional on it, so of two sign ups claiming the same username at the same time only
+    one succeeds. The entry is only read when the write was refused.
+    :param database:
+    :param username:
+    :param owner: user key of the owner
+    :return: bool: whether the username was claimed
+    """
+    etag = database.child("usernames").child(username).get_etag()
+    if etag != NULL_ETAG:
+        return False
+    # A failed condition returns the current ETag instead of the written value
+    result = database.child("usernames").child(username).conditional_set(owner, etag)
+    if isinstance(result, dict) and "ETag" in result:
+        # Claimed in the meantime, possibly by a retried request of this sign up
+        return database.child("usernames").child(username).get().val() == owner
+    return True
+
+
+# Chats are stored per user as
+#   conversations/{email}/{chat_id}: {"title", "created_at", "updated_at", "pairs", "schema"}
+#   messages/{email}/{chat_id}/{pair_key}: {"prompt", "answer", "created_at", "prompt_tokens", "answer_tokens"}
+# Chat ids sort by creation time and pair keys by position, so orderByKey with startAt, endAt and limitToLast pages
+# through the chats and their messages. Schema 1, the layout before chat ids, stored chats/{email}/{title} with
+# prompt_N and answer_N keys, see migrate_chat_schema.
+def new_chat_id(created_at=None):
+    """
+    Returns a new chat id. Ids start with the creation time in milliseconds, so they sort by age.
+    :param created_at: Creation time, now if None
+    :return: str
+    """
+    milliseconds = int((created_at or time.time()) * 1000)
+    return f"{milliseconds:012x}{os.urandom(4).hex()}"
+
+
+def pair_key(index: int):
+    """
+    Returns the database key of the prompt and answer pair at the given index, starting from 1.
+    :param index:
+    :return: str
+    """
+    return f"{index:06d}"
+
+
+def chat_meta(title: str, created_at: float, updated_at: float, pairs: int):
+    """
+    Returns the conversations/{email}/{chat_id} record of a chat.
+    :param title:
+    :param created_at:
+    :param updated_at:
+    :param pairs: Number of prompt and answer pairs
+    :return: dict
+    """
+    return {"title": title, "created_at": created_at, "updated_at": updated_at, "pairs": pairs,
+            "schema": CHAT_SCHEMA_VERSION}
+
+
+def message_record(pair: tuple, created_at: float):
+    """
+    Returns the messages/{email}/{chat_id}/{pair_key} record of a prompt and answer pair.
+    :param pair:
+    :param created_at:
+    :return: dict
+    """
+    prompt, answer = pair
+    return {"prompt": prompt, "answer": answer, "created_at": created_at,
+            "prompt_tokens": ContextBuilder.count_tokens(prompt),
+            "answer_tokens": ContextBuilder.count_tokens(answer)}
+
+
+def fetch_messages(database, email: str, chat_id: str, start: int = 1):
+    """
+    Reads the prompt and answer pairs of a chat from the given index on, newest page first, CHAT_DOWNLOAD_PAGE_SIZE
+    pairs per request.
+    :param database:
+    :param email:
+    :param chat_id:
+    :param start: Index of the first pair to read, starting from 1
+    :return: list[tuple[str, str]]
+    """
+    records = {}
+    end_key = None
+    while True:
+        query = database.child("messages").child(email).child(chat_id).order_by_key().start_at(pair_key(start))
+        if end_key is not None:
+            query = query.end_at(end_key)
+        page = query.limit_to_last(CHAT_DOWNLOAD_PAGE_SIZE + (end_key is not None)).get().val() or {}
+        page = {key: record for key, record in page.items() if key != end_key}
+        records.update(page)
+        if len(page) < CHAT_DOWNLOAD_PAGE_SIZE:
+            break
+        end_key = min(page)
+
+    pairs = []
+    for index, key in enumerate(sorted(records), start):
+        if key != pair_key(index):
+            break  # A pair in between is not written yet
+        pairs.append((records[key]["prompt"], records[key]["answer"]))
+    return pairs
+
+
+def fetch_message_page(database, email: str, chat_id: str, end=None):
+    """
+    Reads one page of prompt and answer pairs with a single request: the newest CHAT_DOWNLOAD_PAGE_SIZE pairs of the
+    chat, or those before index end. Opening a chat reads its newest page and scrolling up reads the older ones.
+    :param database:
+    :param email:
+    :param chat_id:
+    :param end: Index after the last pair to read, the newest pairs if None
+    :return: tuple[int, list[tuple[str, str]]]: index of the first read pair and the pairs
+    """
+    if end is not None and end <= 1:
+        return 1, []
+    query = database.child("messages").child(email).child(chat_id).order_by_key()
+    if end is not None:
+        query = query.end_at(pair_key(end - 1))
+    page = query.limit_to_last(CHAT_DOWNLOAD_PAGE_SIZE).get().val() or {}
+    keys = sorted(page)
+    if not keys:
+        return end or 1, []
+
+    if end is None:
+        # The newest pairs up to the first one that is not written yet
+        start = int(keys[0])
+        pairs = []
+        for index, key in enumerate(keys, start):
+            if key != pair_key(index):
+                break
+            pairs.append((page[key]["prompt"], page[key]["answer"]))
+        return start, pairs
+
+    rows = [(int(key), page[key]["prompt"], page[key]["answer"]) for key in reversed(keys)]
+    return contiguous_pairs(rows, end - 1)
+
+
+def contiguous_pairs(rows, last: int):
+    """
+    Returns the pairs of consecutive indexes that end at the given index.
+    :param rows: (index, prompt, answer) rows, newest first
+    :param last: Index of the newest pair
+    :return: tuple[int, list[tuple[str, str]]]: index of the first pair and the pairs, oldest first
+    """
+    pairs = []
+    expected = last
+    for index, prompt, answer in rows:
+        if index != expected:
+            break
+        pairs.append((prompt, answer))
+        expected -= 1
+    pairs.reverse()
+    return expected + 1, pairs
+
+
+def parse_legacy_chat(chat: dict):
+    """
+    Pairs the prompt_N and answer_N keys of a schema 1 chat in numeric order.
+    :param chat:
+    :return: list[tuple[str, str]]
+    """
+    prompts = {}
+    answers = {}
+    for key, value in chat.items():
+        kind, _, index = key.partition("_")
+        if kind == "prompt":
+            prompts[int(index)] = value
+        elif kind == "answer":
+            answers[int(index)] = value
+    return [(prompts[i], answers[i]) for i in sorted(prompts) if i in answers]
+
+
+def migrate_user_chats(database, email: str, legacy_keys=None):
+    """
+    Moves the schema 1 chats of one user to the current schema. Chats are read one at a time and each is written
+    with one multi-path update that also removes the old copy, so an interrupted migration resumes where it stopped.
+    :param database:
+    :param email: Database key of the user
+    :param legacy_keys: Keys of the user's schema 1 chats, read if None
+    :return: int: number of migrated chats
+    """
+    if legacy_keys is None:
+        legacy_keys = database.child("chats").child(email).shallow().get().val() or {}
+    if not legacy_keys:
+        return 0
+
+    migrated = 0
+    migrated_at = time.time()
+    for index, legacy_key in enumerate(sorted(legacy_keys)):
+        chat = database.child("chats").child(email).child(legacy_key).get().val()
+        if not isinstance(chat, dict):
+            continue  # Migrated by another device in the meantime
+        pairs = parse_legacy_chat(chat)
+        # Schema 1 kept no times, so the chats get ids a millisecond apart in the order they were listed
+        updated_at = migrated_at + index / 1000
+        chat_id = new_chat_id(updated_at)
+
+        update = {f"chats/{email}/{legacy_key}": None}
+        if pairs:
+            update[f"conversations/{email}/{chat_id}"] = chat_meta(
+                MainApp.replace_str(legacy_key, "from_db"), updated_at, updated_at, len(pairs)
+            )
+            update[f"messages/{email}/{chat_id}"] = {
+                pair_key(index): message_record(pair, updated_at) for index, pair in enumerate(pairs, 1)
+            }
+        database.update(update)
+        migrated += 1
+    return migrated
+
+
+def migrate_chat_schema(batch_size: int = CHAT_MIGRATION_BATCH_SIZE):
+    """
+    Moves the schema 1 chats of every user to the current schema, reading one batch of users at a time. Users are
+    also migrated when they log in, so running it is optional, e.g.
+    python -c "import main; main.migrate_chat_schema()".
+    :param batch_size:
+    :return: int: number of migrated chats
+    """
+    database = get_firebase().database()
+    migrated = 0
+    for users in iter_user_batches(database, batch_size):
+        chats = 0
+        for email in users:
+            chats += migrate_user_chats(database, email)
+        migrated += chats
+        logging.info("Chat schema: %d users read, %d chats migrated", len(users), chats)
+    return migrated
+
+
+class StubIngredientRecognizer:
+    """
+    Local ingredient recognition backend that returns a fixed list for every photo. Backends are called on a worker
+    thread with the JPEG bytes of the photo and return the names of the ingredients on it.
+    """
+
+    def __init__(self, ingredients=()):
+        self.ingredients = list(ingredients)
+
+    def recognize(self, photo: bytes):
+        """
+        Returns the ingredients on the photo.
+        :param photo: JPEG bytes made by encode_photo
+        :return: list[str]
+        """
+        return list(self.ingredients)
+
+
+def encode_photo(pixels: bytes, size: tuple, flip: bool):
+    """
+    Turns a camera frame into the JPEG sent to ingredient recognition: downscaled to CAPTURE_MAX_SIZE, upright and
+    with stretched contrast. Pillow reads the frame in place. Runs on a worker thread.
+    :param pixels: RGBA pixels of the camera texture
+    :param size:
+    :param flip: Whether the rows are stored bottom to top, as in an unflipped texture
+    :return: bytes
+    """
+    from PIL import Image, ImageOps
+
+    image = Image.frombuffer("RGBA", tuple(size), pixels, "raw", "RGBA", 0, 1)
+    image.thumbnail((CAPTURE_MAX_SIZE, CAPTURE_MAX_SIZE))
+    if flip:
+        image = image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    image = ImageOps.autocontrast(image.convert("RGB"), cutoff=1)
+
+    photo = io.BytesIO()
+    image.save(photo, format="JPEG", quality=CAPTURE_JPEG_QUALITY)
+    return photo.getvalue()
+
+
+class AsyncWorker:
+    """
+    Owns a background asyncio event loop on a daemon thread. Every network call runs here so the Kivy main thread
+    never blocks; results are posted back to the UI with Clock.schedule_once.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name="async-worker", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro, on_success=None, on_error=None):
+        """
+        Schedules a coroutine on the worker loop. Callbacks are invoked on the Kivy main thread.
+        :param coro:
+        :param on_success: Called with the coroutine result
+        :param on_error: Called with the raised exception
+        :return: concurrent.futures.Future
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        def done(fut):
+            if fut.cancelled():
+                return
+            error = fut.exception()
+            if error is not None:
+                if on_error is not None:
+                    Clock.schedule_once(lambda dt: on_error(error))
+                else:
+                    logging.error("Background task failed: %s", error)
+            elif on_success is not None:
+                result = fut.result()
+                Clock.schedule_once(lambda dt: on_success(result))
+
+        future.add_done_callback(done)
+        return future
+
+    def stop(self):
+        """
+        Stops the worker loop and waits for the thread to finish.
+        :return: None
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=1)
+
+
+class ChatCache:
+    """
+    Local SQLite mirror of the user's chats. Chats are listed and opened from here first, and are synced with
+    firebase in the background using the updated_at marker of every chat. Messages are only ever appended, so a
+    stale chat keeps its messages and only the newer pairs are downloaded.
+    """
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < CHAT_SCHEMA_VERSION:
+                # Schema 1 chats were keyed by title, the mirror is downloaded again after login
+                self.connection.executescript("DROP TABLE IF EXISTS chats; DROP TABLE IF EXISTS messages;")
+                self.connection.execute(f"PRAGMA user_version = {CHAT_SCHEMA_VERSION}")
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS chats (
+                    email TEXT NOT NULL,
+                    chat_key TEXT NOT NULL,
+                    title TEXT NOT NULL DEFAULT '',
+                    updated_at REAL NOT NULL,
+                    loaded INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (email, chat_key)
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    email TEXT NOT NULL,
+                    chat_key TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    prompt TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    PRIMARY KEY (email, chat_key, idx)
+                );
+                """
+            )
+
+    def chat_versions(self, email: str):
+        """
+        Returns the cached chats of the user with their updated_at markers, oldest chat first.
+        :param email:
+        :return: dict[str, float]
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT chat_key, updated_at FROM chats WHERE email = ? ORDER BY chat_key", (email,)
+            ).fetchall()
+        return dict(rows)
+
+    def chat_titles(self, email: str):
+        """
+        Returns the cached chats of the user with their titles, oldest chat first.
+        :param email:
+        :return: dict[str, str]
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT chat_key, title FROM chats WHERE email = ? ORDER BY chat_key", (email,)
+            ).fetchall()
+        return dict(rows)
+
+    def messages(self, email: str, chat_key: str, stale: bool = False):
+        """
+        Returns the newest cached prompt and answer pairs of a chat, back to the first one that is not cached, or
+        None if its messages are not cached or out of date. Older pairs are cached when they are scrolled to.
+        :param email:
+        :param chat_key:
+        :param stale: Also returns the cached pairs of an out of date chat
+        :return: Optional[tuple[int, list[tuple[str, str]]]]: index of the first pair and the pairs
+        """
+        with self.lock:
+            chat = self.connection.execute(
+                "SELECT loaded FROM chats WHERE email = ? AND chat_key = ?", (email, chat_key)
+            ).fetchone()
+            if chat is None or not (chat[0] or stale):
+                return None
+            rows = self.connection.execute(
+                "SELECT idx, prompt, answer FROM messages WHERE email = ? AND chat_key = ? ORDER BY idx DESC",
+                (email, chat_key),
+            ).fetchall()
+        if not rows:
+            return 1, []
+        return contiguous_pairs(rows, rows[0][0])
+
+    def older_messages(self, email: str, chat_key: str, end: int, count: int):
+        """
+        Returns up to count cached pairs of a chat before index end, back to the first one that is not cached.
+        :param email:
+        :param chat_key:
+        :param end: Index after the last pair
+        :param count:
+        :return: list[tuple[str, str]]
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT idx, prompt, answer FROM messages WHERE email = ? AND chat_key = ? AND idx >= ? AND idx < ? "
+                "ORDER BY idx DESC",
+                (email, chat_key, end - count, end),
+            ).fetchall()
+        return contiguous_pairs(rows, end - 1)[1]
+
+    def append_messages(self, email: str, chat_key: str, start: int, pairs: list, updated_at=None):
+        """
+        Stores prompt and answer pairs of a chat from the given index on and marks its messages as up to date.
+        :param email:
+        :param chat_key:
+        :param start: Index of the first pair, starting from 1
+        :param pairs:
+        :param updated_at: Keeps the current marker when None
+        :return: None
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO chats (email, chat_key, updated_at, loaded) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT (email, chat_key) DO UPDATE SET loaded = 1, updated_at = COALESCE(?, updated_at)",
+                (email, chat_key, updated_at or time.time(), updated_at),
+            )
+            self._write_messages(email, chat_key, start, pairs)
+
+    def insert_messages(self, email: str, chat_key: str, start: int, pairs: list):
+        """
+        Stores prompt and answer pairs of a chat from the given index on, e.g. an older page, without marking its
+        messages as up to date.
+        :param email:
+        :param chat_key:
+        :param start: Index of the first pair, starting from 1
+        :param pairs:
+        :return: None
+        """
+        with self.lock, self.connection:
+            self._write_messages(email, chat_key, start, pairs)
+
+    def _write_messages(self, email: str, chat_key: str, start: int, pairs: list):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO messages (email, chat_key, idx, prompt, answer) VALUES (?, ?, ?, ?, ?)",
+            [(email, chat_key, index, prompt, answer) for index, (prompt, answer) in enumerate(pairs, start)],
+        )
+
+    def set_title(self, email: str, chat_key: str, title: str, updated_at: float):
+        """
+        Records the title of a chat.
+        :param email:
+        :param chat_key:
+        :param title:
+        :param updated_at:
+        :return: None
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE chats SET title = ?, updated_at = ? WHERE email = ? AND chat_key = ?",
+                (title, updated_at, email, chat_key),
+            )
+
+    def mark_stale(self, email: str, chat_key: str, updated_at: float, title: str):
+        """
+        Records a newer remote version of a chat. Its newer messages are downloaded when it is opened.
+        :param email:
+        :param chat_key:
+        :param updated_at:
+        :param title:
+        :return: None
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO chats (email, chat_key, title, updated_at, loaded) VALUES (?, ?, ?, ?, 0) "
+                "ON CONFLICT (email, chat_key) DO UPDATE SET title = excluded.title, "
+                "updated_at = excluded.updated_at, loaded = 0",
+                (email, chat_key, title, updated_at),
+            )
+
+    def delete_chat(self, email: str, chat_key: str):
+        """
+        Removes a chat and its messages.
+        :param email:
+        :param chat_key:
+        :return: None
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM chats WHERE email = ? AND chat_key = ?", (email, chat_key))
+            self.connection.execute("DELETE FROM messages WHERE email = ? AND chat_key = ?", (email, chat_key))
+
+    def clear(self, email: str):
+        """
+        Removes every cached chat of the user.
+        :param email:
+        :return: None
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM chats WHERE email = ?", (email,))
+            self.connection.execute("DELETE FROM messages WHERE email = ?", (email,))
+
+
+class ChatStream:
+    """
+    Follows conversations/{email} through the Realtime Database streaming API. Only the chat records are streamed,
+    new messages are read when the record of a chat counts more pairs. Events arrive on the stream thread and are
+    merged per chat until the main thread applies them, CHAT_STREAM_CHATS_PER_FRAME chats at a time, so a burst of
+    events costs one update per chat. A stopped stream is opened again with a growing delay, and the snapshot sent
+    on every connect is applied like any other change.
+    """
+
+    def __init__(self, email: str, on_changes):
+        self.email = email
+        self.on_changes = on_changes
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.snapshot = None
+        self.flush_scheduled = False
+        self.stream = None
+        self.opened_at = None
+        self.closed = False
+        self.retry_delay = CHAT_STREAM_RETRY_DELAY
+        self.watch_event = None
+        self.reconnect_event = None
+
+    def start(self):
+        """
+        Opens the stream and starts watching it.
+        :return: None
+        """
+        self.open()
+        self.watch_event = Clock.schedule_interval(self.watch, CHAT_STREAM_RETRY_DELAY)
+
+    def open(self):
+        self.opened_at = time.time()  # The snapshot sent on connect is read after this
+        database = get_firebase().database()
+        self.stream = database.child("conversations").child(self.email).stream(self.handle, stream_id=self.email)
+
+    def close(self):
+        """
+        Stops following the chats. Pending changes are dropped.
+        :return: None
+        """
+        self.closed = True
+        for event in (self.watch_event, self.reconnect_event):
+            if event is not None:
+                event.cancel()
+        self.close_stream()
+
+    def close_stream(self):
+        # Stream.close joins the stream thread, which can wait for the connection to time out
+        if self.stream is not None:
+            threading.Thread(target=self.stream.close, name="chat-stream-close", daemon=True).start()
+            self.stream = None
+
+    def watch(self, *args):
+        """
+        Schedules a reconnect when the stream thread has stopped.
+        :return: None
+        """
+        thread = getattr(self.stream, "thread", None)
+        if thread is not None and not thread.is_alive():
+            self.schedule_reconnect()
+
+    def schedule_reconnect(self, *args):
+        if self.reconnect_event is None and not self.closed:
+            logging.warning("Chat stream stopped, reconnecting in %gs", self.retry_delay)
+            self.reconnect_event = Clock.schedule_once(self.reconnect, self.retry_delay)
+            self.retry_delay = min(self.retry_delay * 2, CHAT_STREAM_MAX_RETRY_DELAY)
+
+    def reconnect(self, *args):
+        self.reconnect_event = None
+        if not self.closed:
+            self.close_stream()
+            self.open()
+
+    def handle(self, message: dict):
+        """
+        Stream handler, runs on the stream thread.
+        :param message: Server-sent event with event, path and data
+        :return: None
+        """
+        if self.closed:
+            return
+        event = message.get("event")
+        if event in ("cancel", "auth_revoked"):
+            # The server ends the stream after these events
+            Clock.schedule_once(self.schedule_reconnect)
+            return
+        if event not in ("put", "patch"):
+            return
+
+        self.retry_delay = CHAT_STREAM_RETRY_DELAY
+        path = [part for part in (message.get("path") or "/").split("/") if part]
+        data = message.get("data")
+        if event == "patch":
+            updates = [(path + [part for part in key.split("/") if part], value)
+                       for key, value in (data or {}).items()]
+        else:
+            updates = [(path, data)]
+
+        with self.lock:
+            for parts, value in updates:
+                self.merge(parts, value)
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        Clock.schedule_once(self.flush)
+
+    def merge(self, parts: list, value):
+        """
+        Merges one changed node into the pending changes. Must be called with the lock held.
+        :param parts: Path of the node below conversations/{email}
+        :param value:
+        :return: None
+        """
+        if not parts:
+            chats = value if isinstance(value, dict) else {}
+            self.pending = {chat_key: [True, chat] for chat_key, chat in chats.items() if isinstance(chat, dict)}
+            self.snapshot = (set(self.pending), self.opened_at)
+            return
+
+        chat_key = parts[0]
+        if len(parts) == 1:
+            self.pending[chat_key] = [True, value if isinstance(value, dict) else None]
+        elif len(parts) == 2:
+            change = self.pending.setdefault(chat_key, [False, {}])
+            if change[1] is None:
+                change[1] = {}
+            change[1][parts[1]] = value
+
+    def flush(self, *args):
+        """
+        Hands up to CHAT_STREAM_CHATS_PER_FRAME pending chats to on_changes on the main thread. on_changes gets a dict
+        of chat key to (replace, fields) and the (chat keys, opened at) of a new snapshot, or None. replace means
+        fields is the whole chat record, or None if the chat was removed.
+        :return: None
+        """
+        with self.lock:
+            chat_keys = list(itertools.islice(self.pending, CHAT_STREAM_CHATS_PER_FRAME))
+            changes = {chat_key: tuple(self.pending.pop(chat_key)) for chat_key in chat_keys}
+            snapshot, self.snapshot = self.snapshot, None
+            self.flush_scheduled = bool(self.pending)
+
+        if self.flush_scheduled:
+            Clock.schedule_once(self.flush, STREAM_FRAME_BUDGET)
+        if not self.closed and (changes or snapshot is not None):
+            self.on_changes(changes, snapshot)
+
+
+class ResponseCache:
+    """
+    LRU cache of API results keyed by a hash of the request, with an optional SQLite tier on disk. Entries expire
+    after the TTL, and both tiers are trimmed to their size limits, least recently used first.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl: float, path=None, max_disk_entries: int = 0):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            with self.lock, self.connection:
+                self.connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)"
+                )
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Hashes the parts of a request into a cache key.
+        :param parts: JSON serializable request fields
+        :return: str
+        """
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+    def get(self, key: str):
+        """
+        Returns the cached value of the key, or None on a miss.
+        :param key:
+        :return: Any
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[1] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None and self.connection is not None:
+                entry = self.read_disk(key, now)
+                if entry is not None:
+                    self.store_memory(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, value):
+        """
+        Stores a JSON serializable value under the key.
+        :param key:
+        :param value:
+        :return: None
+        """
+        now = time.time()
+        with self.lock:
+            self.store_memory(key, (value, now))
+            if self.connection is None:
+                return
+            with self.connection:
+                self.connection.execute(
+                    f"INSERT OR REPLACE INTO {self.name} (key, value, created_at, used_at) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now, now),
+                )
+                self.connection.execute(f"DELETE FROM {self.name} WHERE created_at < ?", (now - self.ttl,))
+                self.connection.execute(
+                    f"DELETE FROM {self.name} WHERE key IN "
+                    f"(SELECT key FROM {self.name} ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+
+    def store_memory(self, key: str, entry: tuple):
+        """
+        Adds a (value, created_at) entry to the memory tier, evicting the least recently used ones over the limit.
+        :param key:
+        :param entry:
+        :return: None
+        """
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def read_disk(self, key: str, now: float):
+        """
+        Returns the (value, created_at) entry of the key from the disk tier if it has not expired.
+        :param key:
+        :param now:
+        :return: Optional[tuple]
+        """
+        row = self.connection.execute(
+            f"SELECT value, created_at FROM {self.name} WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or now - row[1] > self.ttl:
+            return None
+        with self.connection:
+            self.connection.execute(f"UPDATE {self.name} SET used_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0]), row[1]
+
+    def stats(self):
+        """
+        Returns the hit and miss counters.
+        :return: dict
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+class RecipeBook:
+    """
+    Recipe suggestions and recipes per ingredient set. Suggestions come from one structured completion. Recipes are
+    requested RECIPE_CONCURRENCY at a time and memoized as tasks per (ingredients, title), so a recipe that is still
+    being prefetched is awaited instead of requested again, and an opened recipe is returned at once. Runs on the
+    worker loop.
+    """
+    list_item = re.compile(r"\s*(?:[-*•]|\d+[.)])\s+(.+)")
+
+    def __init__(self, request):
+        """
+        :param request: Coroutine function that returns the completion of (messages, operation)
+        """
+        self.request = request
+        self.tasks = collections.OrderedDict()
+        self.slots = asyncio.Semaphore(RECIPE_CONCURRENCY)
+
+    @staticmethod
+    def ingredients_key(ingredients: list):
+        """
+        Returns the ingredients in a canonical order, so the same set is memoized once.
+        :param ingredients:
+        :return: tuple[str]
+        """
+        return tuple(sorted({ingredient.strip().lower() for ingredient in ingredients}))
+
+    @classmethod
+    def parse_titles(cls, text: str):
+        """
+        Reads the dish names of the suggestion completion, a JSON array of names or a numbered or bulleted list.
+        Other lines, like a preamble, are skipped.
+        :param text:
+        :return: list[str]
+        """
+        decoder = json.JSONDecoder()
+        for start in (index for index, char in enumerate(text) if char == "["):
+            try:
+                titles = decoder.raw_decode(text, start)[0]
+            except ValueError:
+                continue
+            if titles and all(isinstance(title, str) for title in titles):
+                break
+        else:
+            titles = [match.group(1).strip("* ") for match in map(cls.list_item.match, text.splitlines()) if match]
+        return [title.strip() for title in titles if title.strip()][:RECIPE_OPTIONS]
+
+    def memoized(self, key: tuple, create):
+        """
+        Returns the task stored under key, starting it with create on first use. Failed tasks are forgotten so they
+        are requested again.
+        :param key:
+        :param create: callable that returns the coroutine
+        :return: asyncio.Task
+        """
+        task = self.tasks.get(key)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = self.tasks[key] = asyncio.ensure_future(create())
+            task.add_done_callback(self.log_failure)
+        self.tasks.move_to_end(key)
+        while len(self.tasks) > RECIPE_CACHE_SIZE:
+            self.tasks.popitem(last=False)
+        return task
+
+    @staticmethod
+    def log_failure(task: asyncio.Task):
+        """
+        Logs the error of a failed task. Prefetched recipes that are never opened are not awaited, so their errors
+        would otherwise be lost.
+        :param task:
+        :return: None
+        """
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning("Recipe request failed: %s", task.exception())
+
+    async def suggest(self, ingredients: list):
+        """
+        Returns up to RECIPE_OPTIONS dish names for the ingredients, best match first, and starts requesting the
+        recipes of the first RECIPE_PREFETCH of them.
+        :param ingredients:
+        :return: list[str]
+        """
+        key = self.ingredients_key(ingredients)
+        prompt = RECIPE_OPTIONS_PROMPT.format(count=RECIPE_OPTIONS, ingredients=", ".join(key))
+        messages = ContextBuilder().build(INSTRUCTIONS, [], prompt)
+        text = await self.memoized((key, None), lambda: self.request(messages, "openai.recipes"))
+        titles = self.parse_titles(text)
+        for title in titles[:RECIPE_PREFETCH]:
+            self.memoized((key, title), lambda title_=title: self.fetch_recipe(key, title_))
+        return titles
+
+    async def recipe(self, ingredients: list, title: str):
+        """
+        Returns the recipe of a suggested dish.
+        :param ingredients:
+        :param title:
+        :return: str
+        """
+        key = self.ingredients_key(ingredients)
+        return await self.memoized((key, title), lambda: self.fetch_recipe(key, title))
+
+    async def fetch_recipe(self, key: tuple, title: str):
+        prompt = RECIPE_DETAIL_PROMPT.format(title=title, ingredients=", ".join(key))
+        async with self.slots:
+            return await self.request(ContextBuilder().build(INSTRUCTIONS, [], prompt), "openai.recipe")
+
+
+class ContextBuilder:
+    """
+    Builds the messages of a completion request for one chat. The newest prompt and answer pairs are included until
+    CONTEXT_TOKEN_BUDGET is used up, and turns summarized earlier are sent as one system message. Token counts of
+    the pairs and the history messages are kept between turns, so each turn only counts and adds the new pair.
+    """
+    encoding = None
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET):
+        self.budget = budget
+        self.pair_tokens = []
+        self.last_pair = None
+        self.history = []
+        self.window = (0, 0)
+        self.summary = ""
+        self.summary_tokens = 0
+        self.summarized = 0
+
+    @classmethod
+    def count_tokens(cls, text: str):
+        """
+        Returns the token count of a message with the given content, including the per message overhead.
+        :param text:
+        :return: int
+        """
+        if tiktoken is None:
+            return len(text) // 4 + 5
+        if cls.encoding is None:
+            cls.encoding = tiktoken.encoding_for_model(MODEL)
+        return len(cls.encoding.encode(text)) + 4
+
+    def update_counts(self, pairs: list, end: int):
+        """
+        Counts the tokens of pairs added since the last call. A history that was replaced is counted again.
+        :param pairs:
+        :param end: Number of pairs to count
+        :return: None
+        """
+        counted = len(self.pair_tokens)
+        if counted > end or (counted and pairs[counted - 1] != self.last_pair):
+            self.pair_tokens = []
+            self.history = []
+            self.window = (0, 0)
+            self.summary = ""
+            self.summary_tokens = 0
+            self.summarized = 0
+            counted = 0
+
+        for question, answer in pairs[counted:end]:
+            self.pair_tokens.append(self.count_tokens(question) + self.count_tokens(answer))
+        if end:
+            self.last_pair = pairs[end - 1]
+
+    def build(self, instructions: str, pairs: list, new_question: str, end=None):
+        """
+        Returns the messages for the new question, with as much history as fits the token budget.
+        :param instructions:
+        :param pairs: Prompt and answer pairs of the chat, oldest first
+        :param new_question:
+        :param end: Number of pairs the question was asked after, all pairs if None
+        :return: list[dict]
+        """
+        end = len(pairs) if end is None else end
+        self.update_counts(pairs, end)
+        available = self.budget - self.count_tokens(instructions) - self.count_tokens(new_question) - 3
+        if self.summary:
+            available -= self.summary_tokens
+
+        start = end
+        while start > self.summarized and self.pair_tokens[start - 1] <= available:
+            start -= 1
+            available -= self.pair_tokens[start]
+
+        self.update_history(pairs, start, end)
+        messages = [{"role": "system", "content": instructions}]
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+        return messages + self.history + [{"role": "user", "content": new_question}]
+
+    def update_history(self, pairs: list, start: int, end: int):
+        """
+        Moves the history messages to pairs[start:end], dropping and adding only the pairs that changed.
+        :param pairs:
+        :param start:
+        :param end:
+        :return: None
+        """
+        old_start, old_end = self.window
+        if not old_start <= start <= old_end <= end:
+            self.history = []
+            old_start = old_end = start
+        del self.history[:2 * (start - old_start)]
+        for question, answer in pairs[old_end:end]:
+            self.history.append({"role": "user", "content": question})
+            self.history.append({"role": "assistant", "content": answer})
+        self.window = (start, end)
+
+    def pending_summary(self):
+        """
+        Returns the range of pairs that dropped out of the context and are not summarized yet, if there are enough
+        of them to summarize.
+        :return: Optional[tuple[int, int]]
+        """
+        start = self.window[0]
+        if start - self.summarized < CONTEXT_SUMMARY_BATCH:
+            return None
+        return self.summarized, start
+
+    def set_summary(self, summary: str, summarized: int):
+        """
+        Replaces the summary, which now covers the pairs before the given index.
+        :param summary:
+        :param summarized:
+        :return: None
+        """
+        self.summary = summary
+        self.summary_tokens = self.count_tokens(summary) + 8
+        self.summarized = summarized
+
+
+class AuthSession:
+    """
+    Result of a login: the signed-in user, their account record and the prefetched chat versions. The ID token is
+    verified once and reused until it expires.
+    """
+    __slots__ = ("email", "username", "user", "expires_at", "chat_versions")
+
+    def __init__(self, user: dict, username: str, expires_at: float, chat_versions=None):
+        self.email = user["email"]
+        self.username = username
+        self.user = user
+        self.expires_at = expires_at
+        self.chat_versions = chat_versions
+
+    def stored(self):
+        """
+        Returns the fields kept in settings.json to log in again on the next start.
+        :return: dict
+        """
+        return {
+            "email": self.email,
+            "refresh_token": self.user["refreshToken"],
+            "id_token": self.user["idToken"],
+            "expires_at": self.expires_at,
+        }
+
+
+class ChatSession:
+    """
+    One chat of the navigation drawer: its list item, chat layout and prompt and answer pairs. Pairs are only
+    appended to, so a message in flight keeps a valid view of the history by remembering its length. A stored chat
+    is opened with its newest page of pairs, starting at first_pair; older pages loaded by scrolling up are only
+    rendered and kept in older_pairs. Prompts of a chat are sent one at a time, the ones sent while a reply is
+    generated wait in its queue. Writes of the chat count in saves until the database confirms them.
+    """
+    __slots__ = ("chat_id", "list_item", "chat_layout", "pairs", "first_pair", "older_pairs", "history_loading",
+                 "chat_key", "loaded", "rendered_pairs", "context", "in_flight", "queue", "reply", "renderer", "saves",
+                 "saved_at")
+
+    def __init__(self, chat_id: int, list_item, chat_layout):
+        self.chat_id = chat_id
+        self.list_item = list_item
+        self.chat_layout = chat_layout
+        self.pairs = []
+        self.first_pair = 1
+        self.older_pairs = []
+        self.history_loading = False
+        self.chat_key = None
+        self.loaded = True
+        self.rendered_pairs = 0
+        self.context = ContextBuilder()
+        self.in_flight = None
+        self.queue = collections.deque()
+        self.reply = None
+        self.renderer = None
+        self.saves = 0
+        self.saved_at = 0
+
+    @property
+    def pair_count(self):
+        """
+        Number of pairs in the chat, including the ones that are not loaded.
+        :return: int
+        """
+        return self.first_pair - 1 + len(self.pairs)
+
+    @property
+    def history_start(self):
+        """
+        Index of the oldest loaded pair.
+        :return: int
+        """
+        return self.first_pair - len(self.older_pairs)
+
+
+class MessageModel:
+    """
+    A message parsed once into typed segments: paragraphs, list items and code blocks. The label markup of a bubble
+    is rendered from it in two parts, the head shown before "Read more" and the tail, so expanding a bubble only
+    renders the tail. List items are [ref] tap targets named after their segment index. Models are cached per text,
+    except for answers that are still streamed, which only keep their latest model.
+    """
+    ordered_item = re.compile(r"(\d+)[.)]\s+(.*)")
+    bullet_item = re.compile(r"[-*•]\s+(.*)")
+    bold = re.compile(r"\*\*(.+?)\*\*")
+    cache = collections.OrderedDict()
+    streamed = None
+
+    def __init__(self, text: str):
+        self.text = text
+        self.segments = self.parse(text)
+        self.head, self.tail = self.render(READ_MORE_LIMIT)
+
+    @classmethod
+    def get(cls, text: str, streaming: bool = False):
+        """
+        Returns the cached model of the text, parsing it on first use.
+        :param text:
+        :param streaming: Whether the text is a partial answer, which is not added to the cache
+        :return: MessageModel
+        """
+        model = cls.cache.get(text)
+        if model is None and streaming:
+            if cls.streamed is None or cls.streamed.text != text:
+                cls.streamed = cls(text)
+            return cls.streamed
+        if model is None:
+            model = cls.cache[text] = cls(text)
+            if len(cls.cache) > MESSAGE_MODEL_CACHE_SIZE:
+                cls.cache.popitem(last=False)
+        else:
+            cls.cache.move_to_end(text)
+        return model
+
+    @classmethod
+    def parse(cls, text: str):
+        """
+        Splits the text into ("paragraph", text, None), ("item", text, number) and ("code", text, None) segments.
+        Bullet items have no number. Indented lines continue the item above them, and an unterminated code block
+        runs to the end, as while an answer is streamed.
+        :param text:
+        :return: list[tuple[str, str, Optional[int]]]
+        """
+        segments = []
+        code = None
+        joinable = False
+        for line in text.splitlines():
+            stripped = line.strip()
+            if stripped.startswith("```"):
+                if code is None:
+                    code = []
+                else:
+                    segments.append(["code", "\n".join(code), None])
+                    code = None
+                joinable = False
+            elif code is not None:
+                code.append(line)
+            elif not stripped:
+                joinable = False
+            elif cls.ordered_item.match(stripped):
+                number, item = cls.ordered_item.match(stripped).groups()
+                segments.append(["item", item, int(number)])
+                joinable = True
+            elif cls.bullet_item.match(stripped):
+                segments.append(["item", cls.bullet_item.match(stripped).group(1), None])
+                joinable = True
+            elif joinable and (segments[-1][0] == "paragraph" or line[:1].isspace()):
+                segments[-1][1] += "\n" + stripped
+            else:
+                segments.append(["paragraph", stripped, None])
+                joinable = True
+        if code is not None:
+            segments.append(["code", "\n".join(code), None])
+        return [tuple(segment) for segment in segments]
+
+    def render(self, limit: int):
+        """
+        Renders the markup of the segments that fit in limit characters and of the rest. A first segment longer
+        than the limit is split at a word boundary.
+        :param limit:
+        :return: tuple[str, str]: head and tail markup
+        """
+        head, tail = [], []
+        parts = head
+        length = 0
+        for index, (kind, text, number) in enumerate(self.segments):
+            prefix = "" if kind != "item" else "\u2022 " if number is None else f"{number}. "
+            if parts is head and length + len(text) > limit:
+                if not head:
+                    cut = text.rfind(" ", 0, limit)
+                    cut = cut if cut > 0 else limit
+                    head.append((index, kind, prefix, text[:cut]))
+                    prefix, text = "", text[cut:].lstrip()
+                parts = tail
+            if text:
+                parts.append((index, kind, prefix, text))
+            length += len(text)
+        return self.markup(head), self.markup(tail)
+
+    @classmethod
+    def markup(cls, parts: list):
+        """
+        Returns the label markup of (segment index, kind, prefix, text) parts.
+        :param parts:
+        :return: str
+        """
+        chunks = []
+        for position, (index, kind, prefix, text) in enumerate(parts):
+            if position:
+                chunks.append("\n" if kind == "item" and parts[position - 1][1] == "item" else "\n\n")
+            text = escape_markup(text)
+            if kind == "code":
+                chunks.append(f"[font=RobotoMono-Regular]{text}[/font]")
+                continue
+            text = cls.bold.sub(r"[b]\1[/b]", text)
+            if kind == "item":
+                chunks.append(f"[ref={index}]{prefix}{text}[/ref]")
+            else:
+                chunks.append(text)
+        return "".join(chunks)
+
+
+class Palette(EventDispatcher):
+    """
+    Colors of the app's own widgets for the current theme style. kv rules bind to these instead of each comparing
+    the theme style, so a theme switch sets every color once.
+    """
+    text_color = kvprops.ColorProperty([0, 0, 0, 1])
+    surface_color = kvprops.ColorProperty([1, 1, 1, 1])
+    field_color = kvprops.ColorProperty([224 / 255, 224 / 255, 224 / 255, 1])
+    field_focus_color = kvprops.ColorProperty([245 / 255, 245 / 255, 245 / 255, 1])
+    bubble_color = kvprops.ColorProperty([0, 0, 0, 0.1])
+    styles = {
+        "Light": {
+            "text_color": [0, 0, 0, 1],
+            "surface_color": [1, 1, 1, 1],
+            "field_color": [224 / 255, 224 / 255, 224 / 255, 1],
+            "field_focus_color": [245 / 255, 245 / 255, 245 / 255, 1],
+            "bubble_color": [0, 0, 0, 0.1],
+        },
+        "Dark": {
+            "text_color": [1, 1, 1, 1],
+            "surface_color": [18 / 255, 18 / 255, 18 / 255, 1],
+            "field_color": [0, 0, 0, 1],
+            "field_focus_color": [31 / 255, 31 / 255, 31 / 255, 1],
+            "bubble_color": [1, 1, 1, 0.1],
+        },
+    }
+
+    def apply(self, theme_style: str):
+        """
+        Switches the colors to the given theme style.
+        :param theme_style: "Light" or "Dark"
+        :return: None
+        """
+        for name, color in self.styles[theme_style].items():
+            setattr(self, name, color)
+
+
+class BubbleLabel(MDLabel):
+    """
+    Label of a chat bubble that reuses rendered texts. The text is rendered in white and tinted with the label color
+    when drawn, so textures are kept per (text, width, font) and theme switches, recycled bubbles and expanding an
+    answer again do not render the text again. Answers that are still streamed are rendered without the cache.
+    """
+    textures = collections.OrderedDict()
+    texture_pixels = 0
+    use_cache = True
+
+    @classmethod
+    def clear_textures(cls, *args):
+        """
+        Drops the cached textures, their content is lost with the OpenGL context.
+        :return: None
+        """
+        cls.textures.clear()
+        BubbleLabel.texture_pixels = 0
+
+    @staticmethod
+    def forget_texture(texture):
+        """
+        Removes a texture that left the cache from the cached pixels.
+        :param texture:
+        :return: None
+        """
+        BubbleLabel.texture_pixels -= texture.width * texture.height
+
+    def texture_key(self):
+        """
+        Returns the cache key of the current text layout.
+        :return: tuple
+        """
+        width = self.text_size[0]
+        return hash(self.text), int(width) if width else None, self.font_name, self.font_size, self.halign, self.markup
+
+    def texture_update(self, *largs):
+        if not self.text:
+            return super().texture_update(*largs)
+
+        key = self.texture_key()
+        cached = self.textures.get(key) if self.use_cache else None
+        if cached is not None and cached[0] == self.text:
+            self.textures.move_to_end(key)
+            self.texture, self.refs, self.anchors = cached[1:]
+            self.texture_size = list(self.texture.size)
+            return
+
+        label = self._label
+        label.text = self.text
+        label.options["color"] = (1, 1, 1, 1)
+        label.refresh()
+        texture = label.texture
+        if texture is None:
+            return
+
+        # The core label fills its texture lazily and reuses it for the next text of the same size
+        texture.bind()
+        self.refs, self.anchors = (label.refs, label.anchors) if self.markup else ({}, {})
+        self.texture = texture
+        self.texture_size = list(texture.size)
+        if not self.use_cache:
+            return
+        label.texture = None
+
+        if cached is not None:
+            self.forget_texture(self.textures.pop(key)[1])
+        self.textures[key] = (self.text, texture, self.refs, self.anchors)
+        BubbleLabel.texture_pixels += texture.width * texture.height
+        while BubbleLabel.texture_pixels > BUBBLE_TEXTURE_CACHE_PIXELS and len(self.textures) > 1:
+            self.forget_texture(self.textures.popitem(last=False)[1][1])
+
+
+class ChatBubble(RecycleDataViewBehavior, MDBoxLayout):
+    """
+    Recycled view of one chat message. It is filled from a (role, text, expanded, streaming) record of the
+    ChatLayout data list, so only the visible bubbles exist as widgets. Answers are rendered from their MessageModel,
+    the part after "Read more" in a second label.
+    """
+    halign = kvprops.StringProperty("left")
+    btype = kvprops.StringProperty("r")
+    full_text = kvprops.StringProperty()
+    truncated = kvprops.BooleanProperty(False)
+    expanded = kvprops.BooleanProperty(False)
+    streaming = False
+    index = None
+    chat_view = None
+    display = None
+    height_cache = collections.OrderedDict()
+
+    @staticmethod
+    def display_text(role: str, text: str, expanded: bool, streaming: bool = False):
+        """
+        Returns the markup shown in the two bubble labels. The tail of long answers is empty until expanded.
+        :param role:
+        :param text:
+        :param expanded:
+        :param streaming: Whether the answer is still streamed
+        :return: tuple[str, str]
+        """
+        if not text:
+            return "...", ""
+        if role == "user":
+            return escape_markup(text), ""
+        model = MessageModel.get(text, streaming)
+        return model.head, model.tail if expanded else ""
+
+    @staticmethod
+    def label_width(role: str, width: float):
+        """
+        Returns the width the label gets in a bubble of the given width. Assistant bubbles share it with the copy
+        and read more column.
+        :param role:
+        :param width:
+        :return: float
+        """
+        if role == "user":
+            return width - dp(20)
+        return (width - dp(10)) / 1.35
+
+    @classmethod
+    def cached_height(cls, role: str, display: tuple, width: float):
+        """
+        Returns the measured height of a bubble showing the display_text at the given width, if known.
+        :param role:
+        :param display:
+        :param width:
+        :return: Optional[float]
+        """
+        key = (display, int(cls.label_width(role, width)))
+        height = cls.height_cache.get(key)
+        if height is not None:
+            cls.height_cache.move_to_end(key)
+        return height
+
+    def refresh_view_attrs(self, rv, index, data):
+        self.index = index
+        self.chat_view = rv
+        self.btype = "m" if data["role"] == "user" else "r"
+        self.halign = "right" if self.btype == "m" else "left"
+        self.full_text = data["text"]
+        self.expanded = data.get("expanded", False)
+        self.streaming = data.get("streaming", False)
+        self.ids.chat_bubble_text.use_cache = self.ids.chat_bubble_more.use_cache = not self.streaming
+        self.display = self.display_text(data["role"], data["text"], self.expanded, self.streaming)
+        self.truncated = data["role"] == "assistant" and not self.expanded \
+            and bool(MessageModel.get(data["text"], self.streaming).tail)
+        self.ids.chat_bubble_text.text, self.ids.chat_bubble_more.text = self.display
+
+    def on_label_measured(self):
+        """
+        Caches the height of the bubble for its text and width, and stores it in the record so the layout does not
+        need to measure it again. Heights of answers that are still streamed are not cached.
+        :return: None
+        """
+        label, more = self.ids.chat_bubble_text, self.ids.chat_bubble_more
+        if self.chat_view is None or self.index is None or self.index >= len(self.chat_view.data):
+            return
+
+        # A recycled view is measured again once its layout follows the new role, stale widths are not cached
+        role = self.chat_view.data[self.index]["role"]
+        label_width = self.label_width(role, self.width)
+        if abs(label.width - label_width) >= 1 or (more.text and abs(more.width - label_width) >= 1):
+            return
+
+        height = label.texture_size[1] + more.texture_size[1] + dp(20)
+        if not self.streaming:
+            self.height_cache[(self.display, int(label_width))] = height
+            if len(self.height_cache) > BUBBLE_HEIGHT_CACHE_SIZE:
+                self.height_cache.popitem(last=False)
+        record = self.chat_view.data[self.index]
+        if record.get("height") != height:
+            self.chat_view.data[self.index] = dict(record, height=height)
+
+
+class StreamRenderer:
+    """
+    Collects streamed deltas on the worker thread and flushes them into a chat bubble on the main thread, at most
+    once per STREAM_FRAME_BUDGET, so the label texture is not re-rendered for every token. Nothing is shown until
+    the prompt has passed moderation.
+    """
+
+    def __init__(self, chat_layout, message_id: int):
+        self.chat_layout = chat_layout
+        self.message_id = message_id
+        self.text = ""
+        self.chunks = []
+        self.lock = threading.Lock()
+        self.released = threading.Event()
+        self.started_at = time.perf_counter()
+        self.first_render = None
+        self.event = Clock.schedule_interval(self.flush, STREAM_FRAME_BUDGET)
+
+    def feed(self, delta: str):
+        """
+        Queues a delta. Safe to call from any thread.
+        :param delta:
+        :return: None
+        """
+        with self.lock:
+            self.chunks.append(delta)
+
+    def release(self):
+        """
+        Allows queued deltas to be rendered. Safe to call from any thread.
+        :return: None
+        """
+        self.released.set()
+
+    def flush(self, *args):
+        """
+        Renders queued deltas into the bubble.
+        :return: None
+        """
+        if not self.released.is_set():
+            return
+        with self.lock:
+            if not self.chunks:
+                return
+            self.text += "".join(self.chunks)
+            self.chunks.clear()
+
+        self.chat_layout.update_message(self.message_id, text=self.text, streaming=True)
+        if self.first_render is None:
+            self.first_render = time.perf_counter() - self.started_at
+            logging.info("Time to first render: %.3fs", self.first_render)
+
+    def finish(self):
+        """
+        Stops the periodic flush and renders whatever is left.
+        :return: None
+        """
+        self.event.cancel()
+        self.flush()
+
+
+class ChatLayout(MDBoxLayout):
+    """
+    A chat session. Messages are kept as plain records in the data list of a RecycleView.
+    """
+    chat_id = kvprops.NumericProperty()
+    message_ids = itertools.count()
+
+    def make_record(self, role: str, text: str, expanded: bool = False):
+        """
+        Creates the data record of a message.
+        :param role: "user" or "assistant"
+        :param text:
+        :param expanded:
+        :return: dict
+        """
+        record = {"uid": next(self.message_ids), "role": role, "text": text, "expanded": expanded}
+        if role == "user":
+            record["pos_hint"] = {"right": 1}
+
+        height = ChatBubble.cached_height(
+            role, ChatBubble.display_text(role, text, expanded), self.bubble_width()
+        )
+        if height is not None:
+            record["height"] = height
+        return record
+
+    def bubble_width(self):
+        """
+        Returns the width the layout gives to a chat bubble.
+        :return: float
+        """
+        layout = self.ids.chat_view.layout_manager
+        padding_left, _, padding_right, _ = layout.padding
+        return (layout.width - padding_left - padding_right) * layout.default_size_hint_x
+
+    def add_message(self, role: str, text: str):
+        """
+        Appends a message to the chat.
+        :param role:
+        :param text:
+        :return: int: id of the message
+        """
+        record = self.make_record(role, text)
+        self.ids.chat_view.data.append(record)
+        return record["uid"]
 
-cred = credentials.Certificate(GOOGLE_APPLICATION_CREDENTIALS)
-firebase_admin.initialize_app(cred)
+    def find_message(self, message_id: int):
+        """
+        Returns the index of the message in the data list, or None if it was removed.
+        :param message_id:
+        :return: Optional[int]
+        """
+        data = self.ids.chat_view.data
+        for index in range(len(data) - 1, -1, -1):
+            if data[index]["uid"] == message_id:
+                return index
+        return None
 
-firebase = pyrebase.initialize_app(config)
-auth_firebase = firebase.auth()
-db = firebase.database()
+    def update_message(self, message_id: int, **changes):
+        """
+        Replaces fields of a message record, refreshing only that record.
+        :param message_id:
+        :param changes:
+        :return: None
+        """
+        index = self.find_message(message_id)
+        if index is None:
+            return
+        data = self.ids.chat_view.data
+        record = dict(data[index], **changes)
+        if not record.get("streaming"):
+            height = ChatBubble.cached_height(
+                record["role"], ChatBubble.display_text(record["role"], record["text"], record["expanded"]),
+                self.bubble_width(),
+            )
+            if height is not None:
+                record["height"] = height
+        if record != data[index]:
+            data[index] = record
 
+    def remove_message(self, message_id: int):
+        """
+        Removes a message from the chat.
+        :param message_id:
+        :return: None
+        """
+        index = self.find_message(message_id)
+        if index is not None:
+            self.ids.chat_view.data.pop(index)
 
-class ChatBubble(MDBoxLayout):
-    halign = kvprops.StringProperty()
-    btype = kvprops.StringProperty()
-    full_text = kvprops.StringProperty()
+    def prepend_messages(self, records: list):
+        """
+        Adds older messages at the top, keeping the visible messages in place.
+        :param records:
+        :return: None
+        """
+        chat_view = self.ids.chat_view
+        layout = chat_view.layout_manager
+        from_bottom = chat_view.scroll_y * max(layout.height - chat_view.height, 0)
+        had_messages = bool(chat_view.data)
 
+        chat_view.data = records + list(chat_view.data)
+        chat_view.refresh_views()
 
-class ChatLayout(MDBoxLayout):
-    chat_id = kvprops.NumericProperty()
+        scrollable = max(layout.height - chat_view.height, 0)
+        if had_messages and scrollable:
+            chat_view.scroll_y = min(1.0, from_bottom / scrollable)
+        else:
+            chat_view.scroll_y = 0
+
+    def clear_messages(self):
+        """
+        Removes every message from the chat.
+        :return: None
+        """
+        self.ids.chat_view.data = []
+
+    def scroll_to_bottom(self):
+        """
+        Scrolls to the newest message once the layout is updated.
+        :return: None
+        """
+        Clock.schedule_once(lambda dt: setattr(self.ids.chat_view, "scroll_y", 0))
 
 
 # TODO: Chat bubble tıklababilir bir obje olmalı, daha sonra yemek tarifi istenicek, elindeki malzemeler belirlenip,
@@ -88,14 +2249,14 @@ class MainApp(MDApp):
         self.email_verified = None
         self.menu_items = None
         self.menu = None
+        self.palette = Palette()
         self.settings_screen = None
         self.delete_confirmation = None
+        self.delete_confirmation_event = None
         self.dialog_btn_2 = None
         self.logged_out = False
-        self.read_more_button = None
-        self.cb_box = None
         self.camera_screen = None
-        self.cb_label = None
+        self.capture_pending = False
         self.login_check = None
         self.send_layout = None
         self.chat_layout = None
@@ -104,32 +2265,63 @@ class MainApp(MDApp):
         self.signup_screen = None
         self.login_screen = None
         self.sm = None
-        self.prev_q_a = []
         self.dialog = None
         self.dialog_btn = None
-        self.cb_parent = None
         self.user = None
-        self.chat_bubbles = []
-        self.response = ""
+        self.username = None
         self.chat_count = 0
         self.title = ""
-        self.chat_layouts = []
-        self.chat_sessions = []
+        self.session = None
+        self.sessions = {}
+        self.sessions_by_item = {}
+        self.sessions_by_key = {}
+        self.cache_email = None
+        self.cache_shown = False
+        self.auth_session = None
+        self.login_pending = False
+        self.login_retry_event = None
+        self.signup_pending = False
+        self.chat_stream = None
+        self.chat_write_lock = asyncio.Lock()
+        self.prompt_slots = asyncio.Semaphore(MAX_CONCURRENT_PROMPTS)
+        self.recipe_book = RecipeBook(self.cached_response)
+        self.recipe_dialog = None
+        self.request_counts = collections.Counter()
+        self.request_counts_lock = threading.Lock()
         self.store = JsonStore('settings.json')
+        self.started_at = time.perf_counter()
+        self.kv_timings = {}
+        self.built_screens = set()
+        self.screen_loaders = {
+            "login": self.load_login_screen,
+            "signup": self.load_signup_screen,
+            "home": self.load_home_screen,
+            "camera": self.load_camera_screen,
+            "settings": self.load_settings_screen,
+        }
+        self.metrics_sink = None
+        self.metrics_overlay_event = None
+        self.worker = AsyncWorker()
+        self.chat_cache = ChatCache(CHAT_CACHE_PATH)
+        self.completion_cache = None
+        self.moderation_cache = None
+        if RESPONSE_CACHE_ENABLED:
+            self.completion_cache = ResponseCache(
+                "completions", RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH, RESPONSE_CACHE_DISK_SIZE
+            )
+            self.moderation_cache = ResponseCache(
+                "moderations", RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH, RESPONSE_CACHE_DISK_SIZE
+            )
         self.menu_items = [
             {
                 "text": "Light",
-                "viewclass": "OneLineListItem",
+                "viewclass": "MenuListItem",
                 "on_release": lambda x="Light": self.menu_callback(x),
-                "theme_text_color": "Custom",
-                "text_color": "black",
             },
             {
                 "text": "Dark",
-                "viewclass": "OneLineListItem",
+                "viewclass": "MenuListItem",
                 "on_release": lambda x="Dark": self.menu_callback(x),
-                "theme_text_color": "Custom",
-                "text_color": "black"
             }
         ]
 
@@ -143,31 +2335,70 @@ class MainApp(MDApp):
         self.theme_cls.primary_hue = "800"
         self.theme_cls.material_style = "M3"
 
-        if self.theme_cls.theme_style == "Dark":
-            self.menu_items = [item.update({"text_color": "white"}) or item for item in self.menu_items]
-        else:
-            self.menu_items = [item.update({"text_color": "black"}) or item for item in self.menu_items]
+        self.palette.apply(self.theme_cls.theme_style)
+        self.theme_cls.bind(theme_style=lambda theme_cls, theme_style: self.palette.apply(theme_style))
+
+        self.sm = MDScreenManager()
+        self.load_kv_file("uix/widgets/custom_widgets.kv")
+        self.ensure_screen("login")
+        self.sm.current = "login"
+        return self.sm
+
+    def load_kv_file(self, path: str):
+        """
+        Loads a kv file and records how long it took for the startup report.
+        :param path:
+        :return: Any: root widget of the file
+        """
+        started_at = time.perf_counter()
+        root = Builder.load_file(path)
+        self.kv_timings[path] = time.perf_counter() - started_at
+        return root
+
+    def ensure_screen(self, screen_name: str):
+        """
+        Builds a screen the first time it is needed. Every screen is built once.
+        :param screen_name:
+        :return: None
+        """
+        if screen_name not in self.built_screens:
+            self.built_screens.add(screen_name)
+            self.screen_loaders[screen_name]()
+
+    def preload_screens(self, *args):
+        """
+        Builds the next screen of PRELOADED_SCREENS that is not built yet, one per frame.
+        :return: None
+        """
+        for screen_name in PRELOADED_SCREENS:
+            if screen_name not in self.built_screens:
+                self.ensure_screen(screen_name)
+                Clock.schedule_once(self.preload_screens, 0)
+                return
 
-        return self.load_login_screen()
+    def report_startup(self, *args):
+        """
+        Logs the time to the first frame and the time spent loading each kv file.
+        :return: None
+        """
+        logging.info("Startup: first frame after %.3fs", time.perf_counter() - self.started_at)
+        for path, seconds in self.kv_timings.items():
+            logging.info("Startup: %s loaded in %.1fms", path, seconds * 1000)
 
     def load_login_screen(self):
         """
         Loads login screen.
-        :return: MDScreenManager
+        :return: None
         """
-        Builder.load_file("uix/widgets/custom_widgets.kv")
-        self.login_screen = Builder.load_file("uix/screens/login_screen.kv")
-        self.sm = MDScreenManager()
+        self.login_screen = self.load_kv_file("uix/screens/login_screen.kv")
         self.sm.add_widget(self.login_screen)
-        self.sm.current = "login"
-        return self.sm
 
     def load_signup_screen(self):
         """
         Loads sign up screen.
         :return: None
         """
-        self.signup_screen = Builder.load_file("uix/screens/signup_screen.kv")
+        self.signup_screen = self.load_kv_file("uix/screens/signup_screen.kv")
         self.sm.add_widget(self.signup_screen)
 
     def load_home_screen(self):
@@ -175,41 +2406,32 @@ class MainApp(MDApp):
         Loads home screen.
         :return: None
         """
-        self.home_screen = Builder.load_file("uix/screens/home_screen.kv")
-        self.nav_drawer = Builder.load_file("uix/widgets/nav_drawer.kv")
-        self.chat_layout = Builder.load_file("uix/widgets/chat_layout.kv")
-        self.send_layout = Builder.load_file("uix/widgets/send_layout.kv")
+        self.home_screen = self.load_kv_file("uix/screens/home_screen.kv")
+        self.nav_drawer = self.load_kv_file("uix/widgets/nav_drawer.kv")
+        self.chat_layout = self.load_kv_file("uix/widgets/chat_layout.kv")
+        self.send_layout = self.load_kv_file("uix/widgets/send_layout.kv")
 
         self.home_screen.add_widget(self.nav_drawer, index=0)
         self.home_screen.add_widget(self.chat_layout, index=2)
         self.home_screen.add_widget(self.send_layout, index=1)
         self.sm.add_widget(self.home_screen)
+        self.session = self.register_session(0, self.nav_drawer.ids.item_0, self.chat_layout)
 
     def load_camera_screen(self):
         """
         Loads camera screen.
         :return: None
         """
-        self.camera_screen = Builder.load_file("uix/screens/camera_screen.kv")
+        self.camera_screen = self.load_kv_file("uix/screens/camera_screen.kv")
         self.sm.add_widget(self.camera_screen)
 
     def load_settings_screen(self):
-
-        if self.settings_screen is None:
-            self.settings_screen = Builder.load_file("uix/screens/settings_screen.kv")
-            self.sm.add_widget(self.settings_screen)
-            self.settings_screen.ids.settings_email.text += self.user["email"]
-            username = db.child("users").child(self.replace_str(self.user["email"], "to_db")) \
-                .child("username").get().val()
-            self.settings_screen.ids.settings_username.text += username
-        else:
-            self.settings_screen.ids.settings_email.text = "Email: "
-            self.settings_screen.ids.settings_username.text = "Username: "
-            self.settings_screen.ids.settings_email.text += self.user["email"]
-            username = db.child("users").child(self.replace_str(self.user["email"], "to_db")) \
-                .child("username").get().val()
-            self.settings_screen.ids.settings_username.text += username
-
+        """
+        Loads settings screen and its theme menu.
+        :return: None
+        """
+        self.settings_screen = self.load_kv_file("uix/screens/settings_screen.kv")
+        self.sm.add_widget(self.settings_screen)
         self.menu = MDDropdownMenu(
             caller=self.settings_screen.ids.dropdown_item,
             items=self.menu_items,
@@ -217,9 +2439,38 @@ class MainApp(MDApp):
             max_height=dp(112),
         )
 
+    def update_settings_screen(self):
+        """
+        Shows the account of the logged-in user on the settings screen.
+        :return: None
+        """
+        self.settings_screen.ids.settings_email.text = "Email: " + self.user["email"]
+        self.settings_screen.ids.settings_username.text = "Username: " + (self.username or "")
+        if self.username is None:
+            db_email = self.replace_str(self.user["email"], "to_db")
+            self.worker.submit(
+                asyncio.to_thread(self.fetch_user_record, db_email),
+                on_success=self.on_user_record_loaded,
+                on_error=lambda error: logging.warning("Username could not be loaded: %s", error),
+            )
+
         self.nav_drawer.ids.nav_drawer.set_state("closed")
 
+    def on_user_record_loaded(self, record: dict):
+        """
+        Shows the username of the account record on the settings screen.
+        :param record:
+        :return: None
+        """
+        if record is None or self.user is None or record.get("email") != self.user["email"]:
+            return
+        self.username = record.get("username")
+        self.settings_screen.ids.settings_username.text = "Username: " + (self.username or "")
+
     def menu_callback(self, text_item):
+        # Measured up to the next frame, which has drawn the screen in the new colors
+        started_at = time.perf_counter()
+        Clock.schedule_once(lambda dt: metrics.record("ui.theme_switch", time.perf_counter() - started_at))
         self.theme_cls.theme_style_switch_animation = True
         self.theme_cls.theme_style_switch_animation_duration = 0.4
 
@@ -227,36 +2478,259 @@ class MainApp(MDApp):
             self.theme_cls.theme_style = "Dark"
             self.settings_screen.ids.dropdown_item.text = "Dark"
             self.theme_cls.theme_style_switch_animation_duration = 0
-            self.menu_items = [item.update({"text_color": "white"}) or item for item in self.menu_items]
             self.store.put("theme", theme="Dark")
 
         else:
             self.theme_cls.theme_style = "Light"
             self.settings_screen.ids.dropdown_item.text = "Light"
             self.theme_cls.theme_style_switch_animation_duration = 0
-            self.menu_items = [item.update({"text_color": "black"}) or item for item in self.menu_items]
             self.store.put("theme", theme="Light")
 
         self.menu.dismiss()
 
     def on_start(self):
-        self.load_signup_screen()
-        self.load_home_screen()
-        self.chat_layouts.append(self.chat_layout)
+        Clock.schedule_once(self.report_startup, 0)
+        get_context().add_reload_observer(BubbleLabel.clear_textures)
+        Clock.schedule_interval(self.watch_frame, 0)
+        self.metrics_sink = self.create_metrics_sink()
+        if self.metrics_sink is not None:
+            Clock.schedule_interval(self.export_metrics, METRICS_EXPORT_INTERVAL)
+        if SCREEN_PRELOAD:
+            Clock.schedule_once(self.preload_screens, SCREEN_PRELOAD_DELAY)
+
         if "user" in self.store:
-            refresh_token = self.store["user"]["refresh_token"]
-            id_token = auth_firebase.refresh(refresh_token)["idToken"]
-            decoded_id_token = auth.verify_id_token(id_token)
-            login_email = decoded_id_token["email"]
-            login_password = db.child("users").child(self.replace_str(login_email, "to_db")).child("password") \
-                .get().val()
-            self.login_screen.ids.login_email.text = login_email
-            self.login_screen.ids.login_password.text = login_password
-            self.login(auto_login=True)
+            stored_user = self.store["user"]
+            if "email" in stored_user:
+                self.cache_email = self.replace_str(stored_user["email"], "to_db")
+                self.switch_screen("home")
+                self.show_cached_chats()
+
+        # The Clock has not ticked while the app was built, so the delay is counted from the first frame
+        Clock.schedule_once(lambda dt: Clock.schedule_once(self.start_services, SERVICES_START_DELAY))
+
+    def start_services(self, *args):
+        """
+        Loads Firebase and OpenAI on the worker once the first frame is drawn, then restores the stored session.
+        :return: None
+        """
+        self.login_retry_event = None
+        if self.login_check or self.login_pending or self.logged_out:
+            return
+
+        def load():
+            get_auth()
+            get_db()
+            get_openai()
+
+        if "user" not in self.store:
+            self.worker.submit(asyncio.to_thread(load), on_error=lambda error: logging.warning(
+                "Could not load services: %s", error))
+            return
+
+        self.login_pending = True
+        self.worker.submit(
+            self.restore_session(dict(self.store["user"])),
+            on_success=lambda auth_session: self.on_logged_in(auth_session, auto_login=True),
+            on_error=self.on_auto_login_failed,
+        )
+
+    async def restore_session(self, stored_user: dict):
+        """
+        Logs the stored user in again. The stored ID token is reused while it is valid, otherwise it is refreshed and
+        verified. The account record and the chat versions are read at the same time. Runs on the worker loop.
+        :param stored_user: Fields of AuthSession.stored
+        :return: AuthSession
+        """
+        async def token():
+            if stored_user.get("id_token") and \
+                    stored_user.get("expires_at", 0) - ID_TOKEN_EXPIRY_MARGIN > time.time():
+                user = {"email": stored_user["email"], "idToken": stored_user["id_token"],
+                        "refreshToken": stored_user["refresh_token"]}
+                return user, stored_user["expires_at"]
+
+            def refresh():
+                tokens = get_auth().refresh(stored_user["refresh_token"])
+                claims = get_admin_auth().verify_id_token(tokens["idToken"])
+                if not claims.get("email_verified"):
+                    raise Exception("Your email is not verified yet.")
+                user = {"email": claims["email"], "idToken": tokens["idToken"], "refreshToken": tokens["refreshToken"]}
+                return user, claims["exp"]
+
+            return await asyncio.to_thread(refresh)
+
+        async def account(email_: str):
+            db_email = self.replace_str(email_, "to_db")
+            return await asyncio.gather(
+                asyncio.to_thread(self.fetch_user_record, db_email),
+                self.fetch_chat_versions(db_email),
+            )
+
+        email = stored_user.get("email")
+        if email is None:  # Stored before the email was kept in settings.json
+            user, expires_at = await token()
+            email = user["email"]
+            record, chat_versions = await account(email)
+        else:
+            (user, expires_at), (record, chat_versions) = await asyncio.gather(token(), account(email))
+        if record is None or user["email"] != email:
+            raise Exception("Invalid email or password.")
+        return AuthSession(user, record["username"], expires_at, chat_versions)
+
+    async def authenticate(self, login_email: str, login_password: str):
+        """
+        Checks the credentials and signs in. The account record, the email verification, the sign in and the chat
+        versions are requested at the same time. Runs on the worker loop.
+        :param login_email:
+        :param login_password:
+        :return: AuthSession
+        """
+        def email_verified():
+            return get_admin_auth().get_user_by_email(login_email).email_verified
+
+        db_email = self.replace_str(login_email, "to_db")
+        record, verified, user, chat_versions = await asyncio.gather(
+            asyncio.to_thread(self.fetch_user_record, db_email),
+            asyncio.to_thread(email_verified),
+            asyncio.to_thread(get_auth().sign_in_with_email_and_password, login_email, login_password),
+            self.fetch_chat_versions(db_email),
+            return_exceptions=True,
+        )
+        if isinstance(record, Exception):
+            raise record
+        if record is None:
+            raise Exception("Invalid email or password.")
+        if isinstance(verified, Exception):
+            raise verified
+        if not verified:
+            raise Exception("Your email is not verified yet.")
+        if login_email != record["email"] or login_password != record["password"]:
+            raise Exception("Invalid email or password.")
+        if isinstance(user, Exception):
+            raise user
+        if isinstance(chat_versions, Exception):
+            logging.warning("Chat prefetch failed: %s", chat_versions)
+            chat_versions = None
+        return AuthSession(user, record["username"], time.time() + int(user["expiresIn"]), chat_versions)
+
+    @staticmethod
+    def fetch_user_record(db_email: str):
+        """
+        Reads the account record of the user. Safe to call from any thread.
+        :param db_email:
+        :return: Optional[dict]: email, password and username
+        """
+        return get_firebase().database().child("users").child(db_email).get().val()
+
+    def on_auto_login_failed(self, error: Exception):
+        """
+        Goes back to the login screen when the stored user can not be logged in. When the server could not be
+        reached the cached chats stay on screen and the login is tried again after AUTO_LOGIN_RETRY_DELAY.
+        :param error:
+        :return: None
+        """
+        self.login_pending = False
+        if self.logged_out:
+            return  # The user logged out while the stored session was restored
+        if self.cache_shown and is_network_error(error):
+            logging.warning("Could not log in, retrying in %gs: %s", AUTO_LOGIN_RETRY_DELAY, error)
+            self.login_retry_event = Clock.schedule_once(self.start_services, AUTO_LOGIN_RETRY_DELAY)
+            return
+        self.reset_chat_list()
+        self.switch_screen("login")
+        self.dialog_open("Error", f"{error}", "Retry")
+
+    def cancel_login_retry(self):
+        """
+        Cancels the pending login of the stored user, see on_auto_login_failed.
+        :return: None
+        """
+        if self.login_retry_event is not None:
+            self.login_retry_event.cancel()
+            self.login_retry_event = None
 
     def on_stop(self):
+        self.cancel_login_retry()
+        self.cancel_delete_confirmation()
+        self.stop_chat_stream()
+        if self.worker.loop.is_running():  # on_stop is dispatched again when the main loop ends
+            try:
+                self.worker.submit(close_http_session()).result(timeout=1)
+            except Exception as e:
+                logging.warning("Could not close the HTTP session: %s", e)
+        self.worker.stop()
+        if self.metrics_sink is not None:
+            self.export_metrics()
+        for cache in (self.completion_cache, self.moderation_cache):
+            if cache is not None:
+                logging.info("Response cache %s: %s", cache.name, cache.stats())
         return super().on_stop()
 
+    @staticmethod
+    def create_metrics_sink():
+        """
+        Creates the metrics sink selected by METRICS_SINK.
+        :return: Optional[LogMetricsSink | JsonMetricsSink | PrometheusMetricsSink]
+        """
+        sinks = {
+            "log": LogMetricsSink,
+            "json": lambda: JsonMetricsSink(METRICS_JSON_PATH),
+            "prometheus": lambda: PrometheusMetricsSink(METRICS_PROMETHEUS_PORT),
+        }
+        if METRICS_SINK is None:
+            return None
+        try:
+            return sinks[METRICS_SINK]()
+        except OSError as e:
+            logging.warning("Metrics sink %s is not available: %s", METRICS_SINK, e)
+            return None
+
+    def export_metrics(self, *args):
+        """
+        Exports the current metrics through the metrics sink.
+        :return: None
+        """
+        snapshot = metrics.snapshot()
+        if snapshot:
+            self.metrics_sink.export(snapshot)
+
+    @staticmethod
+    def watch_frame(dt: float):
+        """
+        Records frames that took longer than UI_STALL_THRESHOLD as UI thread stalls. Called every frame.
+        :param dt: Seconds since the previous frame
+        :return: None
+        """
+        if dt > UI_STALL_THRESHOLD:
+            metrics.record("ui.stall", dt)
+
+    def show_metrics_overlay(self, show: bool):
+        """
+        Starts or stops refreshing the metrics overlay of the settings screen.
+        :param show:
+        :return: None
+        """
+        overlay = self.settings_screen.ids.metrics_overlay
+        overlay.opacity = 1 if show else 0
+        if show and self.metrics_overlay_event is None:
+            self.update_metrics_overlay()
+            self.metrics_overlay_event = Clock.schedule_interval(self.update_metrics_overlay, 1)
+        elif not show and self.metrics_overlay_event is not None:
+            self.metrics_overlay_event.cancel()
+            self.metrics_overlay_event = None
+
+    def update_metrics_overlay(self, *args):
+        """
+        Shows the most frequent operations on the metrics overlay.
+        :return: None
+        """
+        snapshot = metrics.snapshot()
+        operations = sorted(snapshot.items(), key=lambda item: -item[1]["count"])[:8]
+        self.settings_screen.ids.metrics_overlay.text = "\n".join(
+            f"{name}: {operation['count']}x  p50 {operation['p50']:.0f} / p95 {operation['p95']:.0f} / "
+            f"p99 {operation['p99']:.0f} ms  {operation['bytes'] / 1024:.1f} kB"
+            for name, operation in operations
+        ) or "No backend calls yet"
+
     @staticmethod
     def clear_text(*fields):
         """
@@ -269,18 +2743,115 @@ class MainApp(MDApp):
 
     def switch_screen(self, screen_name: str):
         """
-        Switches to screen by given screen name.
+        Switches to screen by given screen name. Screens are built on first use.
         :param screen_name:
         :return: None
         """
-        if screen_name == "camera":
-            self.load_camera_screen()
+        self.ensure_screen(screen_name)
 
         if screen_name == "settings":
-            self.load_settings_screen()
+            self.update_settings_screen()
+
+        if METRICS_OVERLAY and self.settings_screen is not None:
+            self.show_metrics_overlay(screen_name == "settings")
+
+        if self.camera_screen is not None:
+            self.camera_screen.ids.camera.play = screen_name == "camera"
 
         self.sm.current = screen_name
 
+    def capture_ingredients(self):
+        """
+        Sends the current camera frame to ingredient recognition and asks for recipes with the recognized
+        ingredients in a new chat. Only reading the frame runs on the main thread, so the preview keeps running.
+        :return: None
+        """
+        if self.capture_pending:
+            return
+        texture = self.camera_screen.ids.camera.texture
+        if texture is None:
+            self.dialog_open("Camera", "The camera is not ready yet.", "OK")
+            return
+
+        self.capture_pending = True
+        self.worker.submit(
+            self.recognize_ingredients(texture.pixels, texture.size, texture.uvsize[1] > 0),
+            on_success=self.on_ingredients_recognized,
+            on_error=self.on_recognition_failed,
+        )
+
+    @staticmethod
+    async def recognize_ingredients(pixels: bytes, size: tuple, flip: bool):
+        """
+        Encodes the frame and recognizes the ingredients on it, both on worker threads. Runs on the worker loop.
+        :param pixels:
+        :param size:
+        :param flip:
+        :return: list[str]
+        """
+        photo = await asyncio.to_thread(encode_photo, pixels, size, flip)
+        return await asyncio.to_thread(get_recognizer().recognize, photo)
+
+    def on_ingredients_recognized(self, ingredients: list):
+        """
+        Opens a new chat and suggests recipes with the recognized ingredients.
+        :param ingredients:
+        :return: None
+        """
+        self.capture_pending = False
+        if not ingredients:
+            self.dialog_open("No Ingredients", "No ingredients were recognized on the photo.", "Retry")
+            return
+
+        self.switch_screen("home")
+        self.add_new_chat()
+        self.worker.submit(
+            self.recipe_book.suggest(ingredients),
+            on_success=lambda titles: self.show_recipe_options(ingredients, titles),
+            on_error=lambda error: self.dialog_open("Error", f"{error}", "Retry"),
+        )
+
+    def show_recipe_options(self, ingredients: list, titles: list):
+        """
+        Lets the user pick one of the suggested recipes. The best ranked recipes are already being requested.
+        :param ingredients:
+        :param titles:
+        :return: None
+        """
+        if not titles:
+            self.dialog_open("No Recipes", "No recipes were found for these ingredients.", "OK")
+            return
+
+        items = [
+            OneLineAvatarIconListItem(
+                text=title, on_release=lambda item, title_=title: self.pick_recipe(ingredients, title_)
+            )
+            for title in titles
+        ]
+        self.recipe_dialog = MDDialog(title="Recipes", type="simple", items=items, elevation=2)
+        self.recipe_dialog.open()
+
+    def pick_recipe(self, ingredients: list, title: str):
+        """
+        Shows the recipe of the picked dish in the current chat.
+        :param ingredients:
+        :param title:
+        :return: None
+        """
+        self.recipe_dialog.dismiss()
+        self.queue_message(
+            self.session, RECIPE_PROMPT.format(title=title), lambda: self.recipe_book.recipe(ingredients, title)
+        )
+
+    def on_recognition_failed(self, error: Exception):
+        """
+        Shows why the photo could not be recognized.
+        :param error:
+        :return: None
+        """
+        self.capture_pending = False
+        self.dialog_open("Error", f"{error}", "Retry")
+
     @staticmethod
     def input_limit(obj, max_length: int, _type: str):
         """
@@ -300,55 +2871,70 @@ class MainApp(MDApp):
         if _type in replacement_chars:
             obj.text = "".join(c for c in obj.text if c not in replacement_chars[_type])
 
-    def login(self, auto_login=False):
+    def login(self):
         """
-        Perform login action.
-        :param auto_login:
-        :return: Any
+        Perform login action. The result is applied by on_logged_in or on_login_failed.
+        :return: None
         """
+        if self.login_pending:
+            return
+
         login_email = self.login_screen.ids.login_email.text
         login_password = self.login_screen.ids.login_password.text
+        self.login_pending = True
+        self.worker.submit(
+            self.authenticate(login_email, login_password),
+            on_success=self.on_logged_in,
+            on_error=self.on_login_failed,
+        )
 
-        try:
-            db_user = db.child("users").child(self.replace_str(login_email, "to_db")).get()
-            if db_user.val() is not None:
-                db_email = db_user.val()["email"]
-                db_password = db_user.val()["password"]
-                db_username = db_user.val()["username"]
-                self.email_verified = auth.get_user_by_email(login_email).email_verified
-                if (login_email == db_email and login_password == db_password) and self.email_verified:
-                    self.user = auth_firebase.sign_in_with_email_and_password(
-                        login_email, login_password
-                    )
-                    self.login_check = True
-                    self.switch_screen("home")
-                    if not auto_login:
-                        self.store.put("user", refresh_token=self.user["refreshToken"])
-                        self.dialog_open(
-                            "Logged In",
-                            f'Successfully logged in as "{db_username}".',
-                            "OK",
-                        )
-                    self.get_chat_log()
-                    self.logged_out = False
-                    # self.nav_drawer.ids.user_label.text = self.user["email"]
-                else:
-                    if not self.email_verified:
-                        raise Exception("Your email is not verified yet.")
-            else:
-                raise Exception("Invalid email or password.")
-        except Exception as e:
-            self.dialog_open("Error", f"{e}", "Retry")
-            self.clear_text(
-                self.login_screen.ids.login_email,
-                self.login_screen.ids.login_password,
+    def on_logged_in(self, auth_session: AuthSession, auto_login: bool = False):
+        """
+        Shows the home screen for the signed-in user and syncs their chats.
+        :param auth_session:
+        :param auto_login:
+        :return: None
+        """
+        self.login_pending = False
+        if auto_login and self.logged_out:
+            return  # The user logged out while the stored session was restored
+        self.auth_session = auth_session
+        self.user = auth_session.user
+        self.username = auth_session.username
+        self.email_verified = True
+        self.login_check = True
+        self.switch_screen("home")
+        self.store.put("user", **auth_session.stored())
+        if not auto_login:
+            self.dialog_open(
+                "Logged In",
+                f'Successfully logged in as "{auth_session.username}".',
+                "OK",
             )
+        self.get_chat_log(auth_session.chat_versions)
+        self.logged_out = False
+
+    def on_login_failed(self, error: Exception):
+        """
+        Shows why the login failed.
+        :param error:
+        :return: None
+        """
+        self.login_pending = False
+        self.dialog_open("Error", f"{error}", "Retry")
+        self.clear_text(
+            self.login_screen.ids.login_email,
+            self.login_screen.ids.login_password,
+        )
 
     def sign_up(self):
         """
-        Perform sign up action.
+        Perform sign up action. The result is applied by on_signed_up or on_sign_up_failed.
         :return: None
         """
+        if self.signup_pending:
+            return
+
         signup_screen = self.signup_screen
         signup_username = signup_screen.ids.signup_username.text
         signup_email = signup_screen.ids.signup_email.text
@@ -357,45 +2943,95 @@ class MainApp(MDApp):
         if not signup_email or not signup_password or not signup_username:
             self.dialog_open("Error", "Invalid input.", "Retry")
         else:
+            self.signup_pending = True
+            self.worker.submit(
+                asyncio.to_thread(self.create_account, signup_username, signup_email, signup_password),
+                on_success=self.on_signed_up,
+                on_error=self.on_sign_up_failed,
+            )
+
+    def create_account(self, signup_username: str, signup_email: str, signup_password: str):
+        """
+        Claims the username, creates the account and sends the verification email. Runs on a worker thread. The user
+        record is written together with the username in one multi-path update, so the index never points to a
+        missing record once the account exists. When a later step fails the earlier ones are undone; a sign up that
+        stops between the claim and the update leaves the username claimed without a user, which
+        migrate_username_index releases.
+        :param signup_username:
+        :param signup_email:
+        :param signup_password:
+        :return: None
+        """
+        database = get_firebase().database()
+        db_username = self.replace_str(signup_email, "to_db")
+        if not claim_username(database, signup_username, db_username):
+            raise Exception("Username already exists.")
+
+        user = None
+        removed = {f"usernames/{signup_username}": None}
+        try:
+            user = get_auth().create_user_with_email_and_password(
+                signup_email, signup_password
+            )
+            removed[f"users/{db_username}"] = None
+            database.update({
+                f"users/{db_username}": {
+                    "username": signup_username,
+                    "email": signup_email,
+                    "password": signup_password,
+                },
+                f"usernames/{signup_username}": db_username,
+            })
+            get_auth().send_email_verification(user["idToken"])
+        except Exception:
+            self.undo_sign_up(removed, user)
+            raise
+
+    @staticmethod
+    def undo_sign_up(removed: dict, user=None):
+        """
+        Releases the claimed username and removes the account of a failed sign up. Runs on a worker thread.
+        :param removed: Database paths written by the sign up
+        :param user: The created account, if any
+        :return: None
+        """
+        try:
+            get_firebase().database().update(removed)
+        except Exception as e:
+            logging.error("Could not remove the records of a failed sign up: %s", e)
+        if user is not None:
             try:
-                users = db.child("users").get().val()
-                if users is not None:
-                    for user in users.values():
-                        if user["username"] == signup_username:
-                            self.dialog_open(
-                                "Error", "Username already exists.", "Retry"
-                            )
-                            return
-
-                user = auth_firebase.create_user_with_email_and_password(
-                    signup_email, signup_password
-                )
-                db_username = self.replace_str(signup_email, "to_db")
-                db.child("users").child(db_username).child("username").set(
-                    signup_username
-                )
-                db.child("users").child(db_username).child("email").set(signup_email)
-                db.child("users").child(db_username).child("password").set(
-                    signup_password
-                )
-                auth_firebase.send_email_verification(user["idToken"])
-                self.dialog_open("Success",
-                                 "Successfully created account. You need to verify your email to login.", "OK")
-                self.switch_screen("login")
-                self.clear_text(signup_screen.ids.signup_username,
-                                signup_screen.ids.signup_email,
-                                signup_screen.ids.signup_password)
+                get_auth().delete_user_account(user["idToken"])
             except Exception as e:
-                error_messages = {
-                    auth.EmailAlreadyExistsError: "The user with the provided email already exists.",
-                    auth.UidAlreadyExistsError: "The user with the provided username already exists.",
-                }
-                error_message = error_messages.get(type(e), str(e))
-                self.dialog_open("Error", error_message, "Retry")
-                self.clear_text(
-                    signup_screen.ids.signup_username,
-                    signup_screen.ids.signup_email,
-                    signup_screen.ids.signup_password)
+                logging.error("Could not delete the account of a failed sign up: %s", e)
+
+    def on_signed_up(self, *args):
+        """
+        Goes to the login screen after the account was created.
+        :return: None
+        """
+        signup_screen = self.signup_screen
+        self.signup_pending = False
+        self.dialog_open("Success",
+                         "Successfully created account. You need to verify your email to login.", "OK")
+        self.switch_screen("login")
+        self.clear_text(signup_screen.ids.signup_username,
+                        signup_screen.ids.signup_email,
+                        signup_screen.ids.signup_password)
+
+    def on_sign_up_failed(self, error: Exception):
+        """
+        Shows why the sign up failed.
+        :param error:
+        :return: None
+        """
+        signup_screen = self.signup_screen
+        self.signup_pending = False
+        self.dialog_open("Error", sign_up_error_message(error), "Retry")
+        self.clear_text(
+            signup_screen.ids.signup_username,
+            signup_screen.ids.signup_email,
+            signup_screen.ids.signup_password)
 
     def log_out(self, delete_acc=False):
         """
@@ -403,9 +3039,9 @@ class MainApp(MDApp):
         :return: None
         """
         # pass
-        f = "settings.json"
-        if os.path.isfile(f):
-            os.remove(f)
+        if "user" in self.store:
+            self.store.delete("user")
+            self.cancel_login_retry()
             self.nav_drawer.ids.nav_drawer.set_state("closed")
             self.switch_screen("login")
             self.clear_text(self.login_screen.ids.login_email, self.login_screen.ids.login_password)
@@ -413,28 +3049,80 @@ class MainApp(MDApp):
             if not delete_acc:
                 self.dialog_open("Logged Out", "Successfully logged out.", "OK")
 
-            self.read_more_button = None
-            self.cb_box = None
-            self.cb_label = None
+            self.stop_chat_stream()
+            if self.cache_email is not None:
+                self.chat_cache.clear(self.cache_email)
+
             self.login_check = False
-            self.prev_q_a = []
-            self.cb_parent = None
             self.user = None
-            self.chat_bubbles = []
-            self.response = ""
-            self.chat_count = 0
-            self.title = ""
-            self.chat_layouts = []
-            self.chat_layout = ChatLayout(chat_id=0)
-            self.chat_layouts.append(self.chat_layout)
-            self.chat_sessions = []
+            self.username = None
+            self.auth_session = None
             self.logged_out = True
+            self.reset_chat_list()
 
-            keys_to_remove = [key for key in self.nav_drawer.ids.keys() if key.startswith("item") and key != "item_0"]
-            for key in keys_to_remove:
-                item = self.nav_drawer.ids[f"{key}"]
-                self.nav_drawer.children[0].children[0].children[0].remove_widget(item)
-                self.nav_drawer.ids.pop(key)
+    def reset_chat_list(self):
+        """
+        Removes every chat from the navigation drawer and the home screen.
+        :return: None
+        """
+        self.cancel_login_retry()
+        if self.home_screen is None:
+            return
+        if self.chat_layout is not None and self.chat_layout.parent is not None:
+            self.chat_layout.parent.remove_widget(self.chat_layout)
+
+        md_list = self.nav_drawer.ids.chat_list
+        for session in self.sessions.values():
+            if session.chat_id != 0 and session.list_item.parent is not None:
+                md_list.remove_widget(session.list_item)
+
+        self.chat_count = 0
+        self.title = ""
+        self.sessions = {}
+        self.sessions_by_item = {}
+        self.sessions_by_key = {}
+        self.cache_email = None
+        self.cache_shown = False
+
+        first_item = self.nav_drawer.ids.item_0
+        first_item.text = "New Chat"
+        first_item.children[0].clear_widgets()
+        self.chat_layout = ChatLayout(chat_id=0)
+        self.session = self.register_session(0, first_item, self.chat_layout)
+
+    def register_session(self, chat_id: int, list_item, chat_layout):
+        """
+        Creates the session of a navigation drawer item and adds it to the lookup tables.
+        :param chat_id:
+        :param list_item:
+        :param chat_layout:
+        :return: ChatSession
+        """
+        session = ChatSession(chat_id, list_item, chat_layout)
+        self.sessions[chat_id] = session
+        self.sessions_by_item[list_item] = session
+        return session
+
+    def unregister_session(self, session: ChatSession):
+        """
+        Removes a deleted chat from the lookup tables.
+        :param session:
+        :return: None
+        """
+        self.sessions.pop(session.chat_id, None)
+        self.sessions_by_item.pop(session.list_item, None)
+        if session.chat_key is not None and self.sessions_by_key.get(session.chat_key) is session:
+            del self.sessions_by_key[session.chat_key]
+
+    def set_chat_key(self, session: ChatSession, chat_key: str):
+        """
+        Records the database key of a chat.
+        :param session:
+        :param chat_key:
+        :return: None
+        """
+        session.chat_key = chat_key
+        self.sessions_by_key[chat_key] = session
 
     def create_dialog(self):
         """
@@ -493,36 +3181,100 @@ class MainApp(MDApp):
         :return:
         """
         if self.delete_confirmation is not None:
-            Clock.unschedule(self.check_delete_confirmation)
+            self.cancel_delete_confirmation()
 
             if self.delete_confirmation and delete_what == "log":
                 md_list = self.nav_drawer.ids.chat_list
                 list_item = obj.parent.parent
+                session = self.sessions_by_item.get(list_item)
+                if session is None:  # Deleted already
+                    self.delete_confirmation = None
+                    return
                 md_list.remove_widget(list_item)
 
-                db.child("chats") \
-                    .child(self.replace_str(self.user["email"], "to_db")) \
-                    .child(self.replace_str(obj.parent.parent.text, "to_db")) \
-                    .remove()
+                email = self.replace_str(self.user["email"], "to_db")
+                self.cancel_messages(session)
+                chat_key = session.chat_key
+                if chat_key is not None:
+                    self.worker.submit(
+                        self.delete_chat(email, chat_key),
+                        on_error=lambda error: logging.error("Chat delete failed: %s", error),
+                    )
 
-                chat_layout = self.chat_layouts[list_item.fake_id]
+                self.unregister_session(session)
                 self.title = list_item.text
 
-                chat_layout.children[0].children[0].clear_widgets()
-                self.add_new_chat()
-                self.switch_session(self.nav_drawer.ids[f"item_{self.chat_count}"])
+                session.chat_layout.clear_messages()
+                self.switch_session(self.new_chat_session().list_item)
             elif self.delete_confirmation and delete_what == "account":
-                auth_firebase.delete_user_account(self.user["idToken"])
-                # databaseden sil
-                db.child("users").child(self.replace_str(self.user["email"], "to_db")).remove()
-                # logout at
-                self.log_out(delete_acc=True)
-                self.dialog_open("Success", "Successfully deleted your account.", "OK")
+                self.worker.submit(
+                    asyncio.to_thread(self.delete_account_records, self.user["idToken"], self.user["email"]),
+                    on_success=self.on_account_deleted,
+                    on_error=lambda error: self.dialog_open("Error", f"{error}", "Retry"),
+                )
 
             else:
                 pass
 
-            self.delete_confirmation = None
+            self.delete_confirmation = None
+
+    def cancel_delete_confirmation(self):
+        """
+        Stops waiting for the answer of the delete dialog, see check_delete_confirmation.
+        :return: None
+        """
+        if self.delete_confirmation_event is not None:
+            self.delete_confirmation_event.cancel()
+            self.delete_confirmation_event = None
+
+    async def delete_chat(self, email: str, chat_key: str):
+        """
+        Deletes a chat after the writes submitted before it, so a pair saved just before the delete can not bring the
+        chat back. Runs on the worker loop.
+        :param email:
+        :param chat_key:
+        :return: None
+        """
+        async with self.chat_write_lock:
+            await asyncio.to_thread(self.delete_chat_records, email, chat_key)
+
+    def delete_chat_records(self, email: str, chat_key: str):
+        """
+        Deletes a chat from the firebase database and the local cache. Runs on a worker thread.
+        :param email:
+        :param chat_key:
+        :return: None
+        """
+        get_firebase().database().update({
+            f"conversations/{email}/{chat_key}": None,
+            f"messages/{email}/{chat_key}": None,
+        })
+        self.chat_cache.delete_chat(email, chat_key)
+
+    def delete_account_records(self, id_token: str, email: str):
+        """
+        Deletes the account, its records and its username. Runs on a worker thread.
+        :param id_token:
+        :param email:
+        :return: None
+        """
+        database = get_firebase().database()
+        get_auth().delete_user_account(id_token)
+        db_username = self.replace_str(email, "to_db")
+        username = database.child("users").child(db_username).child("username").get().val()
+        deleted = {f"users/{db_username}": None, f"conversations/{db_username}": None,
+                   f"messages/{db_username}": None}
+        if username:
+            deleted[f"usernames/{username}"] = None
+        database.update(deleted)
+
+    def on_account_deleted(self, *args):
+        """
+        Logs out after the account was deleted.
+        :return: None
+        """
+        self.log_out(delete_acc=True)
+        self.dialog_open("Success", "Successfully deleted your account.", "OK")
 
     def dialog_open(self, title_text: str, dg_text: str, btn_text: str):
         """
@@ -549,32 +3301,55 @@ class MainApp(MDApp):
         self.dialog.dismiss(obj)
 
     @staticmethod
-    async def get_response(instructions: str, previous_questions_and_answers: list, new_question: str):
+    async def get_response(messages: list, operation: str = "openai.completion"):
         """
-        Creates a completion with given parameters and prompt.
-        :param instructions: Instructions that will be given to chatbot
-        :param previous_questions_and_answers:
-        :param new_question:
+        Creates a completion with given parameters and messages.
+        :param messages: Built by ContextBuilder
+        :param operation: Name the request is recorded under in metrics
         :return: str
         """
-        messages = [
-            {"role": "system", "content": instructions},
-        ]
-        for question, answer in previous_questions_and_answers[-MAX_CONTEXT_QUESTIONS:]:
-            messages.append({"role": "user", "content": question})
-            messages.append({"role": "assistant", "content": answer})
-        messages.append({"role": "user", "content": new_question})
-
-        completion = await openai.ChatCompletion.acreate(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            temperature=TEMPERATURE,
-            max_tokens=MAX_TOKENS,
-            top_p=1,
-            frequency_penalty=FREQUENCY_PENALTY,
-            presence_penalty=PRESENCE_PENALTY,
-        )
-        return str(completion.choices[0].message.content)
+        with metrics.measure(operation) as measurement:
+            completion = await get_openai().ChatCompletion.acreate(
+                model=MODEL,
+                messages=messages,
+                temperature=TEMPERATURE,
+                max_tokens=MAX_TOKENS,
+                top_p=1,
+                frequency_penalty=FREQUENCY_PENALTY,
+                presence_penalty=PRESENCE_PENALTY,
+            )
+            response = str(completion.choices[0].message.content)
+            measurement["bytes"] = len(json.dumps(messages)) + len(response.encode())
+        return response
+
+    @staticmethod
+    async def get_response_stream(messages: list):
+        """
+        Creates a streamed completion with given parameters and messages.
+        :param messages: Built by ContextBuilder
+        :return: AsyncIterator[str]
+        """
+        started_at = time.perf_counter()
+        with metrics.measure("openai.stream") as measurement:
+            measurement["bytes"] = len(json.dumps(messages))
+            stream = await get_openai().ChatCompletion.acreate(
+                model=MODEL,
+                messages=messages,
+                temperature=TEMPERATURE,
+                max_tokens=MAX_TOKENS,
+                top_p=1,
+                frequency_penalty=FREQUENCY_PENALTY,
+                presence_penalty=PRESENCE_PENALTY,
+                stream=True,
+            )
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.get("content")
+                if delta:
+                    if started_at is not None:
+                        metrics.record("openai.first_token", time.perf_counter() - started_at)
+                        started_at = None
+                    measurement["bytes"] += len(delta.encode())
+                    yield delta
 
     @staticmethod
     async def get_moderation(question: str):
@@ -602,7 +3377,9 @@ class MainApp(MDApp):
         # if "failure_keyword" in question.lower():
         #     return ["Failed moderation check for testing purposes."]
 
-        response = await openai.Moderation.acreate(input=question)
+        with metrics.measure("openai.moderation") as measurement:
+            response = await get_openai().Moderation.acreate(input=question)
+            measurement["bytes"] = len(question.encode())
         if response.results[0].flagged:
             result = [
                 "Failed moderation check: " + error
@@ -612,35 +3389,145 @@ class MainApp(MDApp):
             return result
         return None
 
-    def completion(self, prompt):
+    async def process_message(self, prompt: str, pairs: list, end: int, renderer=None, context=None):
+        """
+        Runs the network part of sending a message on the worker loop once one of the MAX_CONCURRENT_PROMPTS slots is
+        free. Moderation and completion are started together; if moderation flags the prompt the completion is
+        cancelled.
+        :param prompt:
+        :param pairs: Pairs of the session
+        :param end: Number of pairs in the session at send time
+        :param renderer: StreamRenderer that receives the reply as it is generated
+        :param context: ContextBuilder of the chat
+        :return: str
         """
-        Gets completion results and performs session tasks.
+        async with self.prompt_slots:
+            moderation_task = asyncio.ensure_future(self.check_moderation(prompt, renderer))
+            response_task = asyncio.ensure_future(self.generate_response(prompt, pairs, end, renderer, context))
+            try:
+                _, response = await asyncio.gather(moderation_task, response_task)
+            except BaseException:
+                moderation_task.cancel()
+                response_task.cancel()
+                raise
+            return response
+
+    async def check_moderation(self, prompt: str, renderer=None):
+        """
+        Raises if the prompt fails moderation, otherwise lets the renderer show the streamed reply.
+        :param prompt:
+        :param renderer:
         :return: None
         """
-        try:
-            moderation_task = asyncio.ensure_future(self.get_moderation(prompt))
-            errors = asyncio.get_event_loop().run_until_complete(asyncio.gather(moderation_task))[-1]
-            if errors:
-                raise Exception(errors)
-
-            item_id = f"item_{self.chat_layout.chat_id}"
-
-            for i, (session_item_id, prev_q_a) in enumerate(self.chat_sessions):
-                if session_item_id == item_id:
-                    self.chat_sessions[i] = (
-                        item_id,
-                        prev_q_a + [(prompt, self.response)],
-                    )
-                    self.prev_q_a = prev_q_a + [(prompt, self.response)]
-                    break
-            else:
-                self.chat_sessions.append((item_id, [(prompt, self.response)]))
-                self.prev_q_a = [(prompt, self.response)]
-        except Exception as e:
-            e = str(e).removeprefix("[").removesuffix("]").replace("'", "")
-            self.dialog_open("Error", e, "Retry")
+        if self.moderation_cache is None:
+            errors = await self.get_moderation(prompt)
+        else:
+            key = ResponseCache.make_key(prompt)
+            errors = self.moderation_cache.get(key)
+            if errors is None:
+                errors = await self.get_moderation(prompt) or []
+                self.moderation_cache.put(key, errors)
+        if errors:
+            raise Exception(errors)
+        if renderer is not None:
+            renderer.release()
+
+    async def generate_response(self, prompt: str, pairs: list, end: int, renderer=None, context=None):
+        """
+        Gets the reply for the prompt, streaming it into the renderer when one is given.
+        :param prompt:
+        :param pairs:
+        :param end: Number of pairs the prompt follows
+        :param renderer:
+        :param context: ContextBuilder of the chat, a new one is used if None
+        :return: str
+        """
+        messages = (context or ContextBuilder()).build(INSTRUCTIONS, pairs, prompt, end)
+        if renderer is None:
+            return await self.cached_response(messages)
+
+        key = self.completion_key(messages)
+        if key is not None:
+            response = self.completion_cache.get(key)
+            if response is not None:
+                renderer.feed(response)
+                return response
+
+        chunks = []
+        async for delta in self.get_response_stream(messages):
+            chunks.append(delta)
+            renderer.feed(delta)
+        response = "".join(chunks)
+        if key is not None:
+            self.completion_cache.put(key, response)
+        return response
+
+    async def cached_response(self, messages: list, operation: str = "openai.completion"):
+        """
+        Returns the completion from the response cache when it is enabled and has it, otherwise requests it.
+        :param messages:
+        :param operation: Name the request is recorded under in metrics
+        :return: str
+        """
+        key = self.completion_key(messages)
+        if key is None:
+            return await self.get_response(messages, operation)
+
+        response = self.completion_cache.get(key)
+        if response is None:
+            response = await self.get_response(messages, operation)
+            self.completion_cache.put(key, response)
+        return response
+
+    def completion_key(self, messages: list):
+        """
+        Returns the response cache key of a completion request, or None if the cache is disabled.
+        :param messages:
+        :return: Optional[str]
+        """
+        if self.completion_cache is None:
+            return None
+        return ResponseCache.make_key(
+            MODEL, messages, TEMPERATURE, MAX_TOKENS, FREQUENCY_PENALTY, PRESENCE_PENALTY
+        )
+
+    async def summarize_context(self, context: ContextBuilder, pairs: list):
+        """
+        Summarizes the turns that dropped out of the context of a chat, together with the previous summary.
+        Runs on the worker loop.
+        :param context:
+        :param pairs:
+        :return: None
+        """
+        pending = context.pending_summary()
+        if pending is None:
+            return
+        start, end = pending
+        conversation = "\n".join(f"User: {question}\nAI: {answer}" for question, answer in pairs[start:end])
+        summary_str = f"""
+                        ---BEGIN SUMMARY---
+                        {context.summary}
+                        ---END SUMMARY---
+                        ---BEGIN CONVERSATION---
+                        {conversation}
+                        ---END CONVERSATION---
+                        Update the summary with the conversation in 100 words or fewer in user's language:
+                    """
+        messages = ContextBuilder().build(INSTRUCTIONS, [], summary_str)
+        context.set_summary(await self.cached_response(messages, "openai.summary"), end)
+
+    def completion(self, prompt: str, response: str, session: ChatSession):
+        """
+        Appends the prompt and response pair to the session it was sent from.
+        :param prompt:
+        :param response:
+        :param session:
+        :return: int: index of the pair, starting from 1
+        """
+        session.pairs.append((prompt, response))
+        return session.pair_count
 
-    def generate_title(self, new_question: str, response: str):
+    async def generate_title(self, new_question: str, response: str):
         """
         Generates title with given prompt and response. It generates another completion for title based on first \
         interaction between user and AI.
@@ -655,230 +3542,555 @@ class MainApp(MDApp):
                         ---END CONVERSATION---
                         Summarize the conversation in 5 words or fewer in user's language:
                     """
-        title_task = asyncio.ensure_future(self.get_response(INSTRUCTIONS, self.prev_q_a, title_str))
-        title = asyncio.get_event_loop().run_until_complete(asyncio.gather(title_task))[-1]
-        item = self.nav_drawer.ids[f"item_{self.chat_count}"]
+        return await self.cached_response(ContextBuilder().build(INSTRUCTIONS, [], title_str), "openai.title")
+
+    def set_chat_title(self, session: ChatSession, title: str):
+        """
+        Shows the title of a chat on its navigation drawer item.
+        :param session:
+        :param title:
+        :return: None
+        """
+        item = session.list_item
         item.text = title
-        item.add_widget(IconRightWidget(icon="delete", on_release=self.delete_chat_log))
-        return title
+        if not item.children[0].children:
+            item.add_widget(IconRightWidget(icon="delete", on_release=self.delete_chat_log))
+        if session is self.session:
+            self.title = title
+
+    def save_chat(self, session: ChatSession, write):
+        """
+        Submits a write of the chat and records when the database confirmed it.
+        :param session:
+        :param write: Coroutine of save_chat_log or save_chat_title
+        :return: None
+        """
+        def done(error=None):
+            session.saves -= 1
+            if error is None:
+                session.saved_at = time.time()
+            else:
+                logging.error("Chat save failed: %s", error)
+
+        session.saves += 1
+        self.worker.submit(write, on_success=lambda result: done(), on_error=done)
+
+    async def save_chat_log(self, chat_key: str, title: str, index: int, pair: tuple):
+        """
+        Appends a prompt and answer pair of the chat to the firebase database. Writes run one at a time in the order
+        they were submitted. Runs on the worker loop.
+        :param chat_key:
+        :param title: Stored with the first pair
+        :param index: Index of the pair, starting from 1
+        :param pair:
+        :return: None
+        """
+        if self.login_check:
+            email = self.replace_str(self.user["email"], "to_db")
+            async with self.chat_write_lock:
+                await asyncio.to_thread(self._write_chat_log, email, chat_key, title, index, pair)
+
+    def _write_chat_log(self, email: str, chat_key: str, title: str, index: int, pair: tuple):
+        # pyrebase keeps the query path on the Database object, so worker threads use their own handle
+        database = get_firebase().database()
+        updated_at = time.time()
+        update = {f"messages/{email}/{chat_key}/{pair_key(index)}": message_record(pair, updated_at)}
+        if index == 1:
+            update[f"conversations/{email}/{chat_key}"] = chat_meta(title, updated_at, updated_at, index)
+        else:
+            update[f"conversations/{email}/{chat_key}/updated_at"] = updated_at
+            update[f"conversations/{email}/{chat_key}/pairs"] = index
+
+        self.chat_cache.append_messages(email, chat_key, index, [pair], updated_at)
+        if index == 1:
+            self.chat_cache.set_title(email, chat_key, title, updated_at)
+        database.update(update)
+        self.count_request("chats.update")
 
-    def save_chat_log(self, title: str):
+    async def save_chat_title(self, chat_key: str, title: str):
         """
-        Saves the chat log to the firebase database.
+        Stores the title of a chat in the firebase database. Runs on the worker loop.
+        :param chat_key:
         :param title:
         :return: None
         """
         if self.login_check:
-            user = auth_firebase.get_account_info(self.user["idToken"])
-            email = self.replace_str(user["users"][0]["email"], "to_db")
-            chat_id = self.replace_str(title, "to_db")
-
-            for i, (prompt, answer) in enumerate(self.prev_q_a):
-                prompt_key = f"prompt_{i + 1}"
-                answer_key = f"answer_{i + 1}"
-                db.child("chats").child(email).child(chat_id).child(prompt_key).set(
-                    prompt
-                )
-                db.child("chats").child(email).child(chat_id).child(answer_key).set(
-                    answer
-                )
+            email = self.replace_str(self.user["email"], "to_db")
+            updated_at = time.time()
+            async with self.chat_write_lock:
+                await asyncio.to_thread(self.chat_cache.set_title, email, chat_key, title, updated_at)
+                await asyncio.to_thread(lambda: get_firebase().database().update({
+                    f"conversations/{email}/{chat_key}/title": title,
+                    f"conversations/{email}/{chat_key}/updated_at": updated_at,
+                }))
+            self.count_request("chats.update")
+
+    def count_request(self, name: str, count: int = 1):
+        """
+        Increments the request counter of the given backend operation. Safe to call from any thread.
+        :param name:
+        :param count:
+        :return: None
+        """
+        with self.request_counts_lock:
+            self.request_counts[name] += count
+
+    def get_chat_log(self, chat_versions=None):
+        """
+        Shows the chats of the local cache and syncs them with the firebase database in the background.
+        :param chat_versions: Result of fetch_chat_versions when it was prefetched during login
+        :return: None
+        """
+        email = self.replace_str(self.user["email"], "to_db")
+        if not self.cache_shown or self.cache_email != email:
+            self.cache_email = email
+            self.show_cached_chats()
+
+        self.worker.submit(
+            self.sync_chats(email, chat_versions),
+            on_success=lambda changes: self.on_chats_synced(email, *changes),
+            on_error=lambda error: logging.error("Chat sync failed: %s", error),
+        )
+
+    def show_cached_chats(self):
+        """
+        Lists the chats of the local cache. Messages of a chat are loaded when it is opened.
+        :return: None
+        """
+        self.cache_shown = True
+        for chat_key, title in self.chat_cache.chat_titles(self.cache_email).items():
+            self.assign_chat_item(self.new_chat_session(), chat_key, title)
+            self.append_chat_item()
 
-    def get_chat_log(self):
+        self.switch_session(self.new_chat_session().list_item)
+
+    def assign_chat_item(self, session: ChatSession, chat_key: str, title: str):
         """
-        Retrieves the chat log from the firebase database.
+        Shows a stored chat on a navigation drawer item. Its messages are loaded when it is opened.
+        :param session:
+        :param chat_key:
+        :param title:
         :return: None
         """
-        if (
-                db.child("chats").get().val() is not None
-                and db.child("chats")
-                .child(self.replace_str(self.user["email"], "to_db"))
-                .get()
-                .val() is not None
-        ):
-            chats = db.child("chats").child(
-                self.replace_str(self.user["email"], "to_db")
+        self.set_chat_title(session, title)
+        session.loaded = False
+        self.set_chat_key(session, chat_key)
+
+    def append_chat_item(self):
+        """
+        Adds a "New Chat" item and its chat layout to the end of the navigation drawer.
+        :return: ChatSession
+        """
+        md_list = self.nav_drawer.ids.chat_list
+        list_item = OneLineAvatarIconListItem(
+            text="New Chat",
+            _txt_left_pad=dp(8),
+            on_release=self.switch_session,
+            fake_id=self.chat_count + 1,
+        )
+        md_list.add_widget(list_item)
+        self.chat_count += 1
+        return self.register_session(self.chat_count, list_item, ChatLayout(chat_id=self.chat_count))
+
+    def new_chat_session(self):
+        """
+        Returns the session of the "New Chat" item at the end of the navigation drawer, adding the item when the last
+        chat was deleted, is stored or has a message.
+        :return: ChatSession
+        """
+        trailing = self.sessions.get(self.chat_count)
+        if trailing is None or trailing.chat_key is not None or trailing.pairs or trailing.in_flight is not None:
+            trailing = self.append_chat_item()
+        return trailing
+
+    async def fetch_chat_versions(self, email: str):
+        """
+        Reads the chat records of the user from firebase, after moving their schema 1 chats to the current schema.
+        Runs on the worker loop.
+        :param email:
+        :return: tuple[dict, float]: record per chat key, and the time the read started
+        """
+        started_at = time.time()
+        legacy_keys, meta = await asyncio.gather(
+            asyncio.to_thread(lambda: get_firebase().database().child("chats").child(email).shallow().get().val()),
+            asyncio.to_thread(lambda: get_firebase().database().child("conversations").child(email).get().val()),
+        )
+        self.count_request("chats.shallow")
+        self.count_request("conversations.get")
+
+        if legacy_keys:
+            migrated = await asyncio.to_thread(migrate_user_chats, get_firebase().database(), email, legacy_keys)
+            logging.info("Moved %d chats to chat schema %d", migrated, CHAT_SCHEMA_VERSION)
+            meta = await asyncio.to_thread(
+                lambda: get_firebase().database().child("conversations").child(email).get().val()
             )
-            chat_id = 0
-            for chat in chats.get().each():
-                chat_layout = ChatLayout(chat_id=chat_id)
-                chat_id += 1
-
-                prompt_bubbles = []
-                answer_bubbles = []
-
-                title = self.replace_str(chat.key(), "from_db")
-
-                for item in chat.val().items():
-                    if item[0].split("_")[0] == "prompt":
-                        cb_parent = ChatBubble(
-                            pos_hint={"right": 1}, halign="right", btype="m"
-                        )
-                        cb_relative = cb_parent.children[0]
-                        cb_relative.remove_widget(cb_relative.children[0])
-                        cb_label = cb_parent.ids.chat_bubble_text
-                        cb_label.text = item[1]
-                        prompt_bubbles.append(cb_parent)
-                        self.cb_label = cb_label
-
-                    if item[0].split("_")[0] == "answer":
-                        if len(item[1]) > 200:
-                            cb_parent = ChatBubble(
-                                pos_hint={"left": 1}, halign="left", btype="r"
-                            )
-                            cb_parent.full_text = item[1]
-                            self.cb_box = cb_parent.children[0].children[0]
-
-                            cb_label = cb_parent.ids.chat_bubble_text
-                            cb_label.text = item[1][:200] + "..."
-
-                            self.read_more_button = MDFlatButton(
-                                text="Read \nmore",
-                                pos_hint={"bottom": 0.0, "right": 1.0},
-                                font_size="12sp",
-                                on_release=self.read_more_expand,
-                            )
-
-                            self.cb_box.add_widget(self.read_more_button)
-
-                            answer_bubbles.append(cb_parent)
-                            self.cb_label = cb_label
-                        else:
-                            cb_parent = ChatBubble(
-                                pos_hint={"left": 1}, halign="left", btype="r"
-                            )
-                            cb_parent.full_text = item[1]
-                            cb_label = cb_parent.ids.chat_bubble_text
-                            cb_label.text = item[1]
-                            answer_bubbles.append(cb_parent)
-                            self.cb_label = cb_label
-
-                if self.chat_count == 0:
-                    chat_layout = self.chat_layouts[0]
-                    chat_children = chat_layout.children[0].children[0]
-
-                    item = self.nav_drawer.ids[f"item_{self.chat_count}"]
-                    item.text = title
-                    right_widget = IconRightWidget(
-                        icon="delete", on_release=self.delete_chat_log
-                    )
-                    if not item.children[0].children:
-                        item.add_widget(right_widget)
-
-                    for i in range(len(prompt_bubbles)):
-                        prompt_bubble = prompt_bubbles[i]
-                        answer_bubble = answer_bubbles[i]
-
-                        prompt_text = (
-                            prompt_bubble.children[0].children[0].children[0].text
-                        )
-                        answer_text = answer_bubble.full_text
-
-                        session_id = f"item_{self.chat_count}"
-                        prompt_answer_pair = (prompt_text, answer_text)
-
-                        existing_session = next(
-                            (
-                                session
-                                for session in self.chat_sessions
-                                if session[0] == session_id
-                            ),
-                            None,
-                        )
-
-                        if existing_session is not None:
-                            existing_session[1].append(prompt_answer_pair)
-                        else:
-                            self.chat_sessions.append(
-                                (session_id, [prompt_answer_pair])
-                            )
-
-                        if prompt_bubble.parent is not None:
-                            prompt_bubble.parent.remove_widget(prompt_bubble)
-                        chat_children.add_widget(prompt_bubble)
-
-                        if answer_bubble.parent is not None:
-                            answer_bubble.parent.remove_widget(answer_bubble)
-                        chat_children.add_widget(answer_bubble)
-
-                    md_list = self.nav_drawer.ids.chat_list
-                    list_item = OneLineAvatarIconListItem(
-                        text="New Chat",
-                        _txt_left_pad=dp(8),
-                        on_release=self.switch_session,
-                        fake_id=self.chat_count + 1,
-                        theme_text_color="Custom",
-                        text_color="black" if self.theme_cls.theme_style == "Light" else "white",
-                    )
-                    md_list.add_widget(list_item)
-                    self.chat_count += 1
-                    self.nav_drawer.ids[f"item_{self.chat_count}"] = list_item
-                else:
-                    chat_children = chat_layout.children[0].children[0]
-                    item = self.nav_drawer.ids[f"item_{self.chat_count}"]
-                    item.text = title
-                    right_widget = IconRightWidget(
-                        icon="delete", on_release=self.delete_chat_log
-                    )
-                    if not item.children[0].children:
-                        item.add_widget(right_widget)
-
-                    for i in range(len(prompt_bubbles)):
-                        prompt_bubble = prompt_bubbles[i]
-                        answer_bubble = answer_bubbles[i]
-
-                        prompt_text = (
-                            prompt_bubble.children[0].children[0].children[0].text
-                        )
-                        answer_text = answer_bubble.full_text
-
-                        session_id = f"item_{self.chat_count}"
-                        prompt_answer_pair = (prompt_text, answer_text)
-
-                        existing_session = next(
-                            (
-                                session
-                                for session in self.chat_sessions
-                                if session[0] == session_id
-                            ),
-                            None,
-                        )
-
-                        if existing_session is not None:
-                            existing_session[1].append(prompt_answer_pair)
-                        else:
-                            self.chat_sessions.append(
-                                (session_id, [prompt_answer_pair])
-                            )
-
-                        if prompt_bubble.parent is not None:
-                            prompt_bubble.parent.remove_widget(prompt_bubble)
-                        chat_children.add_widget(prompt_bubble)
-
-                        if answer_bubble.parent is not None:
-                            answer_bubble.parent.remove_widget(answer_bubble)
-                        chat_children.add_widget(answer_bubble)
-
-                    self.chat_layouts.append(chat_layout)
-
-                    md_list = self.nav_drawer.ids.chat_list
-                    list_item = OneLineAvatarIconListItem(
-                        text="New Chat",
-                        _txt_left_pad=dp(8),
-                        on_release=self.switch_session,
-                        fake_id=self.chat_count + 1,
-                        theme_text_color="Custom",
-                        text_color="black" if self.theme_cls.theme_style == "Light" else "white",
-                    )
-                    md_list.add_widget(list_item)
-                    self.chat_count += 1
-                    self.nav_drawer.ids[f"item_{self.chat_count}"] = list_item
+            self.count_request("conversations.get")
+        return {key: record for key, record in (meta or {}).items() if isinstance(record, dict)}, started_at
+
+    async def sync_chats(self, email: str, chat_versions=None):
+        """
+        Compares the updated_at markers of the chats in firebase with the local cache. New and changed chats are
+        recorded in the cache and their messages are downloaded when opened. Runs on the worker loop.
+        :param email:
+        :param chat_versions: Result of fetch_chat_versions, read now if None
+        :return: tuple[list, list, list]: new, changed and removed chat keys
+        """
+        remote, started_at = chat_versions or await self.fetch_chat_versions(email)
+        local = self.chat_cache.chat_versions(email)
+
+        new, changed = [], []
+        for chat_key, meta in remote.items():
+            updated_at = meta.get("updated_at") or started_at
+            if chat_key not in local:
+                new.append(chat_key)
+                self.chat_cache.mark_stale(email, chat_key, updated_at, meta.get("title", ""))
+            elif updated_at > local[chat_key]:
+                changed.append(chat_key)
+                self.chat_cache.mark_stale(email, chat_key, updated_at, meta.get("title", ""))
+
+        removed = [key for key, updated_at in local.items() if key not in remote and updated_at < started_at]
+        for chat_key in removed:
+            self.chat_cache.delete_chat(email, chat_key)
+        return new, changed, removed
+
+    def on_chats_synced(self, email: str, new: list, changed: list, removed: list):
+        """
+        Applies the login sync, then follows later changes through the chat stream.
+        :param email:
+        :param new:
+        :param changed:
+        :param removed:
+        :return: None
+        """
+        if email != self.cache_email or not self.login_check:
+            return
+        self.apply_synced_chats(new, changed, removed)
+        if CHAT_STREAM_ENABLED and self.chat_stream is None:
+            self.chat_stream = ChatStream(email, self.apply_streamed_chats)
+            self.chat_stream.start()
 
-            chat_layout = ChatLayout(chat_id=chat_id)
-            self.chat_layouts.append(chat_layout)
+    def stop_chat_stream(self):
+        """
+        Stops following the chats of the user.
+        :return: None
+        """
+        if self.chat_stream is not None:
+            self.chat_stream.close()
+            self.chat_stream = None
 
-            self.switch_session(self.nav_drawer.ids[f"item_{self.chat_count}"])
-        else:
+    def apply_streamed_chats(self, changes: dict, snapshot):
+        """
+        Applies changes of the chat stream to the local cache, the navigation drawer and open chats.
+        :param changes: Chat key to (replace, fields), see ChatStream.flush
+        :param snapshot: (chat keys, opened at) when the stream sent every chat, otherwise None
+        :return: None
+        """
+        email = self.cache_email
+        if snapshot is not None:
+            # A chat missing from the snapshot was deleted, unless it was saved after the stream was opened or
+            # still has a reply or write on the way. Chats without a chat key are not stored yet.
+            chat_keys, opened_at = snapshot
+            versions = self.chat_cache.chat_versions(email)
+            for chat_key, session in list(self.sessions_by_key.items()):
+                if chat_key in chat_keys or session.in_flight is not None or session.saves:
+                    continue
+                if max(session.saved_at, versions.get(chat_key, 0)) < opened_at:
+                    self.chat_cache.delete_chat(email, chat_key)
+                    self.remove_synced_chat(chat_key)
+
+        for chat_key, (replace, fields) in changes.items():
+            if replace and fields is None:
+                self.chat_cache.delete_chat(email, chat_key)
+                self.remove_synced_chat(chat_key)
+            else:
+                self.update_streamed_chat(chat_key, fields)
+
+    def update_streamed_chat(self, chat_key: str, fields: dict):
+        """
+        Applies a changed chat record sent by the chat stream. A new title is shown right away. When the record
+        counts more pairs than the chat has, an open chat reads the new pairs and a closed chat reads them when it
+        is opened.
+        :param chat_key:
+        :param fields: Changed fields of the record, see chat_meta
+        :return: None
+        """
+        email = self.cache_email
+        session = self.sessions_by_key.get(chat_key)
+        updated_at = fields.get("updated_at") or time.time()
+        if session is None:
+            self.chat_cache.mark_stale(email, chat_key, updated_at, fields.get("title", ""))
+            self.add_synced_chat(chat_key, fields.get("title", ""))
+            return
+
+        title = fields.get("title", session.list_item.text)
+        if title != session.list_item.text:
+            self.chat_cache.set_title(email, chat_key, title, updated_at)
+            self.set_chat_title(session, title)
+
+        if "pairs" in fields:
+            if session.loaded:
+                if fields["pairs"] > session.pair_count:
+                    self.update_chat(session)
+            else:
+                start, cached = self.chat_cache.messages(email, chat_key, stale=True) or (1, [])
+                if fields["pairs"] > start - 1 + len(cached):
+                    self.chat_cache.mark_stale(email, chat_key, updated_at, title)
+
+    def append_pairs(self, session: ChatSession, pairs: list):
+        """
+        Appends prompt and answer pairs to a loaded chat and shows them.
+        :param session:
+        :param pairs:
+        :return: None
+        """
+        if not pairs:
+            return
+        session.pairs.extend(pairs)
+        for prompt, answer in pairs:
+            session.chat_layout.add_message("user", prompt)
+            session.chat_layout.add_message("assistant", answer)
+        session.rendered_pairs += len(pairs)
+        if session is self.session:
+            session.chat_layout.scroll_to_bottom()
+
+    def remove_synced_chat(self, chat_key: str):
+        """
+        Removes a chat that was deleted on another device from the navigation drawer.
+        :param chat_key:
+        :return: None
+        """
+        session = self.sessions_by_key.get(chat_key)
+        if session is None:
+            return
+        if session.list_item.parent is not None:
+            session.list_item.parent.remove_widget(session.list_item)
+        self.cancel_messages(session)
+        self.unregister_session(session)
+        if session is self.session:
+            self.switch_session(self.new_chat_session().list_item)
+
+    def apply_synced_chats(self, new: list, changed: list, removed: list):
+        """
+        Updates the navigation drawer and open chats with the result of sync_chats.
+        :param new:
+        :param changed:
+        :param removed:
+        :return: None
+        """
+        titles = self.chat_cache.chat_titles(self.cache_email)
+        for chat_key in new:
+            if chat_key not in self.sessions_by_key:
+                self.add_synced_chat(chat_key, titles.get(chat_key, ""))
+
+        for chat_key in changed:
+            session = self.sessions_by_key.get(chat_key)
+            if session is None:
+                continue
+            self.set_chat_title(session, titles.get(chat_key, session.list_item.text))
+            if session.loaded:
+                self.update_chat(session)
+
+        for chat_key in removed:
+            self.remove_synced_chat(chat_key)
+
+    def add_synced_chat(self, chat_key: str, title: str):
+        """
+        Lists a chat that was created on another device, keeping a "New Chat" item at the end.
+        :param chat_key:
+        :param title:
+        :return: None
+        """
+        trailing = self.new_chat_session()
+        current = trailing is self.session
+
+        if trailing.chat_layout.ids.chat_view.data:
+            trailing = self.append_chat_item()
+            current = False
+
+        self.assign_chat_item(trailing, chat_key, title)
+        session = self.append_chat_item()
+        if current:
+            self.switch_session(session.list_item)
+
+    def load_chat(self, session: ChatSession):
+        """
+        Loads the newest messages of a chat from the local cache, or from the firebase database if they are not
+        cached.
+        :param session:
+        :return: None
+        """
+        cached = self.chat_cache.messages(self.cache_email, session.chat_key)
+        if cached is not None:
+            self.on_chat_messages_loaded(session, *cached)
+            return
+
+        self.worker.submit(
+            self.load_chat_messages(session.chat_key),
+            on_success=lambda loaded: self.on_chat_messages_loaded(session, *loaded),
+            on_error=lambda error: self.dialog_open("Error", f"{error}", "Retry"),
+        )
+
+    async def load_chat_messages(self, chat_key: str):
+        """
+        Returns the newest messages of one chat. Only the newest page is downloaded; the cached pairs before it are
+        kept when the page follows on from them. Runs on the worker loop.
+        :param chat_key:
+        :return: tuple[int, list[tuple[str, str]]]: index of the first pair and the pairs
+        """
+        email = self.cache_email
+        cached_start, cached = await asyncio.to_thread(self.chat_cache.messages, email, chat_key, True) or (1, [])
+        start, pairs = await asyncio.to_thread(fetch_message_page, get_firebase().database(), email, chat_key)
+        self.count_request("messages.get")
+        await asyncio.to_thread(self.chat_cache.append_messages, email, chat_key, start, pairs)
+
+        if not pairs:
+            return cached_start, cached
+        if cached and cached_start <= start <= cached_start + len(cached):
+            return cached_start, cached[:start - cached_start] + pairs
+        return start, pairs
+
+    async def fetch_new_pairs(self, chat_key: str, start: int):
+        """
+        Downloads the prompt and answer pairs of a chat from the given index on and stores them in the local cache.
+        Runs on the worker loop.
+        :param chat_key:
+        :param start: Index of the first pair, starting from 1
+        :return: list[tuple[str, str]]
+        """
+        email = self.cache_email
+        pairs = await asyncio.to_thread(fetch_messages, get_firebase().database(), email, chat_key, start)
+        self.count_request("messages.get")
+        await asyncio.to_thread(self.chat_cache.append_messages, email, chat_key, start, pairs)
+        return pairs
+
+    async def fetch_older_pairs(self, chat_key: str, end: int):
+        """
+        Downloads the page of prompt and answer pairs of a chat before the given index and stores it in the local
+        cache. Runs on the worker loop.
+        :param chat_key:
+        :param end: Index after the last pair
+        :return: list[tuple[str, str]]
+        """
+        email = self.cache_email
+        start, pairs = await asyncio.to_thread(fetch_message_page, get_firebase().database(), email, chat_key, end)
+        self.count_request("messages.get")
+        await asyncio.to_thread(self.chat_cache.insert_messages, email, chat_key, start, pairs)
+        return pairs
+
+    def update_chat(self, session: ChatSession):
+        """
+        Downloads and shows the pairs that were added to a loaded chat on another device.
+        :param session:
+        :return: None
+        """
+        start = session.pair_count + 1
+        self.worker.submit(
+            self.fetch_new_pairs(session.chat_key, start),
+            on_success=lambda pairs: self.on_new_pairs_loaded(session, start, pairs),
+            on_error=lambda error: logging.error("Chat update failed: %s", error),
+        )
+
+    def on_new_pairs_loaded(self, session: ChatSession, start: int, pairs: list):
+        """
+        Shows the downloaded pairs that the chat does not have yet.
+        :param session:
+        :param start: Index of the first downloaded pair
+        :param pairs:
+        :return: None
+        """
+        if session.loaded and self.sessions.get(session.chat_id) is session:
+            self.append_pairs(session, pairs[session.pair_count + 1 - start:])
+
+    def on_chat_messages_loaded(self, session: ChatSession, start: int, pairs: list):
+        """
+        Stores the loaded messages in the session and renders the newest page of them.
+        :param session:
+        :param start: Index of the first loaded pair
+        :param pairs:
+        :return: None
+        """
+        if session.loaded or self.sessions.get(session.chat_id) is not session:
+            return
+        session.pairs = list(pairs)
+        session.first_pair = start
+        session.older_pairs = []
+        session.loaded = True
+        session.rendered_pairs = 0
+        self.render_history_page(session)
+
+    def render_history_page(self, session: ChatSession):
+        """
+        Adds the next HISTORY_PAGE_SIZE older prompt and answer pairs at the top of the chat layout. Once every loaded
+        pair is shown, the page before them is loaded from the local cache or the firebase database.
+        :param session:
+        :return: None
+        """
+        loaded = len(session.older_pairs) + len(session.pairs)
+        if session.rendered_pairs >= loaded:
+            if session.history_start > 1:
+                self.load_older_pairs(session)
+            return
+
+        pairs = session.older_pairs + session.pairs
+        chat_layout = session.chat_layout
+        end = loaded - session.rendered_pairs
+        start = max(0, end - HISTORY_PAGE_SIZE)
+        records = []
+        for prompt, answer in pairs[start:end]:
+            records.append(chat_layout.make_record("user", prompt))
+            records.append(chat_layout.make_record("assistant", answer))
+        chat_layout.prepend_messages(records)
+        session.rendered_pairs = loaded - start
+
+    def load_older_pairs(self, session: ChatSession):
+        """
+        Loads the CHAT_DOWNLOAD_PAGE_SIZE pairs before the oldest loaded pair of a chat and shows their newest page.
+        :param session:
+        :return: None
+        """
+        if session.history_loading:
+            return
+        end = session.history_start
+        pairs = self.chat_cache.older_messages(self.cache_email, session.chat_key, end, CHAT_DOWNLOAD_PAGE_SIZE)
+        if pairs:
+            self.on_older_pairs_loaded(session, end, pairs)
+            return
+
+        def on_error(error: Exception):
+            session.history_loading = False
+            logging.error("Chat history could not be loaded: %s", error)
+
+        session.history_loading = True
+        self.worker.submit(
+            self.fetch_older_pairs(session.chat_key, end),
+            on_success=lambda loaded: self.on_older_pairs_loaded(session, end, loaded),
+            on_error=on_error,
+        )
+
+    def on_older_pairs_loaded(self, session: ChatSession, end: int, pairs: list):
+        """
+        Adds the pairs before the oldest loaded pair of a chat and shows their newest page.
+        :param session:
+        :param end: Index after the last of the pairs
+        :param pairs:
+        :return: None
+        """
+        session.history_loading = False
+        if not pairs or session.history_start != end or self.sessions.get(session.chat_id) is not session:
             return
+        session.older_pairs[:0] = pairs
+        self.render_history_page(session)
+
+    def on_chat_scroll(self, chat_layout, scroll_y: float):
+        """
+        Loads an older page of the chat when the user scrolls to the top.
+        :param chat_layout:
+        :param scroll_y:
+        :return: None
+        """
+        session = self.sessions.get(chat_layout.chat_id)
+        if scroll_y >= 1 and session is not None:
+            self.render_history_page(session)
 
     def delete_chat_log(self, obj):
         """
@@ -889,118 +4101,246 @@ class MainApp(MDApp):
 
         self.delete_dialog_open("Warning", "Do you really want to delete this chat?", "OK", "Cancel")
 
-        Clock.schedule_interval(lambda dt: self.check_delete_confirmation(obj), 0.1)
+        self.cancel_delete_confirmation()
+        self.delete_confirmation_event = Clock.schedule_interval(lambda dt: self.check_delete_confirmation(obj), 0.1)
 
         self.delete_confirmation = None
 
     def send_message(self):
         """
-        Sends message.
+        Sends message. While the chat is waiting for a reply the message is queued, and a message that is already
+        waiting or being answered is not sent again.
         :return: None
         """
         text_field = self.send_layout.ids.text_field
         message_text = text_field.text.strip()
 
-        if message_text != "":
-            cb_parent = ChatBubble(pos_hint={"right": 1}, halign="right", btype="m")
-            cb_relative = cb_parent.children[0]
-            cb_relative.remove_widget(cb_relative.children[0])
-            cb_label = cb_parent.ids.chat_bubble_text
-            cb_label.text = message_text
-            chat_children = self.chat_layout.children[0].children[0]
-            chat_children.add_widget(cb_parent)
-            self.cb_label = cb_label
-            self.clear_text(text_field)
-            response_task = asyncio.ensure_future(self.get_response(INSTRUCTIONS, self.prev_q_a, message_text))
-            self.response = asyncio.get_event_loop().run_until_complete(asyncio.gather(response_task))[-1]
-
-            if len(self.prev_q_a) == 0:
-                self.title = self.generate_title(message_text, self.response)
-
-            self.completion(message_text)
-            self.show_response()
-            self.save_chat_log(self.title)
+        session = self.session
+        if not session.loaded:
+            self.dialog_open("Loading", "Chat history is still loading.", "OK")
+        elif message_text != "":
+            if self.queue_message(session, message_text):
+                self.clear_text(text_field)
         else:
             self.dialog_open("Blank Prompt", "Input a valid prompt.", "Retry")
             return
 
-    def show_response(self):
+    def queue_message(self, session: ChatSession, prompt: str, request=None):
         """
-        Shows response.
-        :return: None
+        Shows the prompt in the chat and sends it, or queues it while the chat is waiting for a reply. A prompt that
+        is already waiting or being answered is not sent again. The cached chats are shown before the stored user is
+        logged in, but their pairs can only be saved after it.
+        :param session:
+        :param prompt:
+        :param request: Coroutine function that returns the reply, the reply is generated from the chat if None
+        :return: bool: False if the prompt can not be sent before the login completes
         """
-        if self.response:
-            if len(self.response) > 200:
-                cb_parent = ChatBubble(pos_hint={"left": 1}, halign="left", btype="r")
-                self.cb_box = cb_parent.children[0].children[0]
-                cb_parent.full_text = self.response
-                cb_label = cb_parent.ids.chat_bubble_text
-                cb_label.text = self.response[:200] + "..."
+        if not self.login_check:
+            self.dialog_open("Logging In", "Messages can be sent once you are logged in.", "OK")
+            return False
+        if prompt == session.in_flight or any(prompt == queued for queued, _ in session.queue):
+            return True
+
+        session.chat_layout.add_message("user", prompt)
+        if session.in_flight is None:
+            self.start_message(session, prompt, request)
+        else:
+            session.queue.append((prompt, request))
+            session.chat_layout.scroll_to_bottom()
+        return True
 
-                self.read_more_button = MDFlatButton(
-                    text="Read \nmore",
-                    pos_hint={"bottom": 0.0, "right": 1.0},
-                    font_size="12sp",
-                    on_release=self.read_more_expand,
-                )
+    def start_message(self, session: ChatSession, prompt: str, request=None):
+        """
+        Adds the pending answer of the prompt to the chat it was sent in and requests the reply.
+        :param session:
+        :param prompt:
+        :param request: See queue_message
+        :return: None
+        """
+        session.in_flight = prompt
+        chat_layout = session.chat_layout
+        message_id = chat_layout.add_message("assistant", "")
+        chat_layout.scroll_to_bottom()
+
+        end = len(session.pairs)
+        if request is None:
+            renderer = StreamRenderer(chat_layout, message_id) if STREAM_RESPONSES else None
+            reply = self.process_message(prompt, session.pairs, end, renderer, session.context)
+        else:
+            renderer = None
+            reply = request()
+        session.renderer = renderer
+        session.reply = self.worker.submit(
+            reply,
+            on_success=lambda response: self.on_message_processed(
+                prompt, session, message_id, response, end == 0 and session.first_pair == 1, renderer=renderer
+            ),
+            on_error=lambda error: self.on_message_failed(session, message_id, error, renderer=renderer),
+        )
 
-                self.cb_box.add_widget(self.read_more_button)
-                chat_children = self.chat_layout.children[0].children[0]
-                chat_children.add_widget(cb_parent)
-                self.cb_label = cb_label
-            else:
-                cb_parent = ChatBubble(pos_hint={"left": 1}, halign="left", btype="r")
-                cb_parent.full_text = self.response
-                cb_label = cb_parent.ids.chat_bubble_text
-                cb_label.text = self.response
-                chat_children = self.chat_layout.children[0].children[0]
-                chat_children.add_widget(cb_parent)
-                self.cb_label = cb_label
+    def send_next_message(self, session: ChatSession):
+        """
+        Sends the next queued prompt of the chat once the previous one is answered.
+        :param session:
+        :return: None
+        """
+        session.in_flight = None
+        session.reply = None
+        session.renderer = None
+        if session.queue and self.sessions.get(session.chat_id) is session:
+            self.start_message(session, *session.queue.popleft())
 
     @staticmethod
-    def read_more_expand(obj):
+    def cancel_messages(session: ChatSession):
         """
-        Expands the chat bubble.
-        :param obj:
+        Drops the queued prompts of a deleted chat and cancels the reply in flight.
+        :param session:
         :return: None
         """
-        obj.parent.parent.children[1].children[0].text = obj.parent.parent.parent.full_text
-        obj.parent.remove_widget(obj)
-
-    def add_new_chat(self):
+        session.queue.clear()
+        if session.reply is not None:
+            session.reply.cancel()
+        if session.renderer is not None:
+            session.renderer.event.cancel()
+        session.in_flight = None
+        session.reply = None
+        session.renderer = None
+
+    def on_message_processed(self, prompt: str, session: ChatSession, message_id: int, response: str,
+                             first_message: bool, renderer=None):
         """
-        Creates new chat.
+        Applies the result of process_message on the main thread and saves the pair. A new chat gets its chat id
+        with the first pair, its title is generated in the background after the reply is shown. The reply of a chat
+        that was deleted in the meantime is dropped.
+        :param prompt:
+        :param session:
+        :param message_id: Id of the pending answer message
+        :param response:
+        :param first_message:
+        :param renderer:
         :return: None
         """
-        item = self.nav_drawer.ids[f"item_{self.chat_count}"]
-
-        if not item.text == "New Chat":
-            md_list = self.nav_drawer.ids.chat_list
-            list_item = OneLineAvatarIconListItem(
-                text="New Chat",
-                _txt_left_pad=dp(8),
-                on_release=self.switch_session,
-                fake_id=self.chat_count + 1,
-                theme_text_color="Custom",
-                text_color="black" if self.theme_cls.theme_style == "Light" else "white",
+        if self.sessions.get(session.chat_id) is not session:
+            if renderer is not None:
+                renderer.event.cancel()
+            return
+        if renderer is not None:
+            renderer.finish()
+        index = self.completion(prompt, response, session)
+        pair = session.pairs[-1]
+        session.rendered_pairs += 1
+        self.show_response(response, session.chat_layout, message_id)
+
+        if CONTEXT_SUMMARY_ENABLED and session.context.pending_summary() is not None:
+            self.worker.submit(self.summarize_context(session.context, session.pairs))
+
+        if session.chat_key is None:
+            self.set_chat_key(session, new_chat_id())
+        self.save_chat(session, self.save_chat_log(session.chat_key, session.list_item.text, index, pair))
+        if first_message:
+            self.worker.submit(
+                self.generate_title(prompt, response),
+                on_success=lambda title: self.on_title_generated(session, title),
+                on_error=lambda error: self.on_title_failed(session, prompt, error),
             )
-            md_list.add_widget(list_item)
-            self.chat_count += 1
-            self.nav_drawer.ids[f"item_{self.chat_count}"] = list_item
+        self.send_next_message(session)
 
-            chat_id = self.chat_layout.chat_id + 1
-            chat_layout = ChatLayout(chat_id=chat_id)
+    def on_title_generated(self, session: ChatSession, title: str):
+        """
+        Shows the generated title and saves it with the chat, unless the chat was deleted in the meantime.
+        :param session:
+        :param title:
+        :return: None
+        """
+        if self.sessions.get(session.chat_id) is not session:
+            return
+        self.set_chat_title(session, title)
+        self.save_chat(session, self.save_chat_title(session.chat_key, title))
 
-            self.chat_layouts.append(chat_layout)
+    def on_title_failed(self, session: ChatSession, prompt: str, error):
+        """
+        Titles the chat with the start of its first prompt when no title could be generated.
+        :param session:
+        :param prompt:
+        :param error:
+        :return: None
+        """
+        logging.warning("Title generation failed: %s", error)
+        self.on_title_generated(session, self.prompt_title(prompt))
 
-            self.home_screen.remove_widget(self.chat_layout)
-            self.home_screen.add_widget(chat_layout, index=2)
+    @staticmethod
+    def prompt_title(prompt: str, words: int = 5):
+        """
+        Returns the first words of a prompt as a chat title.
+        :param prompt:
+        :param words:
+        :return: str
+        """
+        parts = prompt.split()
+        title = " ".join(parts[:words])
+        return f"{title}..." if len(parts) > words else title
 
-            self.chat_layout = chat_layout
-            self.prev_q_a = []
+    def on_message_failed(self, session: ChatSession, message_id: int, error, renderer=None):
+        """
+        Removes the pending answer and shows the error of a failed message.
+        :param session:
+        :param message_id:
+        :param error:
+        :param renderer:
+        :return: None
+        """
+        if renderer is not None:
+            renderer.event.cancel()
+        if self.sessions.get(session.chat_id) is not session:
+            return
+        session.chat_layout.remove_message(message_id)
+        e = str(error).removeprefix("[").removesuffix("]").replace("'", "")
+        self.dialog_open("Error", e, "Retry")
+        self.send_next_message(session)
 
+    def show_response(self, response: str, chat_layout, message_id: int):
+        """
+        Shows response in the pending answer message.
+        :param response:
+        :param chat_layout:
+        :param message_id:
+        :return: None
+        """
+        if response:
+            chat_layout.update_message(message_id, text=response, streaming=False)
         else:
-            return
+            chat_layout.remove_message(message_id)
+
+    def on_message_item_press(self, bubble, ref: str):
+        """
+        Asks about a tapped list item of an answer in the chat the answer belongs to.
+        :param bubble: ChatBubble of the answer
+        :param ref: Segment index of the item
+        :return: None
+        """
+        kind, item, _ = MessageModel.get(bubble.full_text, bubble.streaming).segments[int(ref)]
+        session = self.sessions.get(bubble.chat_view.parent.chat_id)
+        if kind == "item" and session is not None and session.loaded:
+            self.queue_message(session, FOLLOW_UP_PROMPT.format(item=item.replace("**", "").rstrip(".:")))
+
+    @staticmethod
+    def read_more_expand(obj):
+        """
+        Expands the chat bubble.
+        :param obj:
+        :return: None
+        """
+        record = obj.chat_view.data[obj.index]
+        obj.chat_view.parent.update_message(record["uid"], expanded=True)
+
+    def add_new_chat(self):
+        """
+        Creates new chat.
+        :return: None
+        """
+        session = self.new_chat_session()
+        if session is not self.session:
+            self.switch_session(session.list_item)
 
     def switch_session(self, obj):
         """
@@ -1008,29 +4348,26 @@ class MainApp(MDApp):
         :param obj:
         :return: None
         """
-        id_dict = self.nav_drawer.ids
-        item_id = list(id_dict.keys())[list(id_dict.values()).index(obj)]
-        item = id_dict[f"{item_id}"]
-        chat_id = int(item_id.split("_")[1])
-        chat_layout = self.chat_layouts[chat_id]
+        session = self.sessions_by_item[obj]
+        chat_layout = session.chat_layout
 
+        if self.chat_layout is not None and self.chat_layout is not chat_layout \
+                and self.chat_layout.parent is not None:
+            self.chat_layout.parent.remove_widget(self.chat_layout)
         if chat_layout.parent is not None:
             chat_layout.parent.remove_widget(chat_layout)
 
         self.home_screen.add_widget(chat_layout, index=2)
         self.chat_layout = chat_layout
+        self.session = session
 
-        for session_item_id, prev_q_a in self.chat_sessions:
-            if session_item_id == item_id:
-                self.prev_q_a = prev_q_a
-                break
-        else:
-            self.prev_q_a = []
-
-        self.title = item.text
+        self.title = obj.text
         self.clear_text(self.send_layout.ids.text_field)
         self.nav_drawer.ids.nav_drawer.set_state("closed")
 
+        if not session.loaded:
+            self.load_chat(session)
+
     @staticmethod
     def replace_str(string: str, type_of: str):
         """
@@ -1055,7 +4392,10 @@ class MainApp(MDApp):
                                 "Do you really want to delete this account? This action is irreversible.",
                                 "OK", "Cancel")
 
-        Clock.schedule_interval(lambda dt: self.check_delete_confirmation(obj, delete_what="account"), 0.1)
+        self.cancel_delete_confirmation()
+        self.delete_confirmation_event = Clock.schedule_interval(
+            lambda dt: self.check_delete_confirmation(obj, delete_what="account"), 0.1
+        )
 
         self.delete_confirmation = None
 
@@ -0,0 +1,148 @@
+"""
+Runs MainApp headlessly against the fakes in tests/fakes.py. Kivy is configured for an offscreen window before it is
+imported, and the Clock is ticked by the tests instead of App.run.
+"""
+import asyncio
+import os
+import time
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+os.environ.setdefault("KIVY_NO_FILELOG", "1")
+os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+
+from kivy.config import Config  # noqa: E402
+
+Config.set("graphics", "maxfps", "0")  # Clock.tick returns at once instead of waiting for the next frame
+
+import pytest  # noqa: E402
+from kivy.clock import Clock  # noqa: E402
+from kivy.lang import global_idmap  # noqa: E402
+from kivy.resources import resource_add_path  # noqa: E402
+from kivy.uix.recycleview import views as recycleview_views  # noqa: E402
+
+import main  # noqa: E402
+from tests import fakes  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+resource_add_path(ROOT)  # The kv files are loaded by relative path
+
+EMAIL = "user@example.com"
+DB_EMAIL = "user@example-dot-com"
+
+
+def wait_for(predicate, timeout: float = 5):
+    """
+    Ticks the Clock until predicate returns true, so worker callbacks run on this thread.
+    :param predicate:
+    :param timeout:
+    :return: Any: the result of predicate
+    """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        Clock.tick()
+        result = predicate()
+        if result:
+            return result
+    raise TimeoutError("Condition not met within %.1fs" % timeout)
+
+
+def run(app, coro, timeout: float = 30):
+    """
+    Runs a coroutine on the worker loop of the app and returns its result.
+    :param app:
+    :param coro:
+    :param timeout:
+    :return: Any
+    """
+    return asyncio.run_coroutine_threadsafe(coro, app.worker.loop).result(timeout)
+
+
+async def drain_worker():
+    """
+    Waits for the other tasks of the worker loop and the threads they started. Runs on the worker loop.
+    :return: None
+    """
+    current = asyncio.current_task()
+    while tasks := [task for task in asyncio.all_tasks() if task is not current]:
+        await asyncio.wait(tasks)
+    await asyncio.get_running_loop().shutdown_default_executor()
+
+
+@pytest.fixture
+def firebase():
+    client = fakes.FakeFirebase({"users": {DB_EMAIL: {"email": EMAIL, "username": "user", "password": "password"}}})
+    main.register_service("firebase", client)
+    main.register_service("admin_auth", fakes.FakeAdminAuth())
+    yield client
+    main._services.clear()
+
+
+@pytest.fixture
+def openai_client():
+    client = fakes.FakeOpenAI()
+    main.register_service("openai", client)
+    yield client
+    main._services.pop("openai", None)
+
+
+@pytest.fixture
+def app(firebase, openai_client, tmp_path, monkeypatch):
+    """
+    A MainApp that is logged in as EMAIL but not built. settings.json and chats.db are written to tmp_path.
+    """
+    monkeypatch.chdir(tmp_path)
+    main_app = main.MainApp()
+    # Clock events of earlier apps, like the scroll effect of a chat, may have pointed the app of kv rules at a
+    # stopped app again
+    object.__setattr__(global_idmap["app"], "_obj", None)
+    main_app.user = {"email": EMAIL, "idToken": "id-token"}
+    main_app.login_check = True
+    main_app.cache_email = DB_EMAIL
+    yield main_app
+    # Clock events that outlive the test would write settings.json and chats.db to the next working directory
+    main_app.cancel_login_retry()
+    main_app.stop_chat_stream()
+    run(main_app, drain_worker())  # The chat cache is closed below, so writes still running must finish first
+    Clock.tick()  # Delivers the results of the drained tasks, on_stop cancels what they scheduled
+    main_app.dispatch("on_stop")  # Also releases the app that kv rules refer to as app
+    main_app.chat_cache.connection.close()
+
+
+def render_frames(count: int = 2):
+    """
+    Draws count frames of the offscreen window.
+    :param count:
+    :return: None
+    """
+    from kivy.base import EventLoop
+
+    for _ in range(count):
+        EventLoop.idle()
+
+
+@pytest.fixture
+def ui_app(app):
+    """
+    The app fixture built and shown in an offscreen window, on the home screen with the settings screen loaded.
+    """
+    from kivy.base import EventLoop
+    from kivy.lang import Builder
+
+    EventLoop.ensure_window()
+    window = EventLoop.window
+    app.root = app.build()
+    app.ensure_screen("home")
+    app.ensure_screen("settings")
+    app.switch_screen("home")
+    window.add_widget(app.root)
+    render_frames()
+    # RecycleViews share recycled views per view class. Those of earlier tests are bound to their app's palette and
+    # are cached until the frames above ran their pending refreshes.
+    recycleview_views._cached_views.clear()
+    recycleview_views._cache_count = 0
+    yield app
+    for widget in list(window.children):  # The root and any dialog left open
+        window.remove_widget(widget)
+    for path in app.kv_timings:
+        Builder.unload_file(path)
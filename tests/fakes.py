@@ -0,0 +1,331 @@
+"""
+In-memory stand-ins for the Firebase and OpenAI clients, registered with main.register_service. Every request
+sleeps for a configurable latency and is counted per method, so tests and benchmarks can check both.
+"""
+import asyncio
+import base64
+import collections
+import copy
+import hashlib
+import json
+import re
+import threading
+import time
+import types
+
+import main
+
+
+class FakeResponse:
+    def __init__(self, value):
+        self.value = value
+
+    def val(self):
+        return self.value
+
+
+class FakeTree:
+    """
+    The JSON tree of a fake Realtime Database, shared by every FakeDatabase handle of a FakeFirebase.
+    """
+
+    def __init__(self, data=None, latency: float = 0):
+        self.root = copy.deepcopy(data) if data else {}
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.requests = collections.Counter()
+
+    def request(self, name: str):
+        self.requests[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def node(self, parts: list):
+        node = self.root
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def put(self, parts: list, value):
+        if not parts:
+            self.root = copy.deepcopy(value) if value else {}
+            return
+        node = self.root
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = copy.deepcopy(value)
+
+
+class FakeDatabase:
+    """
+    pyrebase Database over a FakeTree. Like pyrebase, the query is kept on the handle until the next request.
+    """
+
+    def __init__(self, tree: FakeTree):
+        self.tree = tree
+        self.path = ""
+        self.query = {}
+
+    def child(self, *args):
+        self.path = "/".join([self.path] + [str(arg) for arg in args]).strip("/")
+        return self
+
+    def shallow(self):
+        self.query["shallow"] = True
+        return self
+
+    def order_by_key(self):
+        self.query["order_by"] = "$key"
+        return self
+
+    def start_at(self, value):
+        self.query["start_at"] = value
+        return self
+
+    def end_at(self, value):
+        self.query["end_at"] = value
+        return self
+
+    def limit_to_first(self, count: int):
+        self.query["limit_to_first"] = count
+        return self
+
+    def limit_to_last(self, count: int):
+        self.query["limit_to_last"] = count
+        return self
+
+    def take(self):
+        parts, query = [part for part in self.path.split("/") if part], self.query
+        self.path, self.query = "", {}
+        return parts, query
+
+    def get(self, token=None):
+        parts, query = self.take()
+        self.tree.request("db.get")
+        with self.tree.lock:
+            value = self.tree.node(parts)
+            if not isinstance(value, dict) or not query:
+                return FakeResponse(copy.deepcopy(value))
+            if query.get("shallow"):
+                return FakeResponse({key: True for key in value}.keys())  # pyrebase returns dict_keys
+
+            keys = sorted(value)
+            if "start_at" in query:
+                keys = [key for key in keys if key >= query["start_at"]]
+            if "end_at" in query:
+                keys = [key for key in keys if key <= query["end_at"]]
+            if "limit_to_first" in query:
+                keys = keys[:query["limit_to_first"]]
+            if "limit_to_last" in query:
+                keys = keys[-query["limit_to_last"]:]
+            items = [(key, copy.deepcopy(value[key])) for key in keys]
+        return FakeResponse(collections.OrderedDict(items) if items else None)
+
+    @staticmethod
+    def etag(value):
+        """
+        Returns the ETag of a value like the Realtime Database does, the base64 encoded SHA-1 of its JSON.
+        :param value:
+        :return: str
+        """
+        return base64.b64encode(hashlib.sha1(json.dumps(value, sort_keys=True).encode()).digest()).decode()
+
+    def get_etag(self, token=None):
+        parts, _ = self.take()
+        self.tree.request("db.get_etag")
+        with self.tree.lock:
+            return self.etag(self.tree.node(parts))
+
+    def conditional_set(self, data, etag: str, token=None):
+        parts, _ = self.take()
+        self.tree.request("db.conditional_set")
+        with self.tree.lock:
+            current = self.etag(self.tree.node(parts))
+            if current != etag:
+                return {"ETag": current}
+            self.tree.put(parts, data)
+        return data
+
+    def set(self, data, token=None):
+        parts, _ = self.take()
+        self.tree.request("db.set")
+        with self.tree.lock:
+            self.tree.put(parts, data)
+        return data
+
+    def update(self, data: dict, token=None):
+        parts, _ = self.take()
+        self.tree.request("db.update")
+        with self.tree.lock:
+            for path, value in data.items():
+                self.tree.put(parts + [part for part in path.split("/") if part], value)
+        return data
+
+    def remove(self, token=None):
+        parts, _ = self.take()
+        self.tree.request("db.remove")
+        with self.tree.lock:
+            self.tree.put(parts, None)
+
+    def stream(self, handler, token=None, stream_id=None):
+        self.take()
+        return types.SimpleNamespace(close=lambda: None)
+
+
+class FakeAuth:
+    """
+    pyrebase Auth that signs in every email with any password.
+    """
+
+    def __init__(self, tree: FakeTree):
+        self.tree = tree
+
+    def sign_in_with_email_and_password(self, email: str, password: str):
+        self.tree.request("auth.sign_in")
+        return {"email": email, "idToken": "id-token", "refreshToken": "refresh-token", "localId": email,
+                "expiresIn": "3600"}
+
+    def refresh(self, refresh_token: str):
+        self.tree.request("auth.refresh")
+        return {"idToken": "id-token", "refreshToken": refresh_token, "userId": "user"}
+
+    def get_account_info(self, id_token: str):
+        self.tree.request("auth.get_account_info")
+        return {"users": [{"email": "user@example.com"}]}
+
+    def create_user_with_email_and_password(self, email: str, password: str):
+        self.tree.request("auth.create_user")
+        return {"email": email, "idToken": "id-token"}
+
+    def send_email_verification(self, id_token: str):
+        self.tree.request("auth.send_email_verification")
+
+    def delete_user_account(self, id_token: str):
+        self.tree.request("auth.delete_user_account")
+
+
+class FakeFirebase:
+    """
+    pyrebase app whose auth and database clients share one FakeTree.
+    """
+
+    def __init__(self, data=None, latency: float = 0):
+        self.tree = FakeTree(data, latency)
+
+    def auth(self):
+        return FakeAuth(self.tree)
+
+    def database(self):
+        return FakeDatabase(self.tree)
+
+
+class EmailAlreadyExistsError(Exception):
+    pass
+
+
+class UidAlreadyExistsError(Exception):
+    pass
+
+
+class FakeAdminAuth:
+    """
+    firebase_admin.auth with every email verified.
+    """
+    EmailAlreadyExistsError = EmailAlreadyExistsError
+    UidAlreadyExistsError = UidAlreadyExistsError
+
+    @staticmethod
+    def get_user_by_email(email: str):
+        return types.SimpleNamespace(email=email, email_verified=True)
+
+    @staticmethod
+    def verify_id_token(id_token: str, check_revoked: bool = False):
+        return {"email": "user@example.com", "email_verified": True, "exp": time.time() + 3600}
+
+
+class FakeOpenAI:
+    """
+    openai module answering every prompt with reply. Requests wait latency seconds, streamed replies send one word
+    and its trailing whitespace per token_delay seconds. flagged prompts fail moderation.
+    """
+
+    def __init__(self, reply: str = "word " * 50, latency: float = 0, token_delay: float = 0, flagged=()):
+        self.reply = reply
+        self.latency = latency
+        self.token_delay = token_delay
+        self.flagged = set(flagged)
+        self.requests = collections.Counter()
+        self.first_token_at = None
+        self.ChatCompletion = types.SimpleNamespace(acreate=self.create_completion)
+        self.Moderation = types.SimpleNamespace(acreate=self.create_moderation)
+
+    async def create_completion(self, messages: list, stream: bool = False, **kwargs):
+        self.requests["openai.completion"] += 1
+        await asyncio.sleep(self.latency)
+        if not stream:
+            message = types.SimpleNamespace(content=self.reply)
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+        return self.stream_completion()
+
+    async def stream_completion(self):
+        for token in re.findall(r"\s*\S+\s*|\s+", self.reply):
+            await asyncio.sleep(self.token_delay)
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta={"content": token})])
+
+    async def create_moderation(self, input: str):
+        self.requests["openai.moderation"] += 1
+        await asyncio.sleep(self.latency)
+        flagged = input in self.flagged
+        categories = collections.defaultdict(lambda: flagged)
+        return types.SimpleNamespace(results=[types.SimpleNamespace(flagged=flagged, categories=categories)])
+
+
+def chat_history(count: int, answer: str = "An answer with a few words. " * 4):
+    """
+    Returns count generated prompt and answer pairs.
+    :param count:
+    :param answer:
+    :return: list[tuple[str, str]]
+    """
+    return [(f"Question {index}?", f"{answer}{index}") for index in range(1, count + 1)]
+
+
+def chat_records(email: str, chats: dict, updated_at: float = 1):
+    """
+    Returns the conversations and messages nodes of a user with the given chats, in the current chat schema.
+    :param email: Database form of the email
+    :param chats: Prompt and answer pairs per chat key
+    :param updated_at:
+    :return: dict
+    """
+    conversations, messages = {}, {}
+    for chat_key, pairs in chats.items():
+        conversations[chat_key] = main.chat_meta(f"Chat {chat_key}", updated_at, updated_at, len(pairs))
+        messages[chat_key] = {
+            main.pair_key(index): main.message_record(pair, updated_at) for index, pair in enumerate(pairs, 1)
+        }
+    return {"conversations": {email: conversations}, "messages": {email: messages}}
+
+
+def user_records(count: int):
+    """
+    Returns the users and usernames nodes of count generated users.
+    :param count:
+    :return: dict
+    """
+    users = {
+        f"user{index}@example-dot-com": {"email": f"user{index}@example.com", "username": f"user{index}",
+                                         "password": "password"}
+        for index in range(count)
+    }
+    usernames = {record["username"]: key for key, record in users.items()}
+    return {"users": users, "usernames": usernames}
@@ -0,0 +1,146 @@
+"""
+Benchmarks of the chat pipeline against the in-memory backends, over histories of 10, 1k and 10k messages. Every
+backend request waits BACKEND_LATENCY. The backend requests and the peak memory of one call are stored in the
+extra_info of each benchmark, e.g. pytest tests/test_benchmarks.py --benchmark-json=benchmarks.json
+"""
+import itertools
+import tracemalloc
+
+import pytest
+
+import main
+from tests import fakes
+from tests.conftest import DB_EMAIL, render_frames, run, wait_for
+
+pytest.importorskip("pytest_benchmark")
+
+HISTORY_SIZES = (10, 1000, 10000)  # Messages, a prompt and its answer are two
+BACKEND_LATENCY = 0.001  # Seconds every fake Firebase and OpenAI request takes
+ROUNDS = 5
+CHAT_KEY = "0000000000000000aaaa"
+
+
+@pytest.fixture
+def backends(firebase, openai_client):
+    firebase.tree.latency = BACKEND_LATENCY
+    openai_client.latency = BACKEND_LATENCY
+    return firebase, openai_client
+
+
+def report(benchmark, backends, target, setup=None):
+    """
+    Calls target once outside the timed rounds and stores its backend requests and peak memory in extra_info.
+    :param benchmark:
+    :param backends: The firebase and openai fakes
+    :param target:
+    :param setup: Returns the arguments of target, like the setup of benchmark.pedantic
+    :return: None
+    """
+    firebase, openai_client = backends
+    args, kwargs = setup() if setup is not None else ((), {})
+    db_requests, openai_requests = firebase.tree.requests.copy(), openai_client.requests.copy()
+    tracemalloc.start()
+    try:
+        target(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    requests = (firebase.tree.requests - db_requests) + (openai_client.requests - openai_requests)
+    benchmark.extra_info["requests"] = dict(requests)
+    benchmark.extra_info["peak_memory"] = peak
+
+
+@pytest.mark.parametrize("messages", HISTORY_SIZES)
+def test_send_message(benchmark, app, backends, messages):
+    benchmark.group = "send_message"
+    pairs = fakes.chat_history(messages // 2)
+    context = main.ContextBuilder()
+
+    def send():
+        return run(app, app.process_message("What should I cook tonight?", pairs, len(pairs), context=context))
+
+    report(benchmark, backends, send)
+    assert benchmark.pedantic(send, rounds=ROUNDS)
+
+
+@pytest.mark.parametrize("messages", HISTORY_SIZES)
+def test_get_chat_log(benchmark, app, backends, messages):
+    benchmark.group = "get_chat_log"
+    firebase, _ = backends
+    chats = {f"{index:016x}aaaa": fakes.chat_history(5) for index in range(max(1, messages // 10))}
+    firebase.tree.root.update(fakes.chat_records(DB_EMAIL, chats))
+
+    def setup():
+        app.chat_cache.clear(DB_EMAIL)
+        return (), {}
+
+    def sync():
+        return run(app, app.sync_chats(DB_EMAIL))
+
+    report(benchmark, backends, sync, setup)
+    new, changed, removed = benchmark.pedantic(sync, setup=setup, rounds=ROUNDS)
+    assert len(new) == len(chats)
+
+
+@pytest.mark.parametrize("messages", HISTORY_SIZES)
+def test_save_chat_log(benchmark, app, backends, messages):
+    benchmark.group = "save_chat_log"
+    firebase, _ = backends
+    pairs = fakes.chat_history(messages // 2)
+    firebase.tree.root.update(fakes.chat_records(DB_EMAIL, {CHAT_KEY: pairs}))
+    indexes = itertools.count(len(pairs) + 1)
+
+    def save():
+        run(app, app.save_chat_log(CHAT_KEY, "Title", next(indexes), ("Question?", "Answer.")))
+
+    report(benchmark, backends, save)
+    benchmark.pedantic(save, rounds=ROUNDS)
+    assert firebase.tree.node(["conversations", DB_EMAIL, CHAT_KEY, "pairs"]) == next(indexes) - 1
+
+
+@pytest.mark.parametrize("messages", HISTORY_SIZES)
+def test_sign_up(benchmark, app, backends, messages):
+    """
+    Signs up while the database holds one user per message of the history.
+    """
+    benchmark.group = "sign_up"
+    firebase, _ = backends
+    firebase.tree.root.update(fakes.user_records(messages))
+    names = (f"new{index}" for index in itertools.count())
+
+    def setup():
+        name = next(names)
+        return (name, f"{name}@example.com", "password"), {}
+
+    report(benchmark, backends, app.create_account, setup)
+    benchmark.pedantic(app.create_account, setup=setup, rounds=ROUNDS)
+    assert firebase.tree.node(["usernames", "new1"]) == "new1@example-dot-com"
+
+
+@pytest.mark.parametrize("messages", HISTORY_SIZES)
+def test_switch_session(benchmark, ui_app, backends, messages):
+    """
+    Opens a chat that is not in the local cache, until its newest page is drawn.
+    """
+    benchmark.group = "switch_session"
+    app = ui_app
+    firebase, _ = backends
+    pairs = fakes.chat_history(messages // 2)
+    firebase.tree.root.update(fakes.chat_records(DB_EMAIL, {CHAT_KEY: pairs}))
+
+    def setup():
+        app.chat_cache.delete_chat(DB_EMAIL, CHAT_KEY)
+        session = app.new_chat_session()
+        app.assign_chat_item(session, CHAT_KEY, "Title")
+        return (session,), {}
+
+    def switch(session):
+        app.switch_session(session.list_item)
+        wait_for(lambda: session.loaded)
+        render_frames(1)
+
+    report(benchmark, backends, switch, setup)
+    benchmark.pedantic(switch, setup=setup, rounds=ROUNDS)
+    assert len(app.session.pairs) == len(pairs)
+    assert len(app.chat_layout.ids.chat_view.data) == 2 * min(len(pairs), main.HISTORY_PAGE_SIZE)
@@ -0,0 +1,96 @@
+"""
+Runs camera frames through photo encoding and ingredient recognition, and suggests recipes for the result.
+"""
+import io
+import json
+
+import pytest
+
+import main
+from tests.conftest import run, wait_for
+
+Image = pytest.importorskip("PIL.Image")
+
+FRAME_SIZE = (1024, 768)
+RED, BLUE = (255, 0, 0, 255), (0, 0, 255, 255)
+INGREDIENTS = ["tomato", "pasta"]
+TITLES = ["Pasta al pomodoro", "Tomato soup"]
+
+
+def frame(top: tuple, bottom: tuple):
+    """
+    Returns the RGBA pixels of a camera frame whose upper half has one color and lower half another.
+    :param top:
+    :param bottom:
+    :return: bytes
+    """
+    width, height = FRAME_SIZE
+    return bytes(top) * (width * height // 2) + bytes(bottom) * (width * height // 2)
+
+
+def center_of(photo: bytes, y: float):
+    image = Image.open(io.BytesIO(photo))
+    return image.getpixel((image.width // 2, int(y * image.height)))
+
+
+class RecordingRecognizer(main.StubIngredientRecognizer):
+    """
+    Recognizes INGREDIENTS on every photo and keeps the photos it was sent.
+    """
+
+    def __init__(self):
+        super().__init__(INGREDIENTS)
+        self.photos = []
+
+    def recognize(self, photo: bytes):
+        self.photos.append(photo)
+        return super().recognize(photo)
+
+
+@pytest.fixture
+def recognizer(firebase):
+    backend = RecordingRecognizer()
+    main.register_service("recognizer", backend)
+    return backend
+
+
+def test_encode_photo_downscales_to_a_jpeg():
+    photo = main.encode_photo(frame(RED, BLUE), FRAME_SIZE, flip=False)
+    image = Image.open(io.BytesIO(photo))
+
+    assert image.format == "JPEG"
+    assert max(image.size) == main.CAPTURE_MAX_SIZE
+    assert image.size[0] / image.size[1] == pytest.approx(FRAME_SIZE[0] / FRAME_SIZE[1], rel=0.01)
+
+
+def test_encode_photo_flips_bottom_up_frames():
+    upright = main.encode_photo(frame(RED, BLUE), FRAME_SIZE, flip=False)
+    flipped = main.encode_photo(frame(RED, BLUE), FRAME_SIZE, flip=True)
+
+    assert center_of(upright, 0.25)[0] > 200 and center_of(upright, 0.75)[2] > 200
+    assert center_of(flipped, 0.25)[2] > 200 and center_of(flipped, 0.75)[0] > 200
+
+
+def test_recognize_ingredients_sends_the_encoded_photo(app, recognizer):
+    ingredients = run(app, app.recognize_ingredients(frame(RED, BLUE), FRAME_SIZE, False))
+
+    assert ingredients == INGREDIENTS
+    assert recognizer.photos == [main.encode_photo(frame(RED, BLUE), FRAME_SIZE, False)]
+
+
+def test_recognized_ingredients_suggest_recipes(ui_app, openai_client):
+    app = ui_app
+    openai_client.reply = json.dumps(TITLES)
+    app.on_ingredients_recognized(INGREDIENTS)
+
+    wait_for(lambda: app.recipe_dialog is not None)
+    assert [item.text for item in app.recipe_dialog.items] == TITLES
+
+    app.pick_recipe(INGREDIENTS, TITLES[0])
+    wait_for(lambda: app.session.pairs)
+    assert app.session.pairs == [(main.RECIPE_PROMPT.format(title=TITLES[0]), openai_client.reply)]
+
+
+def test_no_ingredients_recognized(ui_app):
+    ui_app.on_ingredients_recognized([])
+    assert ui_app.dialog.title == "No Ingredients"
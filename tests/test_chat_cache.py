@@ -0,0 +1,183 @@
+"""
+Stores chats in the local SQLite mirror and reads them back as the offline-first startup does.
+"""
+import sqlite3
+import time
+
+import pytest
+import requests
+from kivy.clock import Clock
+
+import main
+from tests import fakes
+from tests.conftest import DB_EMAIL, EMAIL, wait_for
+
+CHAT_KEY = main.new_chat_id(1)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    chat_cache = main.ChatCache(str(tmp_path / main.CHAT_CACHE_PATH))
+    yield chat_cache
+    chat_cache.connection.close()
+
+
+def test_append_messages(cache):
+    pairs = fakes.chat_history(5)
+    cache.append_messages(DB_EMAIL, CHAT_KEY, 1, pairs[:3], updated_at=10)
+    cache.append_messages(DB_EMAIL, CHAT_KEY, 4, pairs[3:])
+
+    assert cache.messages(DB_EMAIL, CHAT_KEY) == (1, pairs)
+    assert cache.chat_versions(DB_EMAIL) == {CHAT_KEY: 10}
+    assert cache.messages("other@example-dot-com", CHAT_KEY) is None
+
+
+def test_stale_chat_keeps_its_messages(cache):
+    pairs = fakes.chat_history(3)
+    cache.append_messages(DB_EMAIL, CHAT_KEY, 1, pairs, updated_at=10)
+    cache.mark_stale(DB_EMAIL, CHAT_KEY, 20, "Dinner")
+
+    assert cache.messages(DB_EMAIL, CHAT_KEY) is None
+    assert cache.messages(DB_EMAIL, CHAT_KEY, stale=True) == (1, pairs)
+    assert cache.chat_titles(DB_EMAIL) == {CHAT_KEY: "Dinner"}
+    # Only the newer pairs are downloaded and appended
+    cache.append_messages(DB_EMAIL, CHAT_KEY, 4, [("Dessert?", "Ice cream.")], updated_at=20)
+    assert cache.messages(DB_EMAIL, CHAT_KEY) == (1, pairs + [("Dessert?", "Ice cream.")])
+
+
+def test_paged_chat_returns_the_newest_pairs(cache):
+    pairs = fakes.chat_history(10)
+    cache.append_messages(DB_EMAIL, CHAT_KEY, 1, pairs[:2])
+    cache.append_messages(DB_EMAIL, CHAT_KEY, 7, pairs[6:])  # The newest page of a chat opened on another device
+
+    assert cache.messages(DB_EMAIL, CHAT_KEY) == (7, pairs[6:])
+    assert cache.older_messages(DB_EMAIL, CHAT_KEY, 7, 3) == []
+    cache.insert_messages(DB_EMAIL, CHAT_KEY, 4, pairs[3:6])
+    assert cache.older_messages(DB_EMAIL, CHAT_KEY, 7, 2) == pairs[4:6]
+    assert cache.older_messages(DB_EMAIL, CHAT_KEY, 7, 10) == pairs[3:6]
+    assert cache.messages(DB_EMAIL, CHAT_KEY) == (4, pairs[3:])
+
+
+def test_delete_and_clear(cache):
+    other_key = main.new_chat_id(2)
+    cache.append_messages(DB_EMAIL, CHAT_KEY, 1, fakes.chat_history(2))
+    cache.append_messages(DB_EMAIL, other_key, 1, fakes.chat_history(2))
+
+    cache.delete_chat(DB_EMAIL, CHAT_KEY)
+    assert list(cache.chat_versions(DB_EMAIL)) == [other_key]
+    cache.clear(DB_EMAIL)
+    assert cache.chat_versions(DB_EMAIL) == {}
+
+
+def test_mirror_of_an_older_schema_is_dropped(tmp_path):
+    path = str(tmp_path / main.CHAT_CACHE_PATH)
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE chats (email TEXT, title TEXT)")
+        connection.execute("INSERT INTO chats VALUES (?, ?)", (DB_EMAIL, "Old chat"))
+    connection.close()
+
+    cache = main.ChatCache(path)
+    assert cache.chat_titles(DB_EMAIL) == {}
+    assert cache.connection.execute("PRAGMA user_version").fetchone()[0] == main.CHAT_SCHEMA_VERSION
+    cache.connection.close()
+
+
+@pytest.fixture
+def cached_start(ui_app):
+    """
+    The home screen as on_start shows it for a stored user: the cached chats are listed and the login is pending.
+    """
+    ui_app.store.put("user", email=EMAIL, id_token="id-token", refresh_token="refresh-token", expires_at=0)
+    ui_app.chat_cache.append_messages(DB_EMAIL, CHAT_KEY, 1, fakes.chat_history(2))
+    ui_app.chat_cache.set_title(DB_EMAIL, CHAT_KEY, "Dinner", 10)
+    ui_app.login_check = None
+    ui_app.reset_chat_list()
+    ui_app.cache_email = DB_EMAIL
+    ui_app.show_cached_chats()
+    return ui_app
+
+
+def test_prompt_waits_for_the_login(cached_start):
+    app = cached_start
+    app.send_layout.ids.text_field.text = "Pasta?"
+    app.send_message()
+
+    assert app.dialog.title == "Logging In"
+    assert app.send_layout.ids.text_field.text == "Pasta?"
+    assert app.session.in_flight is None
+    assert not app.session.chat_layout.ids.chat_view.data
+
+
+def test_unreachable_server_keeps_the_cached_chats(cached_start, monkeypatch):
+    app = cached_start
+    refresh, offline = fakes.FakeAuth.refresh, [True]
+
+    def unreachable_refresh(auth, refresh_token: str):
+        if offline:
+            raise requests.ConnectionError("Network is unreachable")
+        return refresh(auth, refresh_token)
+
+    monkeypatch.setattr(fakes.FakeAuth, "refresh", unreachable_refresh)
+    monkeypatch.setattr(main, "AUTO_LOGIN_RETRY_DELAY", 0.1)
+    app.start_services()
+    wait_for(lambda: not app.login_pending)
+
+    assert app.sm.current == "home"
+    assert app.sessions_by_key[CHAT_KEY].list_item.text == "Dinner"
+    # The login is tried again and succeeds once the server is back
+    offline.clear()
+    wait_for(lambda: app.login_check)
+    assert app.auth_session.username == "user"
+    wait_for(lambda: app.chat_stream is not None)  # The chats are synced after the login
+
+
+def test_network_errors_are_classified_without_loading_services(monkeypatch):
+    def unavailable():
+        raise ValueError("Invalid certificate")
+
+    monkeypatch.setattr(main, "_services", {})
+    monkeypatch.setattr(main, "get_firebase", unavailable)
+    assert main.is_network_error(requests.ConnectionError("Network is unreachable"))
+    assert main.is_network_error(TimeoutError())
+    assert not main.is_network_error(ValueError("Invalid certificate"))
+
+
+def test_log_out_cancels_the_login_retry(cached_start, monkeypatch):
+    app = cached_start
+    app.ensure_screen("login")
+    refresh, offline = fakes.FakeAuth.refresh, [True]
+
+    def unreachable_refresh(auth, refresh_token: str):
+        if offline:
+            raise requests.ConnectionError("Network is unreachable")
+        return refresh(auth, refresh_token)
+
+    monkeypatch.setattr(fakes.FakeAuth, "refresh", unreachable_refresh)
+    monkeypatch.setattr(main, "AUTO_LOGIN_RETRY_DELAY", 0.1)
+    app.start_services()
+    wait_for(lambda: app.login_retry_event is not None)
+    app.log_out()
+    offline.clear()  # The server is back, but the user logged out
+
+    assert app.login_retry_event is None
+    assert "user" not in app.store
+    deadline = time.perf_counter() + 0.3
+    while time.perf_counter() < deadline:
+        Clock.tick()
+    assert not app.login_pending and not app.login_check
+    assert app.sm.current == "login"
+
+
+def test_refused_login_goes_back_to_the_login_screen(cached_start, monkeypatch):
+    app = cached_start
+
+    def expired_refresh(auth, refresh_token: str):
+        raise Exception("TOKEN_EXPIRED")
+
+    monkeypatch.setattr(fakes.FakeAuth, "refresh", expired_refresh)
+    app.start_services()
+    wait_for(lambda: not app.login_pending)
+
+    assert app.sm.current == "login"
+    assert app.dialog.title == "Error"
+    assert not app.sessions_by_key
@@ -0,0 +1,36 @@
+"""
+Sends messages through the home screen and checks what saving them costs in the fake database.
+"""
+import pytest
+
+import main
+from tests.conftest import DB_EMAIL, wait_for
+
+
+def send(app, prompt: str):
+    """
+    Sends a prompt from the text field of the current chat and waits for its reply.
+    :param app:
+    :param prompt:
+    :return: None
+    """
+    session = app.session
+    sent = len(session.pairs)
+    app.send_layout.ids.text_field.text = prompt
+    app.send_message()
+    wait_for(lambda: len(session.pairs) > sent and session.in_flight is None)
+
+
+@pytest.mark.parametrize("messages", (1, 10, 40))
+def test_each_message_costs_one_write(ui_app, firebase, messages):
+    app = ui_app
+    for index in range(1, messages + 1):
+        send(app, f"Question {index}?")
+    # Every pair is one multi-location update, the generated title of the chat one more
+    wait_for(lambda: app.request_counts["chats.update"] >= messages + 1)
+
+    assert app.request_counts["chats.update"] == messages + 1
+    assert firebase.tree.requests == {"db.update": messages + 1}
+    chat_key = app.session.chat_key
+    assert main.fetch_messages(firebase.database(), DB_EMAIL, chat_key) == app.session.pairs
+    assert firebase.tree.node(["conversations", DB_EMAIL, chat_key, "pairs"]) == messages
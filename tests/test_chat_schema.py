@@ -0,0 +1,78 @@
+"""
+Reads chats stored in the current schema and moves schema 1 chats to it, against the fake database.
+"""
+import main
+from tests import fakes
+from tests.conftest import DB_EMAIL
+
+PAGE_SIZE = 10
+CHAT_KEY = main.new_chat_id(1)
+
+
+def test_chat_ids_sort_by_creation_time():
+    ids = [main.new_chat_id(created_at) for created_at in (1000, 2000.5, 30000)]
+    assert sorted(ids) == ids
+
+
+def test_fetch_messages_reads_pages(firebase, monkeypatch):
+    monkeypatch.setattr(main, "CHAT_DOWNLOAD_PAGE_SIZE", PAGE_SIZE)
+    pairs = fakes.chat_history(3 * PAGE_SIZE + 5)
+    firebase.tree.put([], fakes.chat_records(DB_EMAIL, {CHAT_KEY: pairs}))
+
+    assert main.fetch_messages(firebase.database(), DB_EMAIL, CHAT_KEY) == pairs
+    assert firebase.tree.requests["db.get"] == 4
+    assert main.fetch_messages(firebase.database(), DB_EMAIL, CHAT_KEY, start=len(pairs) - 2) == pairs[-3:]
+
+
+def test_fetch_message_page_reads_one_page_by_key_range(firebase, monkeypatch):
+    monkeypatch.setattr(main, "CHAT_DOWNLOAD_PAGE_SIZE", PAGE_SIZE)
+    pairs = fakes.chat_history(3 * PAGE_SIZE + 5)
+    firebase.tree.put([], fakes.chat_records(DB_EMAIL, {CHAT_KEY: pairs}))
+
+    # Opening the chat reads its newest page only
+    newest = len(pairs) - PAGE_SIZE
+    assert main.fetch_message_page(firebase.database(), DB_EMAIL, CHAT_KEY) == (newest + 1, pairs[newest:])
+    assert firebase.tree.requests["db.get"] == 1
+    # Scrolling up reads the page before the oldest loaded pair
+    assert main.fetch_message_page(firebase.database(), DB_EMAIL, CHAT_KEY, newest + 1) == \
+        (newest - PAGE_SIZE + 1, pairs[newest - PAGE_SIZE:newest])
+    assert main.fetch_message_page(firebase.database(), DB_EMAIL, CHAT_KEY, 6) == (1, pairs[:5])
+    assert firebase.tree.requests["db.get"] == 3
+    assert main.fetch_message_page(firebase.database(), DB_EMAIL, CHAT_KEY, 1) == (1, [])
+    assert firebase.tree.requests["db.get"] == 3
+
+
+def test_fetch_messages_stops_at_a_missing_pair(firebase):
+    pairs = fakes.chat_history(5)
+    firebase.tree.put([], fakes.chat_records(DB_EMAIL, {CHAT_KEY: pairs}))
+    firebase.tree.put(["messages", DB_EMAIL, CHAT_KEY, main.pair_key(3)], None)
+
+    assert main.fetch_messages(firebase.database(), DB_EMAIL, CHAT_KEY) == pairs[:2]
+
+
+def test_parse_legacy_chat_orders_pairs_numerically():
+    chat = {"prompt_10": "Tenth?", "answer_10": "10", "prompt_2": "Second?", "answer_2": "2", "prompt_11": "Open?"}
+    assert main.parse_legacy_chat(chat) == [("Second?", "2"), ("Tenth?", "10")]
+
+
+def test_migrate_user_chats(firebase, monkeypatch):
+    monkeypatch.setattr(main.time, "time", lambda: 1000)
+    firebase.tree.put(["chats", DB_EMAIL], {
+        "Pasta-ask-": {"prompt_1": "Pasta?", "answer_1": "Boil it.", "prompt_2": "Sauce?", "answer_2": "Tomato."},
+        "Empty": {"title": "Empty"},
+    })
+    firebase.tree.requests.clear()
+
+    assert main.migrate_user_chats(firebase.database(), DB_EMAIL) == 2
+
+    assert not firebase.tree.node(["chats", DB_EMAIL])
+    conversations = firebase.tree.node(["conversations", DB_EMAIL])
+    (chat_id, meta), = conversations.items()
+    updated_at = 1000 + 1 / 1000  # Second in key order, after "Empty"
+    assert meta == main.chat_meta("Pasta?", updated_at, updated_at, 2)
+    assert chat_id.startswith(main.new_chat_id(updated_at)[:12])
+    pairs = main.fetch_messages(firebase.database(), DB_EMAIL, chat_id)
+    assert pairs == [("Pasta?", "Boil it."), ("Sauce?", "Tomato.")]
+    # One multi-path update per chat, which also removes the old copy
+    assert firebase.tree.requests["db.update"] == 2
+    assert main.migrate_user_chats(firebase.database(), DB_EMAIL) == 0
@@ -0,0 +1,132 @@
+"""
+Feeds server-sent events of the conversations stream into ChatStream from another thread, like the stream thread of
+pyrebase, and applies them to the app.
+"""
+import math
+import threading
+import time
+
+import pytest
+
+import main
+from tests.conftest import DB_EMAIL, run, wait_for
+
+CHAT_KEYS = [main.new_chat_id(created_at) for created_at in range(1, 11)]
+
+
+class RecordingStream(main.ChatStream):
+    """
+    ChatStream that records what it hands to the main thread.
+    """
+
+    def __init__(self):
+        self.calls = []
+        super().__init__(DB_EMAIL, lambda changes, snapshot: self.calls.append((changes, snapshot)))
+
+    def send(self, *messages: dict):
+        """
+        Handles the messages on another thread, in order.
+        :param messages:
+        :return: None
+        """
+        thread = threading.Thread(target=lambda: [self.handle(message) for message in messages])
+        thread.start()
+        thread.join()
+
+
+@pytest.fixture
+def stream(firebase):
+    chat_stream = RecordingStream()
+    chat_stream.start()
+    yield chat_stream
+    chat_stream.close()
+
+
+def test_burst_of_events_is_one_change(stream):
+    stream.send(*(
+        {"event": "patch", "path": f"/{CHAT_KEYS[0]}", "data": {"updated_at": index, "pairs": index}}
+        for index in range(1, 6)
+    ))
+    wait_for(lambda: stream.calls)
+    assert stream.calls == [({CHAT_KEYS[0]: (False, {"updated_at": 5, "pairs": 5})}, None)]
+
+
+def test_snapshot_replaces_every_chat(stream):
+    chat = main.chat_meta("Pasta", 1, 1, 2)
+    stream.send({"event": "put", "path": "/", "data": {CHAT_KEYS[0]: chat}})
+    wait_for(lambda: stream.calls)
+
+    (changes, snapshot), = stream.calls
+    assert changes == {CHAT_KEYS[0]: (True, chat)}
+    assert snapshot == ({CHAT_KEYS[0]}, stream.opened_at)
+
+
+def test_removed_chat(stream):
+    stream.send({"event": "put", "path": f"/{CHAT_KEYS[0]}", "data": None})
+    wait_for(lambda: stream.calls)
+    assert stream.calls == [({CHAT_KEYS[0]: (True, None)}, None)]
+
+
+def test_changes_are_spread_over_frames(stream):
+    stream.send({"event": "patch", "path": "/", "data": {f"{chat_key}/title": "Pasta" for chat_key in CHAT_KEYS}})
+    wait_for(lambda: sum(len(changes) for changes, _ in stream.calls) == len(CHAT_KEYS))
+
+    assert len(stream.calls) == math.ceil(len(CHAT_KEYS) / main.CHAT_STREAM_CHATS_PER_FRAME)
+    assert all(len(changes) <= main.CHAT_STREAM_CHATS_PER_FRAME for changes, _ in stream.calls)
+
+
+def test_cancelled_stream_reconnects_with_a_growing_delay(stream):
+    stream.send({"event": "cancel", "path": "/", "data": None})
+    wait_for(lambda: stream.reconnect_event is not None)
+    assert stream.retry_delay == 2 * main.CHAT_STREAM_RETRY_DELAY
+
+
+def test_closed_stream_drops_events(stream):
+    stream.close()
+    stream.send({"event": "put", "path": f"/{CHAT_KEYS[0]}", "data": None})
+    assert not stream.flush_scheduled
+    assert not stream.calls
+
+
+def test_streamed_chats_are_applied(ui_app):
+    app = ui_app
+    app.apply_streamed_chats({CHAT_KEYS[0]: (True, main.chat_meta("Pasta", 1, 1, 2))}, None)
+    session = app.sessions_by_key[CHAT_KEYS[0]]
+    assert session.list_item.text == "Pasta"
+    assert app.chat_cache.chat_titles(DB_EMAIL) == {CHAT_KEYS[0]: "Pasta"}
+
+    app.apply_streamed_chats({CHAT_KEYS[0]: (False, {"title": "Pizza", "updated_at": 2})}, None)
+    assert session.list_item.text == "Pizza"
+
+    app.apply_streamed_chats({CHAT_KEYS[0]: (True, None)}, None)
+    assert CHAT_KEYS[0] not in app.sessions_by_key
+    assert app.chat_cache.chat_titles(DB_EMAIL) == {}
+
+
+def test_snapshot_removes_chats_saved_before_the_stream_opened(ui_app):
+    app = ui_app
+    app.add_synced_chat(CHAT_KEYS[0], "Pasta")
+    app.chat_cache.mark_stale(DB_EMAIL, CHAT_KEYS[0], 1, "Pasta")
+
+    app.apply_streamed_chats({}, (set(), time.time()))
+    assert CHAT_KEYS[0] not in app.sessions_by_key
+    assert app.chat_cache.chat_titles(DB_EMAIL) == {}
+
+
+def test_snapshot_keeps_chats_with_unconfirmed_writes(ui_app):
+    app = ui_app
+    session = app.session
+    opened_at = time.time()
+    run(app, app.chat_write_lock.acquire())  # Holds back the first write of the chat
+    app.send_layout.ids.text_field.text = "Pasta?"
+    app.send_message()
+    wait_for(lambda: session.chat_key is not None)
+    assert session.saves
+
+    app.apply_streamed_chats({}, (set(), opened_at))
+    assert app.sessions_by_key.get(session.chat_key) is session
+
+    app.worker.loop.call_soon_threadsafe(app.chat_write_lock.release)
+    wait_for(lambda: not session.saves)
+    app.apply_streamed_chats({}, (set(), opened_at))
+    assert app.sessions_by_key.get(session.chat_key) is session
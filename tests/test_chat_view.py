@@ -0,0 +1,64 @@
+"""
+Fills the recycled chat view of the home screen and edits its message records.
+"""
+import pytest
+
+import main
+from tests.conftest import render_frames
+
+LONG_ANSWER = " ".join(f"word{index}" for index in range(main.READ_MORE_LIMIT))
+
+
+def fill(chat_layout, messages: int):
+    chat_layout.ids.chat_view.data = [
+        chat_layout.make_record("user" if index % 2 == 0 else "assistant", f"Message {index}")
+        for index in range(messages)
+    ]
+    chat_layout.ids.chat_view.scroll_y = 0
+    render_frames(3)
+    return chat_layout.ids.chat_view.layout_manager.children
+
+
+@pytest.mark.parametrize("messages", (1000, 10000))
+def test_only_visible_messages_have_views(ui_app, messages):
+    views = fill(ui_app.chat_layout, messages)
+    assert 0 < len(views) < 50
+    assert all(isinstance(view, main.ChatBubble) for view in views)
+    assert max(view.index for view in views) == messages - 1
+
+
+def test_add_update_and_remove_messages(ui_app):
+    chat_layout = ui_app.chat_layout
+    question = chat_layout.add_message("user", "Pasta?")
+    answer = chat_layout.add_message("assistant", "")
+    chat_layout.update_message(answer, text="Boil it.", streaming=False)
+    chat_layout.update_message(-1, text="Not in the chat")
+    data = chat_layout.ids.chat_view.data
+
+    assert [(record["role"], record["text"]) for record in data] == [("user", "Pasta?"), ("assistant", "Boil it.")]
+    chat_layout.remove_message(question)
+    assert chat_layout.find_message(question) is None
+    assert chat_layout.find_message(answer) == 0
+
+
+def test_measured_heights_are_reused(ui_app):
+    chat_layout = ui_app.chat_layout
+    fill(chat_layout, 10)
+    data = chat_layout.ids.chat_view.data
+    assert all("height" in record for record in data[-3:])
+
+    record = chat_layout.make_record(data[-1]["role"], data[-1]["text"])
+    assert record["height"] == data[-1]["height"]
+
+
+def test_long_answer_is_truncated_until_expanded():
+    head, tail = main.ChatBubble.display_text("assistant", LONG_ANSWER, expanded=False)
+    assert head and tail == ""
+    expanded_head, expanded_tail = main.ChatBubble.display_text("assistant", LONG_ANSWER, expanded=True)
+    assert expanded_head == head
+    assert f"{head} {expanded_tail}" == LONG_ANSWER
+
+
+def test_user_text_is_shown_as_typed():
+    display = main.ChatBubble.display_text("user", "1. [b]Pasta[/b]", expanded=False)
+    assert display == ("1. &bl;b&br;Pasta&bl;/b&br;", "")
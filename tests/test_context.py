@@ -0,0 +1,72 @@
+"""
+Builds completion requests from long chat histories within the token budget.
+"""
+import main
+from tests import fakes
+
+BUDGET = 500
+INSTRUCTIONS = "You are a cook."
+
+
+def history_tokens(messages: list):
+    return sum(main.ContextBuilder.count_tokens(message["content"]) for message in messages)
+
+
+def test_newest_pairs_fit_the_budget():
+    pairs = fakes.chat_history(100)
+    messages = main.ContextBuilder(BUDGET).build(INSTRUCTIONS, pairs, "And dessert?")
+
+    assert messages[0] == {"role": "system", "content": INSTRUCTIONS}
+    assert messages[-1] == {"role": "user", "content": "And dessert?"}
+    assert history_tokens(messages) <= BUDGET
+    assert messages[-2] == {"role": "assistant", "content": pairs[-1][1]}
+    # The pair before the oldest one sent, and the 3 tokens that prime the reply, would not have fit
+    sent = (len(messages) - 2) // 2
+    question, answer = pairs[-sent - 1]
+    next_pair = main.ContextBuilder.count_tokens(question) + main.ContextBuilder.count_tokens(answer)
+    assert history_tokens(messages) + next_pair + 3 > BUDGET
+
+
+def test_each_turn_counts_only_the_new_pair(monkeypatch):
+    pairs = fakes.chat_history(100)
+    builder = main.ContextBuilder(BUDGET)
+    builder.build(INSTRUCTIONS, pairs, "And dessert?")
+
+    counted = []
+    count_tokens = main.ContextBuilder.count_tokens
+    monkeypatch.setattr(main.ContextBuilder, "count_tokens",
+                        classmethod(lambda cls, text: counted.append(text) or count_tokens(text)))
+    pairs.append(("And dessert?", "Ice cream."))
+    messages = builder.build(INSTRUCTIONS, pairs, "And a drink?")
+
+    assert sorted(counted) == sorted([INSTRUCTIONS, "And a drink?", "And dessert?", "Ice cream."])
+    assert messages == main.ContextBuilder(BUDGET).build(INSTRUCTIONS, pairs, "And a drink?")
+
+
+def test_replaced_history_is_counted_again():
+    builder = main.ContextBuilder(BUDGET)
+    builder.build(INSTRUCTIONS, fakes.chat_history(10), "And dessert?")
+    other = fakes.chat_history(3, answer="Another answer. ")
+
+    messages = builder.build(INSTRUCTIONS, other, "And dessert?")
+    assert messages == main.ContextBuilder(BUDGET).build(INSTRUCTIONS, other, "And dessert?")
+
+
+def test_question_asked_earlier_leaves_out_newer_pairs():
+    pairs = fakes.chat_history(5)
+    messages = main.ContextBuilder(BUDGET).build(INSTRUCTIONS, pairs, "And dessert?", end=3)
+    assert messages[-2] == {"role": "assistant", "content": pairs[2][1]}
+
+
+def test_summary_replaces_dropped_turns():
+    pairs = fakes.chat_history(100)
+    builder = main.ContextBuilder(BUDGET)
+    builder.build(INSTRUCTIONS, pairs, "And dessert?")
+    start, end = builder.pending_summary()
+    assert start == 0 and end >= main.CONTEXT_SUMMARY_BATCH
+
+    builder.set_summary("They asked about many dishes.", end)
+    messages = builder.build(INSTRUCTIONS, pairs, "And dessert?")
+    summary = "Summary of the earlier conversation: They asked about many dishes."
+    assert messages[1] == {"role": "system", "content": summary}
+    assert history_tokens(messages) <= BUDGET + 8
@@ -0,0 +1,108 @@
+"""
+Opens a long stored chat and scrolls up through its history, one page at a time.
+"""
+import main
+from tests import fakes
+from tests.conftest import DB_EMAIL, wait_for
+
+CHAT_KEY = main.new_chat_id(1)
+PAIRS = 2 * main.HISTORY_PAGE_SIZE + 5
+
+
+def store_chat(firebase, pairs: list):
+    for node, value in fakes.chat_records(DB_EMAIL, {CHAT_KEY: pairs}).items():
+        firebase.tree.put([node], value)
+
+
+def open_chat(app):
+    """
+    Lists the stored chats, opens the one under CHAT_KEY and waits until its messages are loaded.
+    :param app:
+    :return: ChatSession
+    """
+    app.get_chat_log()
+    session = wait_for(lambda: app.sessions_by_key.get(CHAT_KEY))
+    app.switch_session(session.list_item)
+    wait_for(lambda: session.loaded)
+    return session
+
+
+def shown_texts(session):
+    return [record["text"] for record in session.chat_layout.ids.chat_view.data]
+
+
+def test_history_is_rendered_a_page_at_a_time(ui_app, firebase):
+    pairs = fakes.chat_history(PAIRS)
+    store_chat(firebase, pairs)
+    session = open_chat(ui_app)
+    assert session.pairs == pairs
+    assert len(shown_texts(session)) == 2 * main.HISTORY_PAGE_SIZE
+    assert shown_texts(session)[-2:] == list(pairs[-1])
+
+    for shown_pairs in (2 * main.HISTORY_PAGE_SIZE, PAIRS, PAIRS):
+        ui_app.on_chat_scroll(session.chat_layout, 1)
+        assert len(shown_texts(session)) == 2 * shown_pairs
+    assert shown_texts(session) == [text for pair in pairs for text in pair]
+
+
+def test_scrolling_down_renders_nothing(ui_app, firebase):
+    store_chat(firebase, fakes.chat_history(PAIRS))
+    session = open_chat(ui_app)
+    ui_app.on_chat_scroll(session.chat_layout, 0.5)
+    assert len(shown_texts(session)) == 2 * main.HISTORY_PAGE_SIZE
+
+
+def test_reopened_chat_is_read_from_the_local_cache(ui_app, firebase):
+    pairs = fakes.chat_history(PAIRS)
+    store_chat(firebase, pairs)
+    open_chat(ui_app)
+    assert ui_app.request_counts["messages.get"] == 1
+
+    ui_app.reset_chat_list()
+    session = open_chat(ui_app)
+    assert session.pairs == pairs
+    assert ui_app.request_counts["messages.get"] == 1
+
+
+def test_long_chat_downloads_older_pages_when_scrolled_to(ui_app, firebase, monkeypatch):
+    monkeypatch.setattr(main, "CHAT_DOWNLOAD_PAGE_SIZE", main.HISTORY_PAGE_SIZE + 10)
+    pairs = fakes.chat_history(PAIRS)
+    store_chat(firebase, pairs)
+    session = open_chat(ui_app)
+    newest = PAIRS - main.CHAT_DOWNLOAD_PAGE_SIZE
+    assert (session.first_pair, session.pairs) == (newest + 1, pairs[newest:])
+    assert ui_app.request_counts["messages.get"] == 1
+
+    ui_app.on_chat_scroll(session.chat_layout, 1)  # Renders the rest of the downloaded page
+    assert len(shown_texts(session)) == 2 * main.CHAT_DOWNLOAD_PAGE_SIZE
+    assert ui_app.request_counts["messages.get"] == 1
+
+    ui_app.on_chat_scroll(session.chat_layout, 1)
+    ui_app.on_chat_scroll(session.chat_layout, 1)  # The older page is requested once
+    wait_for(lambda: len(shown_texts(session)) == 2 * PAIRS)
+    assert shown_texts(session) == [text for pair in pairs for text in pair]
+    assert ui_app.request_counts["messages.get"] == 2
+    # Pairs are only appended to the newest page, older pages are only shown
+    assert session.pairs == pairs[newest:]
+
+    ui_app.on_chat_scroll(session.chat_layout, 1)
+    assert ui_app.request_counts["messages.get"] == 2
+
+
+def test_reopened_long_chat_reads_older_pages_from_the_local_cache(ui_app, firebase, monkeypatch):
+    monkeypatch.setattr(main, "CHAT_DOWNLOAD_PAGE_SIZE", main.HISTORY_PAGE_SIZE)
+    pairs = fakes.chat_history(PAIRS)
+    store_chat(firebase, pairs)
+    session = open_chat(ui_app)
+    for _ in range(3):
+        ui_app.on_chat_scroll(session.chat_layout, 1)
+        wait_for(lambda: not session.history_loading)
+    assert len(shown_texts(session)) == 2 * PAIRS
+    requests = ui_app.request_counts["messages.get"]
+
+    ui_app.reset_chat_list()
+    session = open_chat(ui_app)
+    for _ in range(3):
+        ui_app.on_chat_scroll(session.chat_layout, 1)
+    assert shown_texts(session) == [text for pair in pairs for text in pair]
+    assert ui_app.request_counts["messages.get"] == requests
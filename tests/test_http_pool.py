@@ -0,0 +1,189 @@
+"""
+Counts the TLS handshakes a local stub server sees, to check that the pooled HTTP sessions keep their connections
+alive between requests and between user actions that go through get_firebase.
+"""
+import concurrent.futures
+import http.server
+import shutil
+import ssl
+import subprocess
+import threading
+import time
+
+import pytest
+
+import main
+from tests.conftest import DB_EMAIL, run
+
+requests = pytest.importorskip("requests")
+
+REQUESTS = 20
+RESPONSE_DELAY = 0.01  # Seconds the stub server takes per response, so concurrent requests overlap
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keeps the connection open after a response
+
+    def do_GET(self):
+        self.respond()
+
+    def do_PATCH(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.respond()
+
+    def respond(self):
+        time.sleep(RESPONSE_DELAY)
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """
+    HTTPS server that counts the connections it accepted, each of them one TLS handshake.
+    """
+    daemon_threads = True
+
+    def __init__(self, context: ssl.SSLContext):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.handshakes = 0
+        self.lock = threading.Lock()
+
+    def get_request(self):
+        request = super().get_request()
+        with self.lock:
+            self.handshakes += 1
+        return request
+
+    @property
+    def base_url(self):
+        return f"https://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def url(self):
+        return f"{self.base_url}/users.json"
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is not installed")
+    directory = tmp_path_factory.mktemp("tls")
+    cert, key = directory / "cert.pem", directory / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+         "-addext", "subjectAltName=IP:127.0.0.1", "-keyout", str(key), "-out", str(cert)],
+        check=True, capture_output=True,
+    )
+    return str(cert), str(key)
+
+
+@pytest.fixture
+def server(certificate):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*certificate)
+    stub = StubServer(context)
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+
+def new_session(certificate: tuple):
+    """
+    Returns a requests session that trusts the stub server and ignores proxy and CA bundle environment variables.
+    :param certificate:
+    :return: requests.Session
+    """
+    session = requests.Session()
+    session.trust_env = False
+    session.verify = certificate[0]
+    return session
+
+
+@pytest.fixture
+def pooled_session(certificate):
+    session = new_session(certificate)
+    main.mount_http_pool(session)
+    yield session
+    session.close()
+
+
+def test_pooled_session_reuses_one_connection(server, pooled_session):
+    for _ in range(REQUESTS):
+        pooled_session.get(server.url).raise_for_status()
+    assert server.handshakes == 1
+
+
+def test_new_session_per_request_connects_every_time(server, certificate):
+    for _ in range(REQUESTS):
+        with new_session(certificate) as session:
+            session.get(server.url).raise_for_status()
+    assert server.handshakes == REQUESTS
+
+
+def test_concurrent_requests_are_bounded_by_pool_size(server, pooled_session):
+    with concurrent.futures.ThreadPoolExecutor(3 * main.HTTP_POOL_SIZE) as executor:
+        responses = list(executor.map(lambda _: pooled_session.get(server.url), range(10 * main.HTTP_POOL_SIZE)))
+    assert all(response.ok for response in responses)
+    assert server.handshakes <= main.HTTP_POOL_SIZE
+
+
+@pytest.fixture
+def stub_firebase(app, server, certificate, monkeypatch):
+    """
+    Lets get_firebase initialize pyrebase against the stub server instead of the fake of the app fixture. The Admin
+    SDK is not initialized, since the stub has no service account.
+    """
+    pytest.importorskip("pyrebase")
+    firebase_admin = pytest.importorskip("firebase_admin")
+    from firebase_admin import credentials
+
+    monkeypatch.setattr(firebase_admin, "initialize_app", lambda *args, **kwargs: None)
+    monkeypatch.setattr(credentials, "Certificate", lambda path: None)
+    monkeypatch.setattr(main, "config", dict(main.config, databaseURL=server.base_url))
+    monkeypatch.setenv("REQUESTS_CA_BUNDLE", certificate[0])
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    monkeypatch.setenv("no_proxy", "127.0.0.1")
+    for name in ("firebase", "auth", "db"):
+        main._services.pop(name, None)
+    return main.get_firebase()
+
+
+def test_user_actions_reuse_one_connection(app, server, stub_firebase):
+    chat_key = main.new_chat_id()
+    for index in range(1, REQUESTS + 1):
+        app.fetch_user_record(DB_EMAIL)  # As logging in reads the account record
+        run(app, app.save_chat_log(chat_key, "Pasta", index, ("Pasta?", "Boil it.")))
+    assert server.handshakes == 1
+
+
+def test_concurrent_user_actions_are_bounded_by_pool_size(app, server, stub_firebase):
+    with concurrent.futures.ThreadPoolExecutor(3 * main.HTTP_POOL_SIZE) as executor:
+        for _ in range(3):
+            list(executor.map(app.fetch_user_record, [DB_EMAIL] * 3 * main.HTTP_POOL_SIZE))
+    assert server.handshakes <= main.HTTP_POOL_SIZE
+
+
+def test_worker_http_session_reuses_one_connection(app, server, certificate):
+    pytest.importorskip("aiohttp")
+    context = ssl.create_default_context(cafile=certificate[0])
+
+    async def fetch():
+        session = main.get_http_session()
+        for _ in range(REQUESTS):
+            async with session.get(server.url, ssl=context) as response:
+                response.raise_for_status()
+                await response.read()
+        await main.close_http_session()
+
+    run(app, fetch())
+    assert server.handshakes == 1
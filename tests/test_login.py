@@ -0,0 +1,61 @@
+"""
+Logs in against the fake Firebase backend, whose requests all take LATENCY.
+"""
+import time
+
+import pytest
+
+import main
+from tests import fakes
+from tests.conftest import DB_EMAIL, EMAIL, run
+
+LATENCY = 0.1
+CHAT_KEY = main.new_chat_id(1)
+
+
+@pytest.fixture
+def slow_firebase(firebase):
+    for node, value in fakes.chat_records(DB_EMAIL, {CHAT_KEY: fakes.chat_history(3)}).items():
+        firebase.tree.put([node], value)
+    firebase.tree.latency = LATENCY
+    return firebase
+
+
+def test_login_requests_run_concurrently(app, slow_firebase):
+    started_at = time.perf_counter()
+    auth_session = run(app, app.authenticate(EMAIL, "password"))
+    seconds = time.perf_counter() - started_at
+
+    assert auth_session.username == "user"
+    assert list(auth_session.chat_versions[0]) == [CHAT_KEY]
+    # The account record, the chat list, its schema 1 keys and the sign in
+    assert slow_firebase.tree.requests == {"db.get": 3, "auth.sign_in": 1}
+    assert seconds < 2 * LATENCY
+
+
+@pytest.mark.parametrize("email, password", [(EMAIL, "wrong"), ("nobody@example.com", "password")])
+def test_login_with_wrong_credentials_fails(app, slow_firebase, email, password):
+    with pytest.raises(Exception, match="Invalid email or password."):
+        run(app, app.authenticate(email, password))
+
+
+def test_stored_token_is_reused_while_valid(app, slow_firebase):
+    stored = {"email": EMAIL, "id_token": "id-token", "refresh_token": "refresh-token",
+              "expires_at": time.time() + 2 * main.ID_TOKEN_EXPIRY_MARGIN}
+    auth_session = run(app, app.restore_session(stored))
+
+    assert auth_session.user["idToken"] == "id-token"
+    assert slow_firebase.tree.requests["auth.refresh"] == 0
+    assert list(auth_session.chat_versions[0]) == [CHAT_KEY]
+
+
+def test_expiring_token_is_refreshed(app, slow_firebase):
+    stored = {"email": EMAIL, "id_token": "id-token", "refresh_token": "refresh-token",
+              "expires_at": time.time() + main.ID_TOKEN_EXPIRY_MARGIN / 2}
+    started_at = time.perf_counter()
+    auth_session = run(app, app.restore_session(stored))
+
+    assert auth_session.expires_at > stored["expires_at"]
+    assert slow_firebase.tree.requests["auth.refresh"] == 1
+    # The refresh runs alongside the account reads
+    assert time.perf_counter() - started_at < 2 * LATENCY
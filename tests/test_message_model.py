@@ -0,0 +1,78 @@
+"""
+Parses answers into message models and renders their bubble markup.
+"""
+import collections
+
+import pytest
+
+import main
+
+ANSWER = """Here is what you can cook:
+
+1. **Pasta** with tomato sauce
+   and basil
+2. Omelette
+- Salad
+
+```
+boil(water)
+```
+Enjoy!"""
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(main.MessageModel, "cache", collections.OrderedDict())
+    monkeypatch.setattr(main.MessageModel, "streamed", None)
+
+
+def test_parse_segments():
+    assert main.MessageModel.parse(ANSWER) == [
+        ("paragraph", "Here is what you can cook:", None),
+        ("item", "**Pasta** with tomato sauce\nand basil", 1),
+        ("item", "Omelette", 2),
+        ("item", "Salad", None),
+        ("code", "boil(water)", None),
+        ("paragraph", "Enjoy!", None),
+    ]
+
+
+def test_unterminated_code_block_runs_to_the_end():
+    assert main.MessageModel.parse("Try this:\n```\nboil(water)\nstir()") == [
+        ("paragraph", "Try this:", None), ("code", "boil(water)\nstir()", None),
+    ]
+
+
+def test_items_are_tap_targets():
+    model = main.MessageModel(ANSWER)
+    assert "[ref=1]1. [b]Pasta[/b] with tomato sauce\nand basil[/ref]\n[ref=2]2. Omelette[/ref]" in model.head
+    assert "[ref=3]• Salad[/ref]" in model.head
+    assert "[font=RobotoMono-Regular]boil(water)[/font]" in model.head
+    assert model.tail == ""
+
+
+def test_markup_is_escaped():
+    assert main.MessageModel("Use [b]salt[/b] & pepper").head == "Use &bl;b&br;salt&bl;/b&br; &amp; pepper"
+
+
+def test_long_answer_is_split_at_read_more_limit():
+    words = " ".join(f"word{index}" for index in range(main.READ_MORE_LIMIT))
+    model = main.MessageModel(words)
+
+    assert len(model.head) <= main.READ_MORE_LIMIT
+    assert not model.head.endswith(" ")
+    assert f"{model.head} {model.tail}" == words
+
+
+def test_models_are_cached_per_text():
+    model = main.MessageModel.get(ANSWER)
+    assert main.MessageModel.get(ANSWER) is model
+
+
+def test_streamed_answers_are_not_cached():
+    partial = main.MessageModel.get(ANSWER[:40], streaming=True)
+    assert main.MessageModel.get(ANSWER[:40], streaming=True) is partial
+    main.MessageModel.get(ANSWER[:60], streaming=True)
+
+    assert ANSWER[:40] not in main.MessageModel.cache
+    assert main.MessageModel.streamed.text == ANSWER[:60]
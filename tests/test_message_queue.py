@@ -0,0 +1,121 @@
+"""
+Sends several prompts to one or more chats while their replies are generated by the slow fake OpenAI client.
+"""
+import main
+from tests.conftest import DB_EMAIL, drain_worker, run, wait_for
+
+LATENCY = 0.2
+
+
+def send(app, prompt: str):
+    app.send_layout.ids.text_field.text = prompt
+    app.send_message()
+
+
+def user_messages(session):
+    return [record["text"] for record in session.chat_layout.ids.chat_view.data if record["role"] == "user"]
+
+
+def open_new_chat(app):
+    session = app.append_chat_item()
+    app.switch_session(session.list_item)
+    return session
+
+
+def test_prompts_sent_while_waiting_are_queued(ui_app, openai_client):
+    app = ui_app
+    openai_client.latency = LATENCY
+    session = app.session
+    prompts = ["Pasta?", "Pizza?", "Salad?"]
+
+    for prompt in prompts:
+        send(app, prompt)
+    assert session.in_flight == "Pasta?"
+    assert [prompt for prompt, _ in session.queue] == ["Pizza?", "Salad?"]
+    assert user_messages(session) == prompts
+
+    wait_for(lambda: len(session.pairs) == len(prompts))
+    assert [prompt for prompt, _ in session.pairs] == prompts
+    assert session.in_flight is None
+    # One completion per prompt and one for the title generated after the first reply
+    assert openai_client.requests["openai.completion"] == len(prompts) + 1
+
+
+def test_repeated_prompt_is_sent_once(ui_app, openai_client):
+    app = ui_app
+    openai_client.latency = LATENCY
+    session = app.session
+
+    for prompt in ("Pasta?", "Pasta?", "Pizza?", "Pizza?"):
+        send(app, prompt)
+    assert user_messages(session) == ["Pasta?", "Pizza?"]
+
+    wait_for(lambda: len(session.pairs) == 2 and session.in_flight is None)
+    assert openai_client.requests["openai.completion"] == 2 + 1
+
+
+def test_concurrent_prompts_are_limited_across_chats(ui_app, openai_client, monkeypatch):
+    app = ui_app
+    monkeypatch.setattr(main, "STREAM_RESPONSES", False)
+    openai_client.latency = LATENCY
+    prompts = [f"Question {index}?" for index in range(main.MAX_CONCURRENT_PROMPTS + 2)]
+    create_completion = openai_client.ChatCompletion.acreate
+    active, peak = set(), []
+
+    async def counting_completion(messages: list, **kwargs):
+        prompt = messages[-1]["content"]
+        if prompt not in prompts:  # Titles are generated outside the prompt slots
+            return await create_completion(messages, **kwargs)
+        active.add(prompt)
+        peak.append(len(active))
+        try:
+            return await create_completion(messages, **kwargs)
+        finally:
+            active.discard(prompt)
+
+    openai_client.ChatCompletion.acreate = counting_completion
+    sessions = []
+    for prompt in prompts:
+        sessions.append(open_new_chat(app))
+        send(app, prompt)
+
+    wait_for(lambda: all(session.pairs for session in sessions))
+    assert max(peak) == main.MAX_CONCURRENT_PROMPTS
+    assert [session.pairs[0][0] for session in sessions] == prompts
+
+
+def test_reply_stays_in_the_chat_it_was_sent_from(ui_app, openai_client):
+    app = ui_app
+    openai_client.latency = LATENCY
+    sent_from = app.session
+    send(app, "Pasta?")
+    other = open_new_chat(app)
+
+    wait_for(lambda: sent_from.pairs and sent_from.in_flight is None)
+    assert app.session is other
+    assert [record["text"] for record in sent_from.chat_layout.ids.chat_view.data] == ["Pasta?", openai_client.reply]
+    assert not other.chat_layout.ids.chat_view.data
+    assert not other.pairs
+
+
+def test_chat_deleted_during_a_reply_stays_deleted(ui_app, firebase, openai_client):
+    app = ui_app
+    session = app.session
+    send(app, "Pasta?")
+    wait_for(lambda: session.list_item.text != "New Chat" and app.request_counts["chats.update"] == 2)
+    chat_key = session.chat_key
+
+    openai_client.latency = LATENCY
+    send(app, "Pizza?")
+    send(app, "Salad?")
+    delete_icon = session.list_item.children[0].children[0]
+    app.delete_confirmation = True
+    app.check_delete_confirmation(delete_icon)
+    assert session.in_flight is None and not session.queue
+
+    run(app, drain_worker())
+    wait_for(lambda: True)  # Runs the callbacks of the finished tasks
+    assert session.pairs == [("Pasta?", openai_client.reply)]
+    assert firebase.tree.node(["conversations", DB_EMAIL, chat_key]) is None
+    assert firebase.tree.node(["messages", DB_EMAIL, chat_key]) is None
+    assert app.chat_cache.chat_titles(DB_EMAIL) == {}
@@ -0,0 +1,82 @@
+"""
+Records backend calls made through the instrumented clients and exports the numbers.
+"""
+import json
+import urllib.request
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    recorder = main.Metrics(main.METRICS_SAMPLE_SIZE)
+    monkeypatch.setattr(main, "metrics", recorder)
+    return recorder
+
+
+def test_snapshot_percentiles(metrics):
+    for milliseconds in range(1, 101):
+        metrics.record("db.users.get", milliseconds / 1000, nbytes=10)
+    operation = metrics.snapshot()["db.users.get"]
+
+    assert operation["count"] == 100
+    assert operation["bytes"] == 1000
+    assert (operation["p50"], operation["p95"], operation["p99"]) == pytest.approx((51, 96, 100))
+
+
+def test_sample_size_keeps_the_latest_latencies():
+    recorder = main.Metrics(10)
+    for milliseconds in range(100):
+        recorder.record("openai.completion", milliseconds / 1000)
+    assert recorder.snapshot()["openai.completion"]["p50"] == pytest.approx(95)
+
+
+def test_measure_counts_errors(metrics):
+    with pytest.raises(ValueError):
+        with metrics.measure("openai.moderation"):
+            raise ValueError
+    with metrics.measure("openai.moderation") as measurement:
+        measurement["bytes"] = 42
+
+    operation = metrics.snapshot()["openai.moderation"]
+    assert (operation["count"], operation["errors"], operation["bytes"]) == (2, 1, 42)
+
+
+def test_instrumented_database_names_requests_by_node(metrics, firebase):
+    database = main.get_db()
+    database.child("users").child("user@example-dot-com").get()
+    database.child("chats").order_by_key().limit_to_last(1).get()
+    database.update({"usernames/user": "user@example-dot-com"})
+
+    # Query building calls are not requests
+    assert {name: operation["count"] for name, operation in metrics.snapshot().items()} == {
+        "db.users.get": 1, "db.chats.get": 1, "db.root.update": 1,
+    }
+
+
+def test_instrumented_auth_names_requests_by_method(metrics, firebase):
+    main.get_auth().sign_in_with_email_and_password("user@example.com", "password")
+    assert list(metrics.snapshot()) == ["auth.sign_in_with_email_and_password"]
+
+
+def test_json_sink(metrics, tmp_path):
+    metrics.record("db.users.get", 0.01)
+    path = tmp_path / main.METRICS_JSON_PATH
+    main.JsonMetricsSink(str(path)).export(metrics.snapshot())
+    assert json.loads(path.read_text())["operations"]["db.users.get"]["count"] == 1
+
+
+def test_prometheus_sink(metrics):
+    metrics.record("db.users.get", 0.01)
+    sink = main.PrometheusMetricsSink(0)
+    sink.export(metrics.snapshot())
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{sink.server.server_address[1]}/metrics") as response:
+            lines = response.read().decode().splitlines()
+    finally:
+        sink.server.shutdown()
+        sink.server.server_close()
+    assert 'dataai_operations_total{operation="db.users.get"} 1' in lines
+    assert 'dataai_operation_seconds{operation="db.users.get",quantile="0.99"} 0.01' in lines
@@ -0,0 +1,66 @@
+"""
+Runs moderation and completion of a prompt against the fake OpenAI client, whose requests both take LATENCY.
+"""
+import time
+
+import pytest
+
+from tests.conftest import run
+
+LATENCY = 0.2
+TOKEN_DELAY = 0.02  # Seconds between two streamed tokens
+TOKENS = 20
+
+
+class RecordingRenderer:
+    """
+    Stands in for the StreamRenderer of a message and records the deltas it is fed.
+    """
+
+    def __init__(self):
+        self.deltas = []
+        self.released = False
+
+    def feed(self, delta: str):
+        self.deltas.append(delta)
+
+    def release(self):
+        self.released = True
+
+
+def process(app, prompt: str, renderer=None):
+    """
+    Processes the prompt on the worker loop.
+    :param app:
+    :param prompt:
+    :param renderer:
+    :return: tuple[str, float]: the reply and the seconds it took
+    """
+    started_at = time.perf_counter()
+    response = run(app, app.process_message(prompt, [], 0, renderer))
+    return response, time.perf_counter() - started_at
+
+
+def test_moderation_and_completion_run_concurrently(app, openai_client):
+    openai_client.latency = LATENCY
+    response, seconds = process(app, "What should I cook tonight?")
+
+    assert response == openai_client.reply
+    assert openai_client.requests == {"openai.moderation": 1, "openai.completion": 1}
+    assert seconds < 1.5 * LATENCY
+
+
+def test_flagged_prompt_cancels_the_completion(app, openai_client):
+    openai_client.latency = LATENCY
+    openai_client.token_delay = TOKEN_DELAY
+    openai_client.reply = "word " * TOKENS
+    openai_client.flagged = {"Something flagged"}
+    renderer = RecordingRenderer()
+    started_at = time.perf_counter()
+    with pytest.raises(Exception, match="Failed moderation check"):
+        run(app, app.process_message("Something flagged", [], 0, renderer))
+
+    # The stream is cancelled when moderation fails, instead of running to its end
+    assert time.perf_counter() - started_at < LATENCY + TOKENS * TOKEN_DELAY / 2
+    assert not renderer.released
+    assert len(renderer.deltas) < TOKENS
@@ -0,0 +1,124 @@
+"""
+Suggests recipes for a set of ingredients and fans out the recipe requests, with a fake completion request.
+"""
+import asyncio
+import collections
+import gc
+import json
+
+import pytest
+
+import main
+
+INGREDIENTS = ["Tomato", "pasta ", "basil"]
+TITLES = [f"Dish {index}" for index in range(1, main.RECIPE_OPTIONS + 1)]
+REQUEST_DELAY = 0.01  # Seconds a fake completion takes
+
+
+class FakeRequest:
+    """
+    Completion request of a RecipeBook. Suggestions are a JSON array of TITLES, recipes repeat the prompt.
+    """
+
+    def __init__(self):
+        self.requests = collections.Counter()
+        self.running = 0
+        self.most_running = 0
+
+    async def __call__(self, messages: list, operation: str):
+        self.requests[operation] += 1
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        try:
+            await asyncio.sleep(REQUEST_DELAY)
+        finally:
+            self.running -= 1
+        if operation == "openai.recipes":
+            return "Sure! " + json.dumps(TITLES)
+        return messages[-1]["content"]
+
+
+@pytest.mark.parametrize("text", [
+    'Here you go: ["Pasta", "Omelette"] Enjoy!',
+    "Here you go:\n1. Pasta\n2) **Omelette**\n- Salad",
+    '[1, 2]\n1. Pasta\n2. Omelette',
+])
+def test_parse_titles(text):
+    titles = main.RecipeBook.parse_titles(text)
+    assert titles[:2] == ["Pasta", "Omelette"]
+
+
+def test_parse_titles_keeps_recipe_options():
+    assert main.RecipeBook.parse_titles(json.dumps(TITLES + ["Too many"])) == TITLES
+
+
+def test_suggest_prefetches_the_best_recipes():
+    request = FakeRequest()
+
+    async def suggest():
+        book = main.RecipeBook(request)
+        titles = await book.suggest(INGREDIENTS)
+        await asyncio.sleep(2 * REQUEST_DELAY)
+        recipe = await book.recipe(["basil", "tomato", "pasta"], titles[0])
+        return titles, recipe
+
+    titles, recipe = asyncio.run(suggest())
+    assert titles == TITLES
+    assert recipe == main.RECIPE_DETAIL_PROMPT.format(title=TITLES[0], ingredients="basil, pasta, tomato")
+    # The opened recipe was prefetched, so it is not requested again
+    assert request.requests == {"openai.recipes": 1, "openai.recipe": main.RECIPE_PREFETCH}
+
+
+def test_recipes_are_requested_concurrently_up_to_the_limit():
+    request = FakeRequest()
+
+    async def open_all():
+        book = main.RecipeBook(request)
+        await book.suggest(INGREDIENTS)
+        return await asyncio.gather(*(book.recipe(INGREDIENTS, title) for title in TITLES))
+
+    recipes = asyncio.run(open_all())
+    assert len(set(recipes)) == len(TITLES)
+    assert request.requests["openai.recipe"] == len(TITLES)
+    assert request.most_running == main.RECIPE_CONCURRENCY
+
+
+def test_failed_recipe_is_requested_again():
+    request = FakeRequest()
+    failures = [RuntimeError("Connection reset")]
+
+    async def flaky(messages, operation):
+        if failures:
+            raise failures.pop()
+        return await request(messages, operation)
+
+    async def open_twice():
+        book = main.RecipeBook(flaky)
+        with pytest.raises(RuntimeError):
+            await book.recipe(INGREDIENTS, "Pasta")
+        return await book.recipe(INGREDIENTS, "Pasta")
+
+    assert "Pasta" in asyncio.run(open_twice())
+    assert request.requests == {"openai.recipe": 1}
+
+
+def test_failed_prefetch_is_logged(caplog):
+    request = FakeRequest()
+    errors = []
+
+    async def failing(messages, operation):
+        if operation == "openai.recipe":
+            raise RuntimeError("Connection reset")
+        return await request(messages, operation)
+
+    async def suggest_and_leave():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        book = main.RecipeBook(failing)
+        await book.suggest(INGREDIENTS)
+        await asyncio.sleep(2 * REQUEST_DELAY)
+        book.tasks.clear()  # The user left without opening a recipe
+        gc.collect()
+
+    asyncio.run(suggest_and_leave())
+    assert not errors
+    assert caplog.text.count("Recipe request failed: Connection reset") == main.RECIPE_PREFETCH
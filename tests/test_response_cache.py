@@ -0,0 +1,62 @@
+"""
+Stores and expires entries of the response cache, in memory and in its SQLite tier.
+"""
+import pytest
+
+import main
+
+TTL = 60
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    The time the caches see, moved forward by the tests.
+    """
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    return now
+
+
+def test_make_key_depends_on_every_part():
+    key = main.ResponseCache.make_key("gpt-3.5-turbo", [{"role": "user", "content": "Pasta?"}])
+    assert key == main.ResponseCache.make_key("gpt-3.5-turbo", [{"role": "user", "content": "Pasta?"}])
+    assert key != main.ResponseCache.make_key("gpt-3.5-turbo", [{"role": "user", "content": "Pizza?"}])
+
+
+def test_entries_expire(clock):
+    cache = main.ResponseCache("completions", 10, TTL)
+    cache.put("pasta", "Boil it.")
+    clock[0] += TTL
+    assert cache.get("pasta") == "Boil it."
+    clock[0] += 1
+    assert cache.get("pasta") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 0}
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = main.ResponseCache("completions", 2, TTL)
+    cache.put("pasta", "Boil it.")
+    cache.put("pizza", "Bake it.")
+    cache.get("pasta")
+    cache.put("salad", "Mix it.")
+
+    assert cache.get("pizza") is None
+    assert cache.get("pasta") == "Boil it."
+    assert cache.get("salad") == "Mix it."
+
+
+def test_disk_tier_outlives_the_memory_tier(clock, tmp_path):
+    path = str(tmp_path / "responses.db")
+    cache = main.ResponseCache("completions", 1, TTL, path, max_disk_entries=2)
+    for key in ("pasta", "pizza", "salad"):
+        cache.put(key, {"answer": key})
+        clock[0] += 1
+    cache.connection.close()
+
+    reopened = main.ResponseCache("completions", 1, TTL, path, max_disk_entries=2)
+    assert reopened.get("pasta") is None
+    assert reopened.get("pizza") == {"answer": "pizza"}
+    clock[0] += TTL
+    assert reopened.get("salad") is None
+    reopened.connection.close()
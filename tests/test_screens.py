@@ -0,0 +1,57 @@
+"""
+Builds the app and checks that screens are loaded when first needed or while idle after startup.
+"""
+import pytest
+from kivy.base import EventLoop
+from kivy.lang import Builder
+
+import main
+from tests.conftest import wait_for
+
+
+@pytest.fixture
+def built_app(app):
+    EventLoop.ensure_window()
+    app.root = app.build()
+    yield app
+    for path in app.kv_timings:
+        Builder.unload_file(path)
+
+
+@pytest.fixture
+def screen_loads(built_app):
+    """
+    Times each screen is loaded from now on.
+    """
+    loads = dict.fromkeys(built_app.screen_loaders, 0)
+    for screen_name, load in list(built_app.screen_loaders.items()):
+        def counting_load(screen_name_=screen_name, load_=load):
+            loads[screen_name_] += 1
+            load_()
+
+        built_app.screen_loaders[screen_name] = counting_load
+    return loads
+
+
+def test_build_only_loads_the_login_screen(built_app):
+    assert built_app.built_screens == {"login"}
+    assert set(built_app.kv_timings) == {"uix/widgets/custom_widgets.kv", "uix/screens/login_screen.kv"}
+    assert built_app.sm.screen_names == ["login"]
+
+
+def test_screen_is_built_once(built_app, screen_loads):
+    built_app.ensure_screen("signup")
+    built_app.switch_screen("signup")
+    built_app.ensure_screen("signup")
+
+    assert screen_loads["signup"] == 1
+    assert built_app.sm.current == "signup"
+
+
+def test_preload_builds_one_screen_per_frame(built_app, screen_loads):
+    built_app.preload_screens()
+    assert built_app.built_screens == {"login", main.PRELOADED_SCREENS[0]}
+
+    wait_for(lambda: built_app.built_screens.issuperset(main.PRELOADED_SCREENS))
+    assert "camera" not in built_app.built_screens
+    assert all(screen_loads[screen_name] == 1 for screen_name in main.PRELOADED_SCREENS)
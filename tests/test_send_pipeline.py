@@ -0,0 +1,89 @@
+"""
+Sends prompts from the home screen against slow fake backends and checks that the main thread keeps drawing frames
+while the replies are generated on the worker.
+"""
+import time
+
+import main
+from tests import fakes
+from tests.conftest import render_frames, wait_for
+
+SLOW_LATENCY = 0.3  # Seconds a slow backend request takes
+UI_CALL_LIMIT = 0.05  # Seconds a UI callback may take while its request is in flight
+
+
+def test_send_message_does_not_block_frames(ui_app, openai_client):
+    app = ui_app
+    openai_client.latency = SLOW_LATENCY
+    session = app.session
+    app.send_layout.ids.text_field.text = "What should I cook tonight?"
+
+    started_at = time.perf_counter()
+    app.send_message()
+    assert time.perf_counter() - started_at < UI_CALL_LIMIT
+
+    frames = 0
+    while session.in_flight is not None:
+        render_frames(1)
+        frames += 1
+    assert frames > 1
+    assert session.pairs == [("What should I cook tonight?", openai_client.reply)]
+    assert app.chat_layout.ids.chat_view.data[-1]["text"] == openai_client.reply
+
+
+def test_sign_up_does_not_block_frames(ui_app, firebase):
+    app = ui_app
+    firebase.tree.latency = SLOW_LATENCY / 3
+    app.ensure_screen("signup")
+    ids = app.signup_screen.ids
+    ids.signup_username.text, ids.signup_email.text, ids.signup_password.text = "cook", "cook@example.com", "secret"
+
+    started_at = time.perf_counter()
+    app.sign_up()
+    assert time.perf_counter() - started_at < UI_CALL_LIMIT
+    assert app.signup_pending
+
+    wait_for(lambda: not app.signup_pending)
+    assert app.dialog.title == "Success"
+    assert firebase.tree.node(["usernames", "cook"]) == "cook@example-dot-com"
+    assert firebase.tree.node(["users", "cook@example-dot-com", "username"]) == "cook"
+
+
+def test_sign_up_with_taken_username_fails(ui_app, firebase):
+    app = ui_app
+    firebase.tree.put(["usernames", "cook"], "someone@example-dot-com")
+    app.ensure_screen("signup")
+    ids = app.signup_screen.ids
+    ids.signup_username.text, ids.signup_email.text, ids.signup_password.text = "cook", "cook@example.com", "secret"
+
+    app.sign_up()
+    wait_for(lambda: not app.signup_pending)
+    assert app.dialog.text == "Username already exists."
+    assert firebase.tree.node(["users", "cook@example-dot-com"]) is None
+    assert firebase.tree.requests["auth.create_user"] == 0
+
+
+def test_sign_up_without_services_shows_the_error(ui_app, monkeypatch):
+    app = ui_app
+
+    def unavailable():
+        raise ValueError("Invalid certificate")
+
+    monkeypatch.setattr(main, "_services", {})
+    monkeypatch.setattr(main, "get_firebase", unavailable)
+    app.ensure_screen("signup")
+    ids = app.signup_screen.ids
+    ids.signup_username.text, ids.signup_email.text, ids.signup_password.text = "cook", "cook@example.com", "secret"
+
+    app.sign_up()
+    wait_for(lambda: not app.signup_pending)
+    assert app.dialog.text == "Invalid certificate"
+    assert "admin_auth" not in main._services
+
+
+def test_sign_up_error_messages(firebase):
+    exists = "The user with the provided email already exists."
+    assert main.sign_up_error_message(fakes.EmailAlreadyExistsError()) == exists
+    assert main.sign_up_error_message(Exception('[Errno 400 Client Error] {"error": {"message": "EMAIL_EXISTS"}}')) \
+        == exists
+    assert main.sign_up_error_message(Exception("Username already exists.")) == "Username already exists."
@@ -0,0 +1,120 @@
+"""
+Adds, titles and removes chats of the navigation drawer and checks the session lookup tables stay in step with it.
+"""
+import time
+
+from kivy.clock import Clock
+
+import main
+from tests.conftest import wait_for
+
+CHAT_KEYS = [main.new_chat_id(created_at) for created_at in (1, 2, 3)]
+
+
+def drawer_sessions(app):
+    """
+    Sessions of the chat items in the navigation drawer, top to bottom.
+    :param app:
+    :return: list[ChatSession]
+    """
+    return [app.sessions_by_item[item] for item in reversed(app.nav_drawer.ids.chat_list.children)]
+
+
+def assert_tables_match(app):
+    sessions = drawer_sessions(app)
+    assert sorted(app.sessions) == sorted(session.chat_id for session in sessions)
+    assert all(app.sessions[session.chat_id] is session for session in sessions)
+    assert app.sessions_by_key == {session.chat_key: session for session in sessions if session.chat_key}
+
+
+def test_new_chat_is_not_added_twice(ui_app):
+    ui_app.add_new_chat()
+    ui_app.add_new_chat()
+    assert ui_app.chat_count == 0
+    assert ui_app.new_chat_session() is ui_app.session
+
+
+def test_stored_chat_gets_a_new_chat_after_it(ui_app):
+    ui_app.assign_chat_item(ui_app.session, CHAT_KEYS[0], "Pasta")
+    ui_app.add_new_chat()
+
+    assert ui_app.chat_count == 1
+    assert ui_app.session is ui_app.sessions[1]
+    assert ui_app.session.list_item.text == "New Chat"
+    assert_tables_match(ui_app)
+
+
+def test_synced_chats_are_listed_and_removed(ui_app):
+    for index, chat_key in enumerate(CHAT_KEYS):
+        ui_app.add_synced_chat(chat_key, f"Chat {index}")
+    assert [session.list_item.text for session in drawer_sessions(ui_app)] == ["Chat 0", "Chat 1", "Chat 2", "New Chat"]
+    assert ui_app.session is ui_app.new_chat_session()
+    assert_tables_match(ui_app)
+
+    ui_app.switch_session(ui_app.sessions_by_key[CHAT_KEYS[1]].list_item)
+    ui_app.remove_synced_chat(CHAT_KEYS[1])
+    assert CHAT_KEYS[1] not in ui_app.sessions_by_key
+    assert ui_app.session is ui_app.new_chat_session()
+    assert_tables_match(ui_app)
+
+
+def test_switch_session_shows_the_chat_of_the_item(ui_app):
+    ui_app.add_synced_chat(CHAT_KEYS[0], "Pasta")
+    session = ui_app.sessions_by_key[CHAT_KEYS[0]]
+    ui_app.switch_session(session.list_item)
+
+    assert ui_app.session is session
+    assert ui_app.chat_layout is session.chat_layout
+    assert session.chat_layout.parent is ui_app.home_screen
+    assert ui_app.title == "Pasta"
+    wait_for(lambda: session.loaded)
+
+
+def test_chat_with_a_reply_in_flight_gets_a_new_chat_after_it(ui_app, openai_client):
+    openai_client.latency = 0.2
+    ui_app.send_layout.ids.text_field.text = "Pasta?"
+    ui_app.send_message()
+    ui_app.add_new_chat()
+
+    assert ui_app.chat_count == 1
+    assert ui_app.session.list_item.text == "New Chat"
+    wait_for(lambda: ui_app.sessions[0].pairs)
+
+
+def test_failed_title_falls_back_to_the_prompt(ui_app, openai_client):
+    create_completion = openai_client.ChatCompletion.acreate
+
+    async def failing_title(messages: list, **kwargs):
+        if "Summarize the conversation" in messages[-1]["content"]:
+            raise Exception("The server is overloaded.")
+        return await create_completion(messages, **kwargs)
+
+    openai_client.ChatCompletion.acreate = failing_title
+    session = ui_app.session
+    ui_app.send_layout.ids.text_field.text = "How do I cook pasta al dente?"
+    ui_app.send_message()
+    wait_for(lambda: session.list_item.text != "New Chat")
+    assert session.list_item.text == "How do I cook pasta..."
+
+    ui_app.add_new_chat()
+    assert ui_app.session is not session
+    assert ui_app.chat_count == 1
+    assert_tables_match(ui_app)
+
+
+def test_confirmed_deletes_stop_waiting_for_the_dialog(ui_app):
+    for index, chat_key in enumerate(CHAT_KEYS[:2]):
+        ui_app.add_synced_chat(chat_key, f"Chat {index}")
+
+    for chat_key in CHAT_KEYS[:2]:
+        session = ui_app.sessions_by_key[chat_key]
+        ui_app.delete_chat_log(session.list_item.children[0].children[0])
+        ui_app.set_delete_confirmation(True)
+        wait_for(lambda: chat_key not in ui_app.sessions_by_key)
+        assert ui_app.delete_confirmation_event is None
+
+    deadline = time.perf_counter() + 0.3  # Pollers of earlier deletes would run again within this time
+    while time.perf_counter() < deadline:
+        Clock.tick()
+    assert [session.list_item.text for session in drawer_sessions(ui_app)] == ["New Chat"]
+    assert_tables_match(ui_app)
@@ -0,0 +1,55 @@
+"""
+Starts the app in a fresh interpreter and checks that the OpenAI and Firebase SDKs are not imported before the first
+frame. They are loaded by start_services, SERVICES_START_DELAY after it. Imports are recorded when they are attempted,
+so the check also holds where the SDKs are not installed.
+"""
+import json
+import os
+import subprocess
+import sys
+
+from tests.conftest import ROOT
+
+SDK_MODULES = ("openai", "pyrebase", "firebase_admin")
+
+STARTUP = """
+import json
+import sys
+
+imported = set()
+
+
+class ImportRecorder:
+    @staticmethod
+    def find_spec(name, path=None, target=None):
+        if name.split(".")[0] in {modules!r}:
+            imported.add(name)
+
+
+sys.meta_path.insert(0, ImportRecorder)
+
+from kivy.base import EventLoop, runTouchApp
+from kivy.resources import resource_add_path
+
+import main
+
+resource_add_path({root!r})
+app = main.MainApp()
+app.root = app.build()
+runTouchApp(app.root, embedded=True)
+app.dispatch("on_start")
+EventLoop.idle()
+app.worker.stop()
+print(json.dumps(sorted(imported)))
+"""
+
+
+def test_first_frame_does_not_import_sdks(tmp_path):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (ROOT, os.environ.get("PYTHONPATH")))))
+    env.pop("KIVY_NO_CONSOLELOG", None)
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP.format(root=ROOT, modules=set(SDK_MODULES))],
+        cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout.splitlines()[-1]) == []
@@ -0,0 +1,82 @@
+"""
+Streams replies of the fake OpenAI client through StreamRenderer while the Clock is ticked on this thread, like the
+Kivy main loop does.
+"""
+import time
+
+import pytest
+from kivy.clock import Clock
+
+import main
+from tests.conftest import wait_for
+
+TOKEN_DELAY = 0.05  # Seconds between two streamed tokens, longer than STREAM_FRAME_BUDGET
+CLOCK_TOLERANCE = 0.01  # Seconds an interval event may fire late
+
+
+class RecordingLayout:
+    """
+    Stands in for the ChatLayout of a StreamRenderer and records when each update reached the bubble.
+    """
+
+    def __init__(self):
+        self.updates = []
+
+    def update_message(self, message_id: int, **changes):
+        self.updates.append((time.perf_counter(), changes))
+
+
+@pytest.fixture
+def streaming(openai_client):
+    openai_client.reply = "word " * 10
+    openai_client.token_delay = TOKEN_DELAY
+    return openai_client
+
+
+def test_first_token_is_rendered_within_frame_budget(app, streaming):
+    layout = RecordingLayout()
+    renderer = main.StreamRenderer(layout, 0)
+    future = app.worker.submit(app.process_message("What should I cook tonight?", [], 0, renderer))
+
+    wait_for(lambda: layout.updates)
+    rendered_at, changes = layout.updates[0]
+    assert changes["streaming"]
+    assert rendered_at - streaming.first_token_at <= main.STREAM_FRAME_BUDGET + CLOCK_TOLERANCE
+    assert renderer.first_render <= TOKEN_DELAY + main.STREAM_FRAME_BUDGET + CLOCK_TOLERANCE
+
+    response = future.result(5)
+    renderer.finish()
+    assert layout.updates[-1][1]["text"] == response
+
+
+def test_tokens_are_batched_per_frame(app, openai_client):
+    openai_client.reply = "word " * 40
+    openai_client.token_delay = main.STREAM_FRAME_BUDGET / 8
+    layout = RecordingLayout()
+    renderer = main.StreamRenderer(layout, 0)
+    started_at = time.perf_counter()
+    future = app.worker.submit(app.process_message("What should I cook tonight?", [], 0, renderer))
+
+    wait_for(future.done)
+    streamed_for = time.perf_counter() - started_at
+    renderer.finish()
+    assert layout.updates[-1][1]["text"] == future.result()
+    # At most one update per frame budget the stream lasted, and the one of finish
+    assert len(layout.updates) <= streamed_for / main.STREAM_FRAME_BUDGET + 2
+    assert len(layout.updates) < len(future.result().split()) / 2
+
+
+def test_flagged_prompt_is_never_rendered(app, streaming):
+    streaming.flagged = {"Something flagged"}
+    layout = RecordingLayout()
+    renderer = main.StreamRenderer(layout, 0)
+    future = app.worker.submit(app.process_message("Something flagged", [], 0, renderer))
+
+    wait_for(future.done)
+    with pytest.raises(Exception, match="Failed moderation check"):
+        future.result()
+    deadline = time.perf_counter() + 2 * main.STREAM_FRAME_BUDGET
+    while time.perf_counter() < deadline:
+        Clock.tick()
+    renderer.event.cancel()
+    assert not layout.updates
@@ -0,0 +1,161 @@
+"""
+Switches between the Light and Dark themes with a loaded chat on the home screen.
+"""
+import itertools
+import statistics
+import time
+
+import pytest
+from kivy.core.text import LabelBase
+from kivy.uix.label import Label
+
+import main
+from tests.conftest import render_frames, wait_for
+
+try:
+    import pytest_benchmark
+except ImportError:
+    pytest_benchmark = None
+
+needs_benchmark = pytest.mark.skipif(pytest_benchmark is None, reason="pytest-benchmark is not installed")
+
+ANSWER = "Here is what you can cook:\n" + "".join(
+    f"- **Dish {index}**: a short description of the dish and how long it takes.\n" for index in range(1, 9)
+)
+THEME_STYLES = ("Dark", "Light")
+THEME_MESSAGE_COUNTS = (50, 500, 5000)
+FLAT_TOLERANCE = 2  # Largest allowed ratio between the median switch times with the most and the fewest messages
+SWITCH_ANIMATION_TIME = 0.5  # Seconds until the color animation that menu_callback starts is over
+
+
+def fill_chat(app, messages: int):
+    """
+    Replaces the messages of the current chat with messages alternating questions and long answers, shows the newest
+    ones and returns the texts the bubbles show.
+    :param app:
+    :param messages:
+    :return: set[str]
+    """
+    chat_layout = app.chat_layout
+    records = [
+        chat_layout.make_record("user", f"Question {index}?") if index % 2 == 0
+        else chat_layout.make_record("assistant", f"{ANSWER}{index}")
+        for index in range(messages)
+    ]
+    chat_layout.ids.chat_view.data = records
+    chat_layout.ids.chat_view.scroll_y = 0
+    render_frames(3)
+    return {main.ChatBubble.display_text(record["role"], record["text"], False)[0] for record in records}
+
+
+@pytest.fixture
+def label_renders(monkeypatch):
+    """
+    Texts rendered by a core label from now on. Cached bubble textures are not rendered again.
+    """
+    rendered = []
+    refresh = LabelBase.refresh
+
+    def recording_refresh(label):
+        rendered.append(label.text)
+        return refresh(label)
+
+    monkeypatch.setattr(LabelBase, "refresh", recording_refresh)
+    return rendered
+
+
+@needs_benchmark
+def test_theme_toggle_with_500_bubbles(benchmark, ui_app, label_renders):
+    """
+    Times a theme switch and the frame after it with 500 messages loaded. The RecycleView only has views for the
+    bubbles on screen, their texts must come from the texture cache in the new color.
+    """
+    app = ui_app
+    texts = fill_chat(app, 500)
+    label_renders.clear()
+    styles = itertools.cycle(THEME_STYLES)
+
+    def toggle():
+        app.menu_callback(next(styles))
+        render_frames(1)
+
+    benchmark.pedantic(toggle, rounds=10)
+    views = app.chat_layout.ids.chat_view.layout_manager.children
+    benchmark.extra_info["bubbles"] = len(views)
+    assert not texts.intersection(label_renders)
+    # The colors follow the palette once the switch animation of menu_callback is over
+    wait_for(lambda: all(list(view.ids.chat_bubble_text.color) == list(app.palette.text_color) for view in views))
+
+
+@pytest.fixture
+def chat_labels_updated(ui_app, monkeypatch):
+    """
+    Labels of the chat view whose texture was updated from now on, whether it was rendered or taken from the cache.
+    """
+    updated = set()
+    chat_view = ui_app.chat_layout.ids.chat_view
+
+    for label_class in (Label, main.BubbleLabel):
+        # Kivy binds texture_update by name, so the wrapper keeps it
+        def texture_update(label, *largs, update=label_class.texture_update):
+            widget = label.parent
+            # The window is its own parent
+            while widget is not None and widget is not chat_view and widget.parent is not widget:
+                widget = widget.parent
+            if widget is chat_view:
+                updated.add(label)
+            return update(label, *largs)
+
+        monkeypatch.setattr(label_class, "texture_update", texture_update)
+    return updated
+
+
+def switch_theme(app, style: str):
+    """
+    Switches the theme and draws the next frame.
+    :param app:
+    :param style:
+    :return: float: seconds it took
+    """
+    started_at = time.perf_counter()
+    app.menu_callback(style)
+    render_frames(1)
+    return time.perf_counter() - started_at
+
+
+def settle():
+    """
+    Draws frames until the color animation of the last theme switch is over.
+    :return: None
+    """
+    settled_at = time.perf_counter() + SWITCH_ANIMATION_TIME
+    while time.perf_counter() < settled_at:
+        render_frames(1)
+
+
+@needs_benchmark
+@pytest.mark.parametrize("messages", THEME_MESSAGE_COUNTS)
+def test_theme_switch(benchmark, ui_app, messages):
+    benchmark.group = "theme_switch"
+    fill_chat(ui_app, messages)
+    styles = itertools.cycle(THEME_STYLES)
+    benchmark.pedantic(lambda: switch_theme(ui_app, next(styles)), rounds=10)
+
+
+def test_theme_switch_cost_is_flat(ui_app, chat_labels_updated):
+    """
+    A theme switch updates the same bubble labels and takes about as long however many messages the chat has.
+    """
+    updated, times = {}, {}
+    for messages in THEME_MESSAGE_COUNTS:
+        fill_chat(ui_app, messages)
+        updated[messages], times[messages] = [], []
+        for style in THEME_STYLES * 2:
+            chat_labels_updated.clear()
+            times[messages].append(switch_theme(ui_app, style))
+            settle()
+            updated[messages].append(len(chat_labels_updated))
+
+    fewest, most = min(THEME_MESSAGE_COUNTS), max(THEME_MESSAGE_COUNTS)
+    assert updated[most] == updated[fewest]
+    assert statistics.median(times[most]) <= FLAT_TOLERANCE * statistics.median(times[fewest])
@@ -0,0 +1,112 @@
+"""
+Claims usernames in the usernames index of the fake database, releases them when a sign up fails and builds the
+index from an existing users node.
+"""
+import concurrent.futures
+import math
+
+import pytest
+
+import main
+from tests import fakes
+from tests.conftest import DB_EMAIL, EMAIL
+
+USERS = 25
+BATCH_SIZE = 10
+
+
+def test_claim_free_username(firebase):
+    database = firebase.database()
+    assert main.claim_username(database, "cook", "cook@example-dot-com")
+    assert firebase.tree.node(["usernames", "cook"]) == "cook@example-dot-com"
+    # The ETag of the empty entry is enough to claim it
+    assert firebase.tree.requests == {"db.get_etag": 1, "db.conditional_set": 1}
+
+
+def test_claim_taken_username(firebase):
+    firebase.tree.put(["usernames", "cook"], "someone@example-dot-com")
+    assert not main.claim_username(firebase.database(), "cook", "cook@example-dot-com")
+    assert firebase.tree.node(["usernames", "cook"]) == "someone@example-dot-com"
+    assert firebase.tree.requests == {"db.get_etag": 1}
+
+
+def test_concurrent_claims_have_one_winner(firebase):
+    # Every request waits, so both sign ups read the free entry before either of them writes it
+    firebase.tree.latency = 0.02
+    owners = [f"cook{index}@example-dot-com" for index in range(2)]
+    with concurrent.futures.ThreadPoolExecutor(len(owners)) as executor:
+        claimed = list(executor.map(lambda owner: main.claim_username(firebase.database(), "cook", owner), owners))
+
+    assert claimed.count(True) == 1
+    assert firebase.tree.node(["usernames", "cook"]) == owners[claimed.index(True)]
+
+
+def fail(error: Exception):
+    def failing(*args, **kwargs):
+        raise error
+    return failing
+
+
+def test_failed_verification_email_undoes_the_sign_up(app, firebase, monkeypatch):
+    monkeypatch.setattr(fakes.FakeAuth, "send_email_verification", fail(Exception("Network unreachable")))
+    with pytest.raises(Exception, match="Network unreachable"):
+        app.create_account("cook", "cook@example.com", "secret")
+
+    assert firebase.tree.node(["usernames", "cook"]) is None
+    assert firebase.tree.node(["users", "cook@example-dot-com"]) is None
+    assert firebase.tree.requests["auth.delete_user_account"] == 1
+
+
+def test_existing_email_keeps_its_account(app, firebase, monkeypatch):
+    error = fakes.EmailAlreadyExistsError("EMAIL_EXISTS")
+    monkeypatch.setattr(fakes.FakeAuth, "create_user_with_email_and_password", fail(error))
+    with pytest.raises(fakes.EmailAlreadyExistsError):
+        app.create_account("cook", EMAIL, "secret")
+
+    assert firebase.tree.node(["usernames", "cook"]) is None
+    assert firebase.tree.node(["users", DB_EMAIL, "username"]) == "user"
+    assert firebase.tree.requests["auth.delete_user_account"] == 0
+
+
+def test_sign_up_writes_the_record_with_the_username(app, firebase):
+    app.create_account("cook", "cook@example.com", "secret")
+
+    assert firebase.tree.node(["usernames", "cook"]) == "cook@example-dot-com"
+    assert firebase.tree.node(["users", "cook@example-dot-com", "username"]) == "cook"
+    assert firebase.tree.requests["db.conditional_set"] == 1
+    assert firebase.tree.requests["db.update"] == 1
+    assert firebase.tree.requests["db.set"] == 0
+
+
+def test_migrate_username_index(firebase):
+    records = fakes.user_records(USERS)
+    firebase.tree.put(["users"], records["users"])
+    # Already indexed usernames keep their owner
+    firebase.tree.put(["users", "someone@example-dot-com"], {"email": "someone@example.com", "username": "someone",
+                                                             "password": "password"})
+    firebase.tree.put(["usernames", "user0"], "someone@example-dot-com")
+    firebase.tree.requests.clear()
+
+    added = main.migrate_username_index(BATCH_SIZE)
+
+    assert added == USERS
+    assert firebase.tree.node(["usernames", "user0"]) == "someone@example-dot-com"
+    assert firebase.tree.node(["usernames", "user1"]) == "user1@example-dot-com"
+    batches = math.ceil(USERS / BATCH_SIZE)
+    # One shallow read of the index, one read per batch and one for the empty batch after the last
+    assert firebase.tree.requests["db.get"] == batches + 2
+    assert firebase.tree.requests["db.update"] == batches
+
+
+def test_migrate_username_index_releases_claims_without_a_user(firebase):
+    # Sign ups that stopped after claiming the username, the second one taken by an existing user since
+    firebase.tree.put(["usernames", "ghost"], "ghost@example-dot-com")
+    firebase.tree.put(["usernames", "cook"], "cook@example-dot-com")
+    firebase.tree.put(["users", "chef@example-dot-com"], {"email": "chef@example.com", "username": "cook",
+                                                          "password": "password"})
+
+    main.migrate_username_index(BATCH_SIZE)
+
+    assert firebase.tree.node(["usernames", "ghost"]) is None
+    assert firebase.tree.node(["usernames", "cook"]) == "chef@example-dot-com"
+    assert firebase.tree.node(["usernames", "user"]) == DB_EMAIL